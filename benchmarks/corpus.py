@@ -0,0 +1,159 @@
+"""
+Synthetic ReScript corpus for the benchmarks: modules of configurable size and shape, edit
+scripts over them, and a throwaway git repository holding a base branch and an edited branch.
+"""
+import os
+import random
+import subprocess
+from dataclasses import dataclass, field, replace
+from typing import List, Tuple
+
+
+@dataclass
+class CorpusShape:
+    files: int = 50
+    lets: int = 40  # top-level let bindings per file
+    nesting: int = 3  # depth of nested switch/if expressions inside function bodies
+    variants: int = 12  # constructors per variant type
+    types: int = 4
+    externals: int = 4
+    submodules: int = 2  # nested `module X = { ... }` blocks per file
+    submodule_lets: int = 6
+
+
+@dataclass
+class EditScript:
+    modify: int = 3  # declarations whose body changes
+    add: int = 1
+    delete: int = 1
+
+
+# A declaration is (kind, name, seed); its text is a pure function of those, so an edit is a new seed
+Decl = Tuple[str, str, int]
+
+
+@dataclass
+class Module:
+    path: str
+    decls: List[Decl] = field(default_factory=list)
+    submodules: List[Tuple[str, List[Decl]]] = field(default_factory=list)
+
+
+def _expression(rng: random.Random, depth: int, indent: str) -> str:
+    if depth <= 0:
+        return rng.choice(["x + %d" % rng.randint(0, 99), "acc * %d" % rng.randint(1, 9), "Belt.Int.toString(x)->String.length"])
+    inner = indent + "  "
+    if rng.random() < 0.5:
+        return (
+            f"switch x {{\n"
+            f"{inner}| {rng.randint(0, 9)} => {_expression(rng, depth - 1, inner)}\n"
+            f"{inner}| _ => {_expression(rng, depth - 1, inner)}\n"
+            f"{indent}}}"
+        )
+    return (
+        f"if x > {rng.randint(0, 99)} {{\n"
+        f"{inner}{_expression(rng, depth - 1, inner)}\n"
+        f"{indent}}} else {{\n"
+        f"{inner}{_expression(rng, depth - 1, inner)}\n"
+        f"{indent}}}"
+    )
+
+
+def render_decl(decl: Decl, shape: CorpusShape, indent: str = "") -> str:
+    kind, name, seed = decl
+    rng = random.Random(seed)
+    if kind == "let":
+        inner = indent + "  "
+        return (
+            f"{indent}let {name} = (x, acc) => {{\n"
+            f"{inner}let y = x + {rng.randint(0, 999)}\n"
+            f"{inner}{_expression(rng, shape.nesting, inner)}\n"
+            f"{indent}}}\n"
+        )
+    if kind == "type":
+        constructors = "".join(
+            f"{indent}  | {name.capitalize()}{index}" + (f"(int, string)" if rng.random() < 0.3 else "") + "\n"
+            for index in range(shape.variants)
+        )
+        return f"{indent}type {name} =\n{constructors}"
+    return f'{indent}@module("lib{rng.randint(0, 9)}") external {name}: (string, int) => promise<int> = "{name}Impl"\n'
+
+
+def render_module(module: Module, shape: CorpusShape) -> str:
+    parts = [render_decl(decl, shape) for decl in module.decls]
+    for name, decls in module.submodules:
+        body = "".join(render_decl(decl, shape, "  ") for decl in decls)
+        parts.append(f"module {name} = {{\n{body}}}\n")
+    return "\n".join(parts)
+
+
+def generate_corpus(shape: CorpusShape, seed: int = 0) -> List[Module]:
+    rng = random.Random(seed)
+    modules = []
+    for index in range(shape.files):
+        module = Module(f"src/components/Component{index}.res")
+        module.decls += [("type", f"t{i}", rng.getrandbits(32)) for i in range(shape.types)]
+        module.decls += [("external", f"ext{i}", rng.getrandbits(32)) for i in range(shape.externals)]
+        module.decls += [("let", f"fn{i}", rng.getrandbits(32)) for i in range(shape.lets)]
+        module.submodules = [
+            (f"Sub{i}", [("let", f"inner{j}", rng.getrandbits(32)) for j in range(shape.submodule_lets)])
+            for i in range(shape.submodules)
+        ]
+        modules.append(module)
+    return modules
+
+
+def apply_edits(module: Module, edits: EditScript, rng: random.Random) -> Module:
+    """A copy of the module with `edits.modify` bodies changed, `edits.add` lets added and `edits.delete` removed"""
+    decls = list(module.decls)
+    for _ in range(min(edits.delete, len(decls))):
+        decls.pop(rng.randrange(len(decls)))
+    for index in rng.sample(range(len(decls)), min(edits.modify, len(decls))):
+        kind, name, _ = decls[index]
+        decls[index] = (kind, name, rng.getrandbits(32))
+    for index in range(edits.add):
+        decls.insert(rng.randrange(len(decls) + 1), ("let", f"added{index}_{rng.getrandbits(16)}", rng.getrandbits(32)))
+    return Module(module.path, decls, list(module.submodules))
+
+
+def _git(cwd: str, *args: str):
+    subprocess.run(["git", *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def build_repo(root: str, shape: CorpusShape, edits: EditScript, edited_files: int, seed: int = 0) -> Tuple[str, str, str]:
+    """
+    Create `root/origin.git` and a clone at `root/work` with a `main` branch holding the corpus and a
+    `feature` branch where `edited_files` files got the edit script applied (plus one added and one
+    deleted file). Both branches are pushed, so GitWrapper's origin/<branch> lookups work.
+    Returns (clone_path, from_branch, to_branch).
+    """
+    rng = random.Random(seed + 1)
+    origin = os.path.join(root, "origin.git")
+    work = os.path.join(root, "work")
+    _git(root, "init", "-q", "--bare", origin)
+    _git(root, "clone", "-q", origin, work)
+    for key, value in (("user.name", "bench"), ("user.email", "bench@example.com"), ("commit.gpgsign", "false")):
+        _git(work, "config", key, value)
+
+    def write(module: Module):
+        path = os.path.join(work, module.path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(render_module(module, shape))
+
+    modules = generate_corpus(shape, seed)
+    _git(work, "checkout", "-q", "-b", "main")
+    for module in modules:
+        write(module)
+    _git(work, "add", "-A")
+    _git(work, "commit", "-q", "-m", "corpus")
+
+    _git(work, "checkout", "-q", "-b", "feature")
+    for module in rng.sample(modules, min(edited_files, len(modules))):
+        write(apply_edits(module, edits, rng))
+    write(Module("src/components/Added.res", generate_corpus(replace(shape, files=1), seed + 2)[0].decls))
+    os.unlink(os.path.join(work, modules[-1].path))
+    _git(work, "add", "-A")
+    _git(work, "commit", "-q", "-m", "edits")
+    _git(work, "push", "-q", "origin", "main", "feature")
+    return work, "feature", "main"
@@ -0,0 +1,158 @@
+"""
+Benchmarks for declaration extraction, comparison and the end-to-end PR diff over a local repo.
+
+    python benchmarks/run.py --output bench.json
+    python benchmarks/run.py --output after.json --compare bench.json
+
+Each benchmark is timed `--repeat` times and reported as min/median/mean seconds. Results are
+saved as JSON together with the corpus shape, so runs with the same parameters can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from tree_sitter import Language, Parser
+import tree_sitter_rescript
+
+from corpus import CorpusShape, EditScript, apply_edits, build_repo, generate_corpus, render_module
+from rescript_ast_diff.compare_commits import generate_pr_changes_bitbucket
+from rescript_ast_diff.differ import RescriptFileDiff
+from rescript_ast_diff.gitwrapper import GitWrapper
+from rescript_ast_diff.output import OUTPUT_FILE_NAMES
+
+
+def timed(function, repeat: int, check=None) -> dict:
+    """check, if given, runs after each timed call (outside the timing) and raises if the call failed"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+        if check:
+            check()
+    return {"min": min(durations), "median": statistics.median(durations), "mean": statistics.mean(durations), "runs": repeat}
+
+
+def run_benchmarks(shape: CorpusShape, edits: EditScript, edited_files: int, repeat: int, seed: int, parse_workers: int) -> dict:
+    parser = Parser(Language(tree_sitter_rescript.language()))
+    rng = random.Random(seed)
+    modules = generate_corpus(shape, seed)
+    old_sources = [render_module(module, shape).encode() for module in modules]
+    new_sources = [render_module(apply_edits(module, edits, rng), shape).encode() for module in modules]
+    old_trees = [parser.parse(source) for source in old_sources]
+    new_trees = [parser.parse(source) for source in new_sources]
+    results = {}
+
+    results["parse"] = timed(lambda: [parser.parse(source) for source in old_sources], repeat)
+    results["extract_query"] = timed(lambda: [RescriptFileDiff().extract_components(tree.root_node) for tree in old_trees], repeat)
+    results["extract_walk"] = timed(lambda: [RescriptFileDiff(use_query=False).extract_components(tree.root_node) for tree in old_trees], repeat)
+    results["compare"] = timed(lambda: [RescriptFileDiff("M").compare_two_files(old, new) for old, new in zip(old_trees, new_trees)], repeat)
+    results["compare_verify"] = timed(lambda: [RescriptFileDiff("M", verify=True).compare_two_files(old, new) for old, new in zip(old_trees, new_trees)], repeat)
+
+    # Both extraction strategies must agree, otherwise the timings are not comparable
+    for tree in old_trees:
+        query = RescriptFileDiff().extract_components(tree.root_node)
+        walk = RescriptFileDiff(use_query=False).extract_components(tree.root_node)
+        if [sorted(kind) for kind in query] != [sorted(kind) for kind in walk]:
+            raise AssertionError("query and walk extraction disagree")
+
+    with tempfile.TemporaryDirectory() as root:
+        work, from_branch, to_branch = build_repo(root, shape, edits, edited_files, seed)
+        output_dir = os.path.join(root, "out")
+        output_path = os.path.join(output_dir, OUTPUT_FILE_NAMES["json"])
+
+        def clear_output():
+            if os.path.exists(output_path):
+                os.unlink(output_path)
+
+        def check_output():
+            # generate_pr_changes_bitbucket reports errors instead of raising, so a failed run would
+            # otherwise be timed as if it had succeeded
+            if not os.path.exists(output_path):
+                raise AssertionError(f"end-to-end run wrote no {output_path}")
+            with open(output_path) as f:
+                if not json.load(f):
+                    raise AssertionError(f"end-to-end run wrote no changes to {output_path}")
+            clear_output()
+
+        clear_output()
+        with GitWrapper(work) as gitclient:
+            for name, options in (
+                ("end_to_end", {}),
+                ("end_to_end_incremental", {"incremental": True}),
+                ("end_to_end_hunk_directed", {"hunk_directed": True}),
+            ):
+                results[name] = timed(
+                    lambda: generate_pr_changes_bitbucket(
+                        gitclient_object=gitclient, fromBranch=from_branch, toBranch=to_branch,
+                        output_dir=output_dir, parse_workers=parse_workers, **options,
+                    ),
+                    repeat,
+                    check=check_output,
+                )
+    return results
+
+
+def compare(results: dict, baseline: dict):
+    print(f"{'benchmark':<28}{'baseline':>12}{'current':>12}{'ratio':>9}")
+    for name, timing in results["benchmarks"].items():
+        before = baseline["benchmarks"].get(name)
+        if before is None:
+            continue
+        print(f"{name:<28}{before['median']:>12.4f}{timing['median']:>12.4f}{timing['median'] / before['median']:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    defaults = CorpusShape()
+    for name, value in asdict(defaults).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=value)
+    parser.add_argument("--modify", type=int, default=EditScript.modify)
+    parser.add_argument("--add", type=int, default=EditScript.add)
+    parser.add_argument("--delete", type=int, default=EditScript.delete)
+    parser.add_argument("--edited-files", type=int, default=10, help="Files touched on the feature branch")
+    parser.add_argument("--parse-workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", default=None, help="Earlier results file to print ratios against")
+    args = parser.parse_args()
+
+    shape = CorpusShape(**{name: getattr(args, name) for name in asdict(defaults)})
+    edits = EditScript(args.modify, args.add, args.delete)
+    benchmarks = run_benchmarks(shape, edits, args.edited_files, args.repeat, args.seed, args.parse_workers)
+
+    revision = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, text=True).stdout.strip()
+    results = {
+        "revision": revision,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "shape": asdict(shape),
+        "edits": asdict(edits),
+        "edited_files": args.edited_files,
+        "parse_workers": args.parse_workers,
+        "seed": args.seed,
+        "benchmarks": benchmarks,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=3)
+    print("Results written to - ", args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
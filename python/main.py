@@ -21,19 +21,38 @@ def clone_repo(repo_url, local_path):
         print(f'Repository already exists at {local_path}')
 
 def get_changed_files(branch_or_commit, new_commit, local_path):
-    old_cwd = os.getcwd()
-    os.chdir(local_path)
-
-    try:
-        subprocess.run(['git', 'checkout', '-f', branch_or_commit], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        commit = subprocess.run(['git', 'rev-parse', branch_or_commit], check=True, stdout=subprocess.PIPE).stdout.decode().strip()
-        diff = subprocess.run(['git', 'diff', '--name-only', commit, new_commit], check=True, stdout=subprocess.PIPE).stdout.decode()
-
-        files = [file for file in diff.split('\n') if file.strip() and file.endswith('.res')]
-
-        return files
-    finally:
-        os.chdir(old_cwd)
+    # Diffing two commits only reads the object database; the working tree is left alone
+    commit = subprocess.run(['git', '-C', local_path, 'rev-parse', branch_or_commit], check=True, stdout=subprocess.PIPE).stdout.decode().strip()
+    diff = subprocess.run(['git', '-C', local_path, 'diff', '--name-only', commit, new_commit], check=True, stdout=subprocess.PIPE).stdout.decode()
+
+    files = [file for file in diff.split('\n') if file.strip() and file.endswith('.res')]
+
+    return files
+
+def list_blobs(commit, files, local_path):
+    """Map each file that exists at `commit` to its blob id, via `git ls-tree`"""
+    if not files:
+        return {}
+    entries = subprocess.run(['git', '-C', local_path, 'ls-tree', '-r', '-z', '--full-tree', commit, '--'] + files, check=True, stdout=subprocess.PIPE).stdout.decode()
+    blobs = {}
+    for entry in entries.split('\0'):
+        if entry:
+            meta, file = entry.split('\t', 1)
+            blobs[file] = meta.split(' ')[2]
+    return blobs
+
+def read_blobs(object_ids, local_path):
+    """Read many blobs through a single `git cat-file --batch` process"""
+    request = ''.join(f'{object_id}\n' for object_id in object_ids).encode()
+    output = subprocess.run(['git', '-C', local_path, 'cat-file', '--batch'], input=request, check=True, stdout=subprocess.PIPE).stdout
+    contents = []
+    position = 0
+    for _ in object_ids:
+        header_end = output.index(b'\n', position)
+        size = int(output[position:header_end].split(b' ')[2])
+        contents.append(output[header_end + 1:header_end + 1 + size])
+        position = header_end + 1 + size + 1
+    return contents
 
 def main():
     args = sys.argv[1:]
@@ -55,26 +74,15 @@ def main():
 
         file_node_dict = defaultdict(list)
 
-        file_paths = [os.path.join(local_repo_path, file) for file in changed_files]
-
-        print('Processing modules for previous commit...')
-        for changed_file in file_paths:
-            if os.path.exists(changed_file):
-                module_name = extract_module_name(changed_file)
-                ast = parser.parse(open(changed_file, "rb").read())
-                file_node_dict[module_name].append(ast)
-
-        print('Switching to current commit...')
-        old_cwd = os.getcwd()
-        os.chdir(local_repo_path)
-        subprocess.run(['git', 'checkout', '-f', current_commit], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        os.chdir(old_cwd)
-
-        print('Processing modules for current commit...')
-        for changed_file in file_paths:
-            if os.path.exists(changed_file):
+        # Both revisions are read from the object database, so the clone is never checked out
+        for label, commit in (('previous', branch_or_commit), ('current', current_commit)):
+            print(f'Processing modules for {label} commit...')
+            blobs = list_blobs(commit, changed_files, local_repo_path)
+            present_files = [file for file in changed_files if file in blobs]
+            contents = read_blobs([blobs[file] for file in present_files], local_repo_path)
+            for changed_file, content in zip(present_files, contents):
                 module_name = extract_module_name(changed_file)
-                ast = parser.parse(open(changed_file, "rb").read())
+                ast = parser.parse(content)
                 file_node_dict[module_name].append(ast)
 
         print('Generating changes...')
@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+
+from rescript_ast_diff.history import generate_history
+from rescript_ast_diff.shards import Shard
+
+
+def history_command(args):
+    from_commit, separator, to_commit = args.range.partition("..")
+    if not separator or not from_commit or not to_commit:
+        raise SystemExit(f"Expected a commit range A..B, got '{args.range}'")
+    generate_history(
+        args.repo,
+        from_commit,
+        to_commit,
+        output_dir=args.output,
+        output_format=args.format,
+        workers=args.workers,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=args.cache_max_bytes,
+        quiet=args.quiet,
+        ignore_formatting=args.ignore_formatting,
+    )
+
+
+def open_clients(args, fetch_ttl: float = 0.0):
+    """(bitbucket_object, gitclient_object) for --bitbucket-url/--project/--slug/--mirror or --repo"""
+    from rescript_ast_diff.bitbucket import BitBucket
+    from rescript_ast_diff.gitwrapper import GitWrapper
+
+    bitbucket_object = gitclient_object = None
+    if args.bitbucket_url:
+        if not (args.project and args.slug):
+            raise SystemExit("--bitbucket-url needs --project and --slug")
+        auth = (os.environ.get("BITBUCKET_USERNAME"), os.environ.get("BITBUCKET_TOKEN"))
+        bitbucket_object = BitBucket(args.bitbucket_url, args.project, args.slug, auth, {"Accept": "application/json"})
+        if args.mirror:
+            gitclient_object = GitWrapper(args.mirror, fetch_ttl=fetch_ttl)
+    else:
+        gitclient_object = GitWrapper(args.repo, fetch_ttl=fetch_ttl)
+    return bitbucket_object, gitclient_object
+
+
+def compare_command(args):
+    from rescript_ast_diff.compare_commits import generate_pr_changes_bitbucket
+
+    if not args.pr and not (args.from_branch and args.to_branch):
+        raise SystemExit("Expected --pr or both --from-branch and --to-branch")
+    bitbucket_object, gitclient_object = open_clients(args)
+    if args.pr and not bitbucket_object:
+        raise SystemExit("--pr needs --bitbucket-url")
+    try:
+        generate_pr_changes_bitbucket(
+            bitbucket_object,
+            gitclient_object,
+            pr_id=args.pr,
+            fromBranch=args.from_branch,
+            toBranch=args.to_branch,
+            output_dir=args.output,
+            output_format=args.format,
+            quiet=args.quiet,
+            fetch_workers=args.fetch_workers,
+            parse_workers=args.parse_workers,
+            cache_dir=args.cache_dir,
+            cache_max_bytes=args.cache_max_bytes,
+            incremental=args.incremental,
+            hunk_directed=args.hunk_directed,
+            detect_renames=args.detect_renames,
+            edit_scripts=args.edit_scripts,
+            patch_heads=args.patch_heads,
+            ignore_formatting=args.ignore_formatting,
+            collect_metrics=args.metrics,
+            prometheus=args.prometheus,
+            shard=args.shard,
+        )
+    finally:
+        if gitclient_object:
+            gitclient_object.close()
+        if bitbucket_object:
+            bitbucket_object.close()
+
+
+def merge_command(args):
+    from rescript_ast_diff.shards import merge_shards
+
+    try:
+        merge_shards(args.shards, output_dir=args.output, output_format=args.format)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+
+def serve_command(args):
+    from rescript_ast_diff.server import DiffService, serve
+
+    bitbucket_object, gitclient_object = open_clients(args, fetch_ttl=args.fetch_ttl)
+    service = DiffService(
+        bitbucket_object,
+        gitclient_object,
+        parse_workers=args.parse_workers,
+        fetch_workers=args.fetch_workers,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=args.cache_max_bytes,
+        max_concurrent=args.max_concurrent,
+        max_queue=args.max_queue,
+        timeout=args.timeout,
+    )
+    serve(service, host=args.host, port=args.port, socket_path=args.socket)
+
+
+def index_command(args):
+    from rescript_ast_diff.gitwrapper import GitWrapper
+    from rescript_ast_diff.index import DeclarationIndex, build_index
+
+    if args.action == "build":
+        build_index(args.repo, args.db, args.refs, workers=args.workers, cache_dir=args.cache_dir)
+        return
+    with GitWrapper(args.repo) as gitclient, DeclarationIndex(args.db) as index:
+        if args.action == "impact":
+            # Both sides are brought into the index first; whatever is already there is reused
+            old_commit = index.update(gitclient, args.old, workers=args.workers, cache_dir=args.cache_dir)
+            new_commit = index.update(gitclient, args.new, workers=args.workers, cache_dir=args.cache_dir)
+            changed = index.changed_declarations(old_commit, new_commit)
+            impacted = index.impacted(new_commit, [(entry["module"], entry["name"]) for entry in changed], max_depth=args.depth)
+            results = {"changed": changed, "impacted": impacted}
+        elif args.action == "find":
+            results = index.definitions(gitclient.resolve_commit(args.commit), args.name, kind=args.kind)
+        else:
+            results = index.changes(gitclient.resolve_commit(args.old), gitclient.resolve_commit(args.new), args.name, kind=args.kind)
+    print(json.dumps(results, indent=3))
+
+
+def shard_argument(value: str) -> Shard:
+    try:
+        return Shard.parse(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="rescript_ast_diff", description="Declaration-level diffs of ReScript code")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    history = commands.add_parser("history", help="Per-commit declaration changes for every commit in a range")
+    history.add_argument("range", help="Commit range A..B (commits reachable from B but not A, oldest first)")
+    history.add_argument("--repo", default=".", help="Path to the git repository")
+    history.add_argument("--output", default="./", help="Directory for history.ndjson / history.json")
+    history.add_argument("--format", choices=("ndjson", "json"), default="ndjson")
+    history.add_argument("--workers", type=int, default=1, help="Parser processes; each distinct blob is parsed once")
+    history.add_argument("--cache-dir", default=None, help="Declaration cache shared across runs")
+    history.add_argument("--cache-max-bytes", type=int, default=None)
+    history.add_argument("--ignore-formatting", action="store_true", help="Do not report declarations whose only changes are layout or comments")
+    history.add_argument("--quiet", action="store_true")
+    history.set_defaults(handler=history_command)
+
+    compare = commands.add_parser("compare", help="Declaration changes of a PR or between two branches")
+    compare.add_argument("--pr", default=None, help="Pull request id (needs --bitbucket-url)")
+    compare.add_argument("--from-branch", default=None, help="Branch with the changes")
+    compare.add_argument("--to-branch", default=None, help="Branch it is compared against, from their merge-base")
+    compare.add_argument("--repo", default=".", help="Local repository to read from when not using Bitbucket")
+    compare.add_argument("--bitbucket-url", default=None, help="Bitbucket REST base URL; credentials come from BITBUCKET_USERNAME/BITBUCKET_TOKEN")
+    compare.add_argument("--project", default=None)
+    compare.add_argument("--slug", default=None)
+    compare.add_argument("--mirror", default=None, help="With Bitbucket, a local clone to read changed files and contents from")
+    compare.add_argument("--output", default="./", help="Directory for detailed_changes.json / .ndjson")
+    compare.add_argument("--format", choices=("json", "ndjson"), default="json")
+    compare.add_argument("--fetch-workers", type=int, default=8)
+    compare.add_argument("--parse-workers", type=int, default=1)
+    compare.add_argument("--cache-dir", default=None)
+    compare.add_argument("--cache-max-bytes", type=int, default=None)
+    compare.add_argument("--incremental", action="store_true", help="Reparse modified files incrementally from their diff hunks")
+    compare.add_argument("--hunk-directed", action="store_true", help="Only compare declarations a diff hunk touches")
+    compare.add_argument("--detect-renames", action="store_true", help="Also write declaration_moves.json")
+    compare.add_argument("--edit-scripts", action="store_true", help="Report modified declarations as tree edit scripts")
+    compare.add_argument("--patch-heads", action="store_true", help="Rebuild new-side files from the raw diff (Bitbucket only)")
+    compare.add_argument("--ignore-formatting", action="store_true", help="Do not report declarations whose only changes are layout or comments")
+    compare.add_argument("--metrics", action="store_true", help="Also write metrics.json")
+    compare.add_argument("--prometheus", metavar="PATH", default=None, help="Also write the metrics in the Prometheus text format to PATH (implies --metrics)")
+    compare.add_argument("--shard", type=shard_argument, default=None, help="Only diff shard i of N (i/N, from 1), balanced by file size; combine the shards with `merge`")
+    compare.add_argument("--quiet", action="store_true")
+    compare.set_defaults(handler=compare_command)
+
+    merge = commands.add_parser("merge", help="Combine the outputs of every `compare --shard` of one run")
+    merge.add_argument("shards", nargs="+", help="Output directories of shards 1..N")
+    merge.add_argument("--output", default="./", help="Directory for the combined detailed_changes file")
+    merge.add_argument("--format", choices=("json", "ndjson"), default=None, help="Defaults to the shards' format")
+    merge.set_defaults(handler=merge_command)
+
+    server = commands.add_parser("serve", help="Keep parsers warm and answer diff requests over HTTP")
+    server.add_argument("--repo", default=".", help="Local repository to read from when not using Bitbucket")
+    server.add_argument("--bitbucket-url", default=None, help="Bitbucket REST base URL; credentials come from BITBUCKET_USERNAME/BITBUCKET_TOKEN")
+    server.add_argument("--project", default=None)
+    server.add_argument("--slug", default=None)
+    server.add_argument("--mirror", default=None, help="With Bitbucket, a local clone to read changed files and contents from")
+    server.add_argument("--host", default="127.0.0.1")
+    server.add_argument("--port", type=int, default=8765)
+    server.add_argument("--socket", default=None, help="Listen on this Unix socket instead of TCP")
+    server.add_argument("--parse-workers", type=int, default=2)
+    server.add_argument("--fetch-workers", type=int, default=8)
+    server.add_argument("--max-concurrent", type=int, default=4, help="Requests processed at once")
+    server.add_argument("--max-queue", type=int, default=32, help="Requests accepted (running or waiting) before answering 503")
+    server.add_argument("--timeout", type=float, default=30.0, help="Seconds per request before answering 504")
+    server.add_argument("--fetch-ttl", type=float, default=0.0, help="Reuse a branch fetched less than this many seconds ago instead of fetching it again")
+    server.add_argument("--cache-dir", default=None)
+    server.add_argument("--cache-max-bytes", type=int, default=None)
+    server.set_defaults(handler=serve_command)
+
+    index = commands.add_parser("index", help="SQLite index of every declaration and reference per commit")
+    index.add_argument("--repo", default=".", help="Path to the git repository")
+    index.add_argument("--db", default="declarations.sqlite", help="Index database file")
+    actions = index.add_subparsers(dest="action", required=True)
+    build = actions.add_parser("build", help="Index commits, each incrementally from the last indexed one")
+    build.add_argument("refs", nargs="+")
+    build.add_argument("--workers", type=int, default=1)
+    build.add_argument("--cache-dir", default=None)
+    find = actions.add_parser("find", help="Where a declaration is defined at a commit")
+    find.add_argument("name", help="Bare or Module::qualified declaration name")
+    find.add_argument("--commit", default="HEAD")
+    find.add_argument("--kind", choices=("function", "type", "external"), default=None)
+    changed = actions.add_parser("changes", help="Modules where a declaration changed between two commits")
+    changed.add_argument("old")
+    changed.add_argument("new")
+    changed.add_argument("name")
+    changed.add_argument("--kind", choices=("function", "type", "external"), default=None)
+    impact = actions.add_parser("impact", help="Declarations changed between two commits and everything that transitively refers to them")
+    impact.add_argument("old")
+    impact.add_argument("new")
+    impact.add_argument("--depth", type=int, default=3, help="Follow references at most this many levels")
+    impact.add_argument("--workers", type=int, default=1)
+    impact.add_argument("--cache-dir", default=None)
+    index.set_defaults(handler=index_command)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,13 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from rescript_ast_diff import metrics
 
 def handle_response(response, function, *args):
     if response.status_code == 200:
@@ -12,20 +21,78 @@ def handle_response(response, function, *args):
     return None
 
 class BitBucket:
-    def __init__(self, base_url, project_key, repo_slug, auth, headers):
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # The `raw` endpoint itself is missing or refuses the request; anything else (a 404 for a path
+    # that does not exist, say) would fail the same way through `browse`
+    RAW_UNAVAILABLE_STATUSES = (405, 406, 501)
+
+    def __init__(self, base_url, project_key, repo_slug, auth, headers, pool_size=16, max_concurrency=8, max_retries=3, backoff_factor=0.5, requests_per_second=None):
         self.base_url = base_url
         self.project_key = project_key
         self.repo_slug = repo_slug
         self.auth = auth
         self.headers = headers
 
+        # One session for every call, so connections (and TLS handshakes) are reused
+        self.session = requests.Session()
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=self.RETRY_STATUSES,
+            allowed_methods=frozenset({"GET"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._min_interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._next_request_at = 0.0
+        self._rate_lock = threading.Lock()
+        self._raw_available = True
+
         self.FILE_CONTENT_URL  = base_url + "/api/latest/projects/{projectKey}/repos/{repositorySlug}/browse/{path}"
+        self.RAW_FILE_URL  = base_url + "/api/latest/projects/{projectKey}/repos/{repositorySlug}/raw/{path}"
         self.GET_PR_URL = base_url + "/api/latest/projects/{projectKey}/repos/{repositorySlug}/pull-requests/{pullRequestId}"
         self.GET_LATEST_COMMIT = base_url + "/api/latest/projects/{projectKey}/repos/{repositorySlug}/commits/{branchName}?limit=1"
         self.DIFF_URL  = base_url + "/api/latest/projects/{projectKey}/repos/{repositorySlug}/compare/diff"
         self.DIFF_URL_RAW  = base_url + "/api/latest/projects/{projectKey}/repos/{repositorySlug}/diff"
         self.GET_PRS = base_url + "/api/latest/projects/{projectKey}/repos/{repositorySlug}/pull-requests?state=OPEN&at=refs/heads/{sourceBranch}&direction=OUTGOING"
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def _wait_for_rate_limit(self):
+        if not self._min_interval:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_request_at)
+            self._next_request_at = start_at + self._min_interval
+        if start_at > now:
+            time.sleep(start_at - now)
+
+    def _get(self, url, params=None, stream=False, headers=None):
+        """GET through the shared session, bounded by max_concurrency and retried on 429/5xx"""
+        with self._slots:
+            self._wait_for_rate_limit()
+            with metrics.span("bitbucket.request"):
+                response = self.session.get(url, auth = self.auth, headers = {**self.headers, **(headers or {})}, params = params, stream = stream)
+        if metrics.enabled():
+            metrics.count("http.requests")
+            retries = getattr(response.raw, "retries", None)
+            metrics.count("http.retries", len(retries.history) if retries is not None else 0)
+        return response
+
     def get_file_path_from_object(self, json_object):
         if json_object["parent"] == "":
             return json_object["name"]
@@ -39,7 +106,8 @@ class BitBucket:
                 changes = {
                     "added" : [],
                     "deleted" : [],
-                    "modified" : []
+                    "modified" : [],
+                    "renamed" : []
                 }
 
                 for diff in json["diffs"]:
@@ -48,7 +116,12 @@ class BitBucket:
                     elif diff["destination"] is None:
                         changes["deleted"].append(self.get_file_path_from_object(diff["source"]))
                     else:
-                        changes["modified"].append(self.get_file_path_from_object(diff["source"]))
+                        source_path = self.get_file_path_from_object(diff["source"])
+                        destination_path = self.get_file_path_from_object(diff["destination"])
+                        if source_path != destination_path:
+                            changes["renamed"].append((source_path, destination_path))
+                        else:
+                            changes["modified"].append(source_path)
                 
                 return changes
 
@@ -57,7 +130,7 @@ class BitBucket:
                 "to": to_commit,
                 "from": from_commit
             }
-            response = requests.get(final_url, auth = self.auth, headers = self.headers, params=params)
+            response = self._get(final_url, params=params)
             return handle_response(response, discover_files)
 
     def get_changed_files_from_commits_raw(self, from_commit: str, to_commit: str):
@@ -66,12 +139,67 @@ class BitBucket:
                 "to": to_commit,
                 "from": from_commit
             }
-            response = requests.get(final_url, auth = self.auth, headers = self.headers, params=params)
+            response = self._get(final_url, params=params)
             return handle_response(response, lambda x: x.text)
 
+    def get_raw_diff(self, from_commit: str, to_commit: str) -> Optional[str]:
+        """
+        The whole unified diff from to_commit to from_commit as git prints it, `index` lines
+        included, in one request. Decoded so that it encodes back to the exact bytes.
+        """
+        final_url = self.DIFF_URL_RAW.format(projectKey = self.project_key, repositorySlug = self.repo_slug)
+        params = {
+            "since": to_commit,
+            "until": from_commit,
+        }
+        response = self._get(final_url, params=params, headers={"Accept": "text/plain"})
+        if response.status_code == 200:
+            metrics.count("bytes_fetched", len(response.content))
+        return handle_response(response, lambda response: response.content.decode("utf-8", errors="surrogateescape"))
+
+    def get_file_hunks(self, from_commit: str, to_commit: str) -> dict:
+        """Changed line ranges per file as 0-based (old_start, old_count, new_start, new_count)"""
+
+        def collect_hunks(response):
+            hunks = {}
+            for diff in response.json()["diffs"]:
+                if diff["source"] is None or diff["destination"] is None:
+                    continue
+                file_hunks = hunks.setdefault(self.get_file_path_from_object(diff["source"]), [])
+                for hunk in diff.get("hunks", []):
+                    # With contextLines=0 every run of removed/added segments is one changed region
+                    old_next, new_next = hunk["sourceLine"] - 1, hunk["destinationLine"] - 1
+                    region = None
+                    for segment in hunk["segments"]:
+                        if segment["type"] == "CONTEXT":
+                            if region:
+                                file_hunks.append(tuple(region))
+                                region = None
+                            old_next = segment["lines"][-1]["source"]
+                            new_next = segment["lines"][-1]["destination"]
+                            continue
+                        if region is None:
+                            region = [old_next, 0, new_next, 0]
+                        if segment["type"] == "REMOVED":
+                            region[1] += len(segment["lines"])
+                        else:
+                            region[3] += len(segment["lines"])
+                    if region:
+                        file_hunks.append(tuple(region))
+            return hunks
+
+        final_url = self.DIFF_URL.format(projectKey = self.project_key, repositorySlug = self.repo_slug)
+        params = {
+            "to": to_commit,
+            "from": from_commit,
+            "contextLines": 0
+        }
+        response = self._get(final_url, params=params)
+        return handle_response(response, collect_hunks)
+
     def get_pr_bitbucket(self, pr_id: str):
         final_url = self.GET_PR_URL.format(projectKey = self.project_key, repositorySlug = self.repo_slug, pullRequestId = pr_id)
-        response = requests.get(final_url, auth = self.auth, headers = self.headers)
+        response = self._get(final_url)
         return handle_response(response, lambda response: response.json())
     
     def get_latest_commit_from_branch(self, branchName: str):
@@ -80,7 +208,7 @@ class BitBucket:
             return formatted_response['id']
         
         final_url = self.GET_LATEST_COMMIT.format(projectKey = self.project_key, repositorySlug = self.repo_slug, branchName = branchName)
-        response = requests.get(final_url, auth = self.auth, headers = self.headers)
+        response = self._get(final_url)
         return handle_response(response, handle_file_response)
 
     def get_pr_id(self, branchName: str): 
@@ -91,19 +219,70 @@ class BitBucket:
                     return (pr['id'], pr['fromRef']['latestCommit'], pr['toRef']['latestCommit'])
         
         final_url = self.GET_PRS.format(projectKey = self.project_key, repositorySlug = self.repo_slug, sourceBranch = branchName)
-        response = requests.get(final_url, auth = self.auth, headers = self.headers)
+        response = self._get(final_url)
         return handle_response(response, handle_file_response)
 
     def get_file_content_from_bitbucket(self, file_path: str, commit: str = "") -> str:
-        
+        """Fetch a file through the paginated `browse` endpoint, following every page"""
+        lines = self._browse_lines(file_path, commit)
+        return "\n".join(lines) if lines is not None else None
+
+    def _browse_lines(self, file_path: str, commit: str = "") -> Optional[List[str]]:
+        """Every line of a file through `browse`, without terminators, or None on failure"""
+
         def handle_file_response(response):
             formatted_response = response.json()
-            return "\n".join(line["text"] for line in formatted_response["lines"])
-        
+            return [line["text"] for line in formatted_response["lines"]], formatted_response
+
         final_url = self.FILE_CONTENT_URL.format(projectKey = self.project_key, repositorySlug = self.repo_slug, path = file_path)
         params = {
             "at" : commit,
             "limit": 10000
         }
-        response = requests.get(final_url, auth = self.auth, headers = self.headers, params=params)
-        return handle_response(response, handle_file_response)
+        lines = []
+        while True:
+            response = self._get(final_url, params=params)
+            page = handle_response(response, handle_file_response)
+            if page is None:
+                return None
+            page_lines, formatted_response = page
+            lines.extend(page_lines)
+            if formatted_response.get("isLastPage", True) or "nextPageStart" not in formatted_response:
+                break
+            params["start"] = formatted_response["nextPageStart"]
+        return lines
+
+    def get_file_bytes_from_bitbucket(self, file_path: str, commit: str = "") -> bytes:
+        """
+        Stream the raw bytes of a file, or None if it cannot be read. Only when the server does not
+        offer the `raw` endpoint is the file rebuilt from the paginated `browse` endpoint instead;
+        browse drops line terminators, so every line, the last included, gets its "\n" back (as
+        `rescript format` writes them) and carriage returns browse reports are kept.
+        """
+        if self._raw_available:
+            final_url = self.RAW_FILE_URL.format(projectKey = self.project_key, repositorySlug = self.repo_slug, path = file_path)
+            with self._get(final_url, params={"at": commit}, stream=True) as response:
+                if response.status_code == 200:
+                    content = b"".join(response.iter_content(chunk_size=64 * 1024))
+                    metrics.count("bytes_fetched", len(content))
+                    return content
+                if response.status_code not in self.RAW_UNAVAILABLE_STATUSES:
+                    print(f"Error: Received status code {response.status_code} for {file_path} at {commit}")
+                    return None
+            # Remembered, so later files go straight to `browse`
+            self._raw_available = False
+
+        lines = self._browse_lines(file_path, commit)
+        if lines is None:
+            return None
+        content = "".join(line + "\n" for line in lines).encode()
+        metrics.count("bytes_fetched", len(content))
+        return content
+
+    def get_file_contents(self, pairs: Iterable[Tuple[str, str]]) -> List[Optional[bytes]]:
+        """Fetch raw bytes of many (commit, file_path) pairs concurrently; results are in input order, None on failure"""
+        pairs = list(pairs)
+        if not pairs:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(pairs))) as pool:
+            return list(pool.map(lambda pair: self.get_file_bytes_from_bitbucket(pair[1], pair[0]), pairs))
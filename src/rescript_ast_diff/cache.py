@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import tempfile
+from importlib import metadata
+from typing import Optional
+
+from rescript_ast_diff import metrics
+from rescript_ast_diff.differ import Declaration
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; eviction then runs without the cross-process lock
+    fcntl = None
+
+# Bump whenever the shape or meaning of a cached record changes
+CACHE_FORMAT_VERSION = 3
+
+COMPONENT_KINDS = ("functions", "types", "externals")
+
+
+def git_blob_id(content: bytes) -> str:
+    """The id git assigns to a blob with this content, so fetched bytes and `ls-tree` ids share one key space"""
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def cache_key(blob_id: str, ignore_formatting: bool = False) -> str:
+    """Declarations fingerprinted with normalized_hash are cached apart from the exact ones"""
+    return blob_id + "-normalized" if ignore_formatting else blob_id
+
+
+def grammar_version() -> str:
+    try:
+        return metadata.version("tree-sitter-rescript")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def components_to_record(components) -> dict:
+    """Serialise extract_components output; trees are dropped, fingerprints, bodies and spans are kept"""
+    return {
+        kind: {
+            name: [decl.fingerprint, decl.body, list(decl.start_point), list(decl.end_point), decl.start_byte, decl.end_byte]
+            for name, decl in component_map.items()
+        }
+        for kind, component_map in zip(COMPONENT_KINDS, components)
+    }
+
+
+def record_to_components(record: dict):
+    """Inverse of components_to_record: Declarations with no tree and their body held inline"""
+    return tuple(
+        {
+            name: Declaration(name, None, None, 0, start_byte, end_byte, tuple(start), tuple(end), fingerprint, body=body)
+            for name, (fingerprint, body, start, end, start_byte, end_byte) in record[kind].items()
+        }
+        for kind in COMPONENT_KINDS
+    )
+
+
+class DeclarationCache:
+    """
+    On-disk cache of extracted declarations keyed by git blob id.
+
+    Entries live under a directory named after the grammar and cache format versions, so upgrading
+    either starts a fresh namespace. Writes go to a temporary file and are renamed into place, and
+    readers tolerate entries vanishing underneath them, so concurrent jobs can share a directory.
+    Hits refresh the entry's mtime; once the namespace grows past max_bytes the least recently
+    used entries are evicted.
+    """
+
+    suffix = ".json"
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries_dir = os.path.join(cache_dir, self.namespace())
+        os.makedirs(self.entries_dir, exist_ok=True)
+        self._approximate_size = None
+        self.hits = 0
+        self.misses = 0
+
+    def namespace(self) -> str:
+        return hashlib.sha1(f"{grammar_version()}:{CACHE_FORMAT_VERSION}".encode()).hexdigest()[:16]
+
+    def _entry_path(self, blob_id: str) -> str:
+        return os.path.join(self.entries_dir, blob_id[:2], blob_id[2:] + self.suffix)
+
+    def get(self, blob_id: str):
+        """Cached components for a blob, or None"""
+        path = self._entry_path(blob_id)
+        try:
+            with open(path, "rb") as f:
+                record = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            metrics.count("cache.misses")
+            return None
+        self.hits += 1
+        metrics.count("cache.hits")
+        return record_to_components(record)
+
+    def put(self, blob_id: str, components):
+        self._write(self._entry_path(blob_id), json.dumps(components_to_record(components), separators=(",", ":")).encode())
+
+    def _write(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+
+        if self._approximate_size is None:
+            self._approximate_size = self._scan_size()
+        self._approximate_size += len(data)
+        if self._approximate_size > self.max_bytes:
+            self.evict()
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        for directory, _, files in os.walk(self.entries_dir):
+            for name in files:
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def evict(self, target_fraction: float = 0.8):
+        """Delete least recently used entries until the namespace is below target_fraction of max_bytes"""
+        lock_file = open(os.path.join(self.cache_dir, ".evict.lock"), "w")
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Another job is already evicting
+                    self._approximate_size = None
+                    return
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * target_fraction
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
+            self._approximate_size = total
+        finally:
+            lock_file.close()
+
+
+class ContentCache(DeclarationCache):
+    """
+    File contents keyed by (commit, path), in their own namespace of the same cache directory
+    and with the same atomic writes and LRU eviction as DeclarationCache.
+    """
+
+    suffix = ".blob"
+
+    def namespace(self) -> str:
+        return "contents"
+
+    def _key(self, commit: str, file_path: str) -> str:
+        return hashlib.sha1(f"{commit}:{file_path}".encode(errors="surrogateescape")).hexdigest()
+
+    def get(self, commit: str, file_path: str) -> Optional[bytes]:
+        path = self._entry_path(self._key(commit, file_path))
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            metrics.count("content_cache.misses")
+            return None
+        self.hits += 1
+        metrics.count("content_cache.hits")
+        return content
+
+    def put(self, commit: str, file_path: str, content: bytes):
+        self._write(self._entry_path(self._key(commit, file_path)), content)
+
+
+def open_cache(cache_dir: Optional[str], max_bytes: Optional[int] = None, cache_class=DeclarationCache) -> Optional[DeclarationCache]:
+    if not cache_dir:
+        return None
+    if max_bytes is None:
+        return cache_class(cache_dir)
+    return cache_class(cache_dir, max_bytes)
@@ -1,13 +1,21 @@
 import os
 
 import subprocess
-from tree_sitter import Language, Parser, Node
-import tree_sitter_rescript
+import time
+from tree_sitter import Parser, Node
 import json
 from collections import defaultdict
-from rescript_ast_diff.differ import RescriptFileDiff
+from rescript_ast_diff import metrics
+from rescript_ast_diff.differ import RescriptFileDiff, rescript_language
 from rescript_ast_diff.bitbucket import BitBucket
+from rescript_ast_diff.cache import ContentCache, open_cache
 from rescript_ast_diff.gitwrapper import GitWrapper
+from rescript_ast_diff.hunks import hunk_from_unified
+from rescript_ast_diff.patches import PatchError, apply_patch, parse_patch
+from rescript_ast_diff.pipeline import DiffPipeline
+from rescript_ast_diff.output import ChangesWriter
+from rescript_ast_diff.renames import DeclarationMatcher
+from rescript_ast_diff.shards import Shard, write_manifest
 import traceback
 
 
@@ -16,164 +24,310 @@ def extract_module_name(filepath):
 
 def clone_repo(repo_url, local_path):
     if not os.path.exists(local_path):
+        # Blobless: only the files a diff reads are ever downloaded
         print(f'Cloning repository to {local_path}...')
-        subprocess.run(['git', 'clone', repo_url, local_path], check=True)
+        GitWrapper.clone(repo_url, local_path)
     else:
         print(f'Repository already exists at {local_path}')
 
 def get_changed_files(branch_or_commit, new_commit, local_path):
-    old_cwd = os.getcwd()
-    os.chdir(local_path)
+    # Diffing two commits only reads the object database; the working tree is left alone
+    commit = subprocess.run(['git', '-C', local_path, 'rev-parse', branch_or_commit], check=True, stdout=subprocess.PIPE).stdout.decode().strip()
+    diff = subprocess.run(['git', '-C', local_path, 'diff', '--name-only', commit, new_commit], check=True, stdout=subprocess.PIPE).stdout.decode()
 
-    try:
-        subprocess.run(['git', 'checkout', '-f', branch_or_commit], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        commit = subprocess.run(['git', 'rev-parse', branch_or_commit], check=True, stdout=subprocess.PIPE).stdout.decode().strip()
-        diff = subprocess.run(['git', 'diff', '--name-only', commit, new_commit], check=True, stdout=subprocess.PIPE).stdout.decode()
-
-        files = [file for file in diff.split('\n') if file.strip() and file.endswith('.res')]
+    files = [file for file in diff.split('\n') if file.strip() and file.endswith('.res')]
 
-        return files
-    finally:
-        os.chdir(old_cwd)
+    return files
 
-def generate_changes_local(repo_url, local_repo_path, branch_or_commit, current_commit, output_dir):
+def generate_changes_local(repo_url, local_repo_path, branch_or_commit, current_commit, output_dir, output_format="json", shard: Shard = None):
+    """
+    Diff two revisions of a local clone by reading both trees straight from the object
+    database. The working tree is never checked out, so several runs can share one clone.
+    With shard, only that shard's files (balanced by their new size) are read and diffed.
+    """
     try:
-        RS_LANGUAGE = Language(tree_sitter_rescript.language())
-        parser = Parser(RS_LANGUAGE)
+        parser = Parser(rescript_language())
         clone_repo(repo_url, local_repo_path)
 
-        print('Getting changed files...')
-        changed_files = get_changed_files(branch_or_commit, current_commit, local_repo_path)
-        print(f'Found {len(changed_files)} changed ReScript files')
-
-        file_node_dict = defaultdict(list)
+        with GitWrapper(local_repo_path) as gitclient:
+            old_commit = gitclient.resolve_commit(branch_or_commit)
+            new_commit = gitclient.resolve_commit(current_commit)
+
+            print('Getting changed files...')
+            changed_files = get_changed_files(old_commit, new_commit, local_repo_path)
+            print(f'Found {len(changed_files)} changed ReScript files')
+
+            old_blobs = gitclient.list_tree(old_commit, changed_files)
+            new_blobs = gitclient.list_tree(new_commit, changed_files)
+            # Only files present at both revisions are compared
+            common_files = [file for file in changed_files if file in old_blobs and file in new_blobs]
+            total_files = len(common_files)
+            if shard is not None:
+                sizes = dict(zip(common_files, gitclient.get_file_sizes((new_commit, file) for file in common_files)))
+                common_files = [file for _, file in shard.select([("modified", file) for file in common_files], lambda _, file: sizes[file] or 1)]
+                print(f'SHARD {shard} - {len(common_files)} of {total_files} files')
+
+            print('Reading modules from both commits...')
+            contents = gitclient.get_blobs(
+                [old_blobs[file] for file in common_files] + [new_blobs[file] for file in common_files]
+            )
 
-        file_paths = [os.path.join(local_repo_path, file) for file in changed_files]
+        print('Generating changes...')
 
-        print('Processing modules for previous commit...')
-        for changed_file in file_paths:
-            if os.path.exists(changed_file):
-                module_name = extract_module_name(changed_file)
-                ast = parser.parse(open(changed_file, "rb").read())
-                file_node_dict[module_name].append(ast)
-
-        print('Switching to current commit...')
-        old_cwd = os.getcwd()
-        os.chdir(local_repo_path)
-        subprocess.run(['git', 'checkout', '-f', current_commit], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        os.chdir(old_cwd)
-
-        print('Processing modules for current commit...')
-        for changed_file in file_paths:
-            if os.path.exists(changed_file):
+        with ChangesWriter(output_dir, output_format) as writer:
+            for index, changed_file in enumerate(common_files):
                 module_name = extract_module_name(changed_file)
-                ast = parser.parse(open(changed_file, "rb").read())
-                file_node_dict[module_name].append(ast)
+                old_ast = parser.parse(contents[index])
+                new_ast = parser.parse(contents[len(common_files) + index])
+                diff = RescriptFileDiff(module_name)
+                changes = diff.compare_two_files(old_ast, new_ast)
+                writer.write(changes.to_dict())
 
-        print('Generating changes...')
-
-        os.makedirs(output_dir, exist_ok=True)
-        all_changes = []
-        for module_name, asts_list in file_node_dict.items():
-            if len(asts_list) == 2:
-                old_node, new_node = asts_list
-                diff = RescriptFileDiff(old_node, new_node, module_name)
-                changes = diff.process_files()
-                all_changes.append(changes.to_dict())
-
-        final_output_path = os.path.join(output_dir, "detailed_changes.json")
-        with open(final_output_path, "w") as f:
-            json.dump(all_changes, f, indent = 3)
-        
-        print("Changes written to - ", final_output_path)
+        print("Changes written to - ", writer.output_path)
+        if shard is not None:
+            run = {"from_commit": old_commit, "to_commit": new_commit, "format": output_format}
+            print("Shard manifest written to - ", write_manifest(output_dir, shard.manifest(**run)))
 
     except Exception as e:
         print("ERROR - ", e)
         print(traceback.format_exc())
 
-def generate_pr_changes_bitbucket(bitbucket_object: BitBucket = None, gitclient_object: GitWrapper = None, pr_id: str = None, fromBranch: str = None, toBranch: str = None, output_dir="./", quiet=True):
+# (commit, path) pairs read per cat-file round while the deadline is being watched
+CONTENT_BATCH_SIZE = 256
+
+
+def check_deadline(deadline, stage: str):
+    """Raise TimeoutError once a time.monotonic() deadline has passed; None means no deadline"""
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError(f"request timed out during {stage}")
 
-    try:
-        RS_LANGUAGE = Language(tree_sitter_rescript.language())
-        parser = Parser(RS_LANGUAGE)
-        # if not isinstance(bitbucket_object, BitBucket):
-            # raise Exception("You should pass an valid bitbucket object")
-        
 
+def iter_pr_changes(bitbucket_object: BitBucket = None, gitclient_object: GitWrapper = None, pr_id: str = None, fromBranch: str = None, toBranch: str = None, fetch_workers: int = 8, parse_workers: int = 1, cache_dir: str = None, cache_max_bytes: int = None, incremental: bool = False, hunk_directed: bool = False, parse_pool=None, detect_renames: bool = False, edit_scripts: bool = False, patch_heads: bool = False, ignore_formatting: bool = False, shard: Shard = None, deadline: float = None, commits: dict = None):
+    """
+    Yield (mode, file_path, changes_dict) for every changed .res file of a PR or branch pair, in order.
+    Renamed files are diffed old path against new path and their record gets "renamedFrom".
+    With edit_scripts, modified declarations carry an edit script instead of both bodies. With
+    ignore_formatting, changes to layout and comments alone do not make a declaration modified.
+
+    Given both a Bitbucket client and a local mirror, Bitbucket only resolves the PR or branches
+    to commits; the changed files, hunks and contents are read from the mirror, which is fetched
+    only if it lacks one of the commits. A file the mirror cannot provide is fetched over REST,
+    and if the commits cannot be brought into the mirror everything goes through Bitbucket.
+
+    With patch_heads (Bitbucket only), the raw diff between the two commits is fetched in one
+    request and only old-side contents are fetched (through a ContentCache in cache_dir, if
+    given); modified, renamed and added files are rebuilt from it by applying their hunks. A
+    rebuilt file that does not match the blob id in the patch is fetched instead.
+
+    With shard, only that shard's slice of the changed files is diffed and read (see
+    shards.Shard). Files are weighed by blob size when a local repository is used; Bitbucket
+    alone cannot tell sizes without downloading every file, so there each file weighs the same.
+
+    With deadline (a time.monotonic() value), TimeoutError is raised as soon as it is noticed to
+    have passed: between stages, while contents are read and before each file is fetched.
+
+    Given a `commits` dict, it is filled with the resolved "from_commit" (the target side) and
+    "to_commit" (the head) as soon as they are known, so callers can record what was diffed.
+    """
+    with metrics.span("resolve_commits"):
         if bitbucket_object:
             if pr_id:
                 pull_request = bitbucket_object.get_pr_bitbucket(pr_id)
                 latest_commit, old_commit = pull_request["fromRef"]["latestCommit"], pull_request["toRef"]["latestCommit"]
+                branches = [pull_request["fromRef"]["displayId"], pull_request["toRef"]["displayId"]]
             else: 
                 latest_commit = bitbucket_object.get_latest_commit_from_branch(fromBranch)
                 old_commit = bitbucket_object.get_latest_commit_from_branch(toBranch)
+                branches = [fromBranch, toBranch]
         else: 
-            latest_commit = gitclient_object.get_latest_commit_from_branch(fromBranch)
-            old_commit = gitclient_object.get_common_ancestor(fromBranch,toBranch)
-
-        print("LATEST COMMIT -", latest_commit)
-        print("OLDEST COMMIT -", old_commit)
-
-        changed_files = bitbucket_object.get_changed_files_from_commits(latest_commit, old_commit) if bitbucket_object else gitclient_object.get_changed_files_from_commits(latest_commit, old_commit)
-
-        all_changes = []
-        for changed_file in changed_files["modified"]:
-            if changed_file[-4:] != ".res":
-                continue
-            if bitbucket_object:
-                old_file = bitbucket_object.get_file_content_from_bitbucket(changed_file, old_commit)
-                new_file = bitbucket_object.get_file_content_from_bitbucket(changed_file, latest_commit)
-            else: 
-                old_file = gitclient_object.get_file_content(changed_file, old_commit)
-                new_file = gitclient_object.get_file_content(changed_file, latest_commit)
-
-            old_ast = parser.parse(old_file.encode())
-            new_ast = parser.parse(new_file.encode())
-            diff = RescriptFileDiff(changed_file)
-            changes = diff.compare_two_files(old_ast, new_ast)
-            all_changes.append(changes.to_dict())
-            if not quiet:
-                print("PROCESSED MODIFIED FILE -", changed_file)
-        
-        for added_file in changed_files["added"]:
-            if added_file[-4:] != ".res":
-                continue
-
-            if bitbucket_object:
-                file_content = bitbucket_object.get_file_content_from_bitbucket(added_file, latest_commit)
-            else:
-                file_content = gitclient_object.get_file_content(added_file, latest_commit)
-
-            file_ast = parser.parse(file_content.encode())
-            diff = RescriptFileDiff(added_file)
-            changes = diff.process_single_file(file_ast, mode="added")
-            all_changes.append(changes.to_dict())
-            if not quiet:
-                print("PROCESSED ADDED FILE -", added_file)
-
-        for deleted_file in changed_files["deleted"]:
-            if deleted_file[-4:] != ".res":
-                continue
-            if bitbucket_object:
-                file_content = bitbucket_object.get_file_content_from_bitbucket(deleted_file, old_commit)
-            else:
-                file_content = gitclient_object.get_file_content(deleted_file, old_commit)
-            file_ast = parser.parse(file_content.encode())
-            diff = RescriptFileDiff(deleted_file)
-            changes = diff.process_single_file(file_ast, mode="deleted")
-            all_changes.append(changes.to_dict())
-            if not quiet:
-                print("PROCESSED DELETED FILE -", deleted_file)
-
-        final_output_path = os.path.join(output_dir, "detailed_changes.json")
-        with open(final_output_path, "w") as f:
-            json.dump(all_changes, f, indent = 3)
+            # One fetch brings both branches up to date
+            gitclient_object.fetch([fromBranch, toBranch])
+            latest_commit = gitclient_object.get_latest_commit_from_branch(fromBranch, fetch=False)
+            old_commit = gitclient_object.get_common_ancestor(fromBranch, toBranch, fetch=False)
+
+    print("LATEST COMMIT -", latest_commit)
+    print("OLDEST COMMIT -", old_commit)
+    if commits is not None:
+        commits.update(from_commit=old_commit, to_commit=latest_commit)
+    check_deadline(deadline, "commit resolution")
+
+    local = gitclient_object is not None
+    # Bitbucket compares a PR's head against its merge-base with the target; the mirror does the same
+    compare_base = old_commit
+    if local and bitbucket_object:
+        with metrics.span("mirror_sync"):
+            local = gitclient_object.ensure_commits([latest_commit, old_commit], branches)
+        if local:
+            compare_base = gitclient_object.merge_base(latest_commit, old_commit)
+        else:
+            print("Commits are not available in the local mirror, reading everything from Bitbucket")
+        check_deadline(deadline, "mirror sync")
+
+    with metrics.span("changed_files"):
+        changed_files = gitclient_object.get_changed_files_from_commits(latest_commit, compare_base) if local else bitbucket_object.get_changed_files_from_commits(latest_commit, old_commit)
+    check_deadline(deadline, "changed files")
+
+    # A rename into or out of .res is just an addition or a deletion as far as ReScript is concerned
+    renamed_from = {}
+    for old_path, new_path in changed_files["renamed"]:
+        if old_path.endswith(".res") and new_path.endswith(".res"):
+            renamed_from[new_path] = old_path
+        elif new_path.endswith(".res"):
+            changed_files["added"].append(new_path)
+        elif old_path.endswith(".res"):
+            changed_files["deleted"].append(old_path)
+
+    tasks = [("modified", changed_file) for changed_file in changed_files["modified"] if changed_file[-4:] == ".res"]
+    tasks += [("renamed", new_path) for new_path in renamed_from]
+    tasks += [
+        (mode, changed_file)
+        for mode in ("added", "deleted")
+        for changed_file in changed_files[mode]
+        if changed_file[-4:] == ".res"
+    ]
+    if shard is not None:
+        # Weighed by the size of the file's surviving side, looked up without reading any contents
+        def weighed_side(mode, file_path):
+            return (old_commit if mode == "deleted" else latest_commit, file_path)
+
+        sizes = {}
+        if local:
+            sides = [weighed_side(mode, file_path) for mode, file_path in tasks]
+            with metrics.span("sizes"):
+                sizes = dict(zip(sides, gitclient_object.get_file_sizes(sides)))
+        tasks = shard.select(tasks, lambda mode, file_path: sizes.get(weighed_side(mode, file_path)) or 1)
+        print(f"SHARD {shard} - {len(tasks)} of {len(shard.tasks)} files")
+
+    file_contents = {}
+    if local:
+        # Stream every blob we need through one cat-file process instead of a `git show` per file
+        wanted = [(old_commit, renamed_from.get(file_path, file_path)) for mode, file_path in tasks if mode != "added"]
+        wanted += [(latest_commit, file_path) for mode, file_path in tasks if mode != "deleted"]
+        with metrics.span("prefetch"):
+            # One download for a partial clone, then reads in rounds so a deadline can interrupt them
+            gitclient_object.prefetch_paths(wanted)
+            for start in range(0, len(wanted), CONTENT_BATCH_SIZE):
+                check_deadline(deadline, "prefetch")
+                batch = wanted[start:start + CONTENT_BATCH_SIZE]
+                file_contents.update(zip(batch, gitclient_object.get_file_contents(batch)))
+
+    patches = None
+    content_cache = None
+    if patch_heads and not local:
+        with metrics.span("patch"):
+            raw_diff = bitbucket_object.get_raw_diff(latest_commit, old_commit)
+        if raw_diff is not None:
+            patches = parse_patch(raw_diff)
+            content_cache = open_cache(cache_dir, cache_max_bytes, cache_class=ContentCache)
+
+    def get_content(file_path, commit):
+        if local:
+            content = file_contents[(commit, file_path)]
+            if content is not None or not bitbucket_object:
+                return content
+            # The mirror lacks this one file; ask Bitbucket for it alone
+            metrics.count("mirror.rest_fallbacks")
+        if content_cache is not None:
+            content = content_cache.get(commit, file_path)
+            if content is not None:
+                return content
+        content = bitbucket_object.get_file_bytes_from_bitbucket(file_path, commit)
+        if content_cache is not None and content is not None:
+            content_cache.put(commit, file_path, content)
+        return content
+
+    def rebuild_head(file_path, old_content):
+        patch = patches.get(file_path)
+        if patch is None or old_content is None:
+            return None
+        try:
+            content = apply_patch(old_content, patch)
+        except PatchError as e:
+            print("PATCH MISMATCH -", e)
+            metrics.count("patch.fallbacks")
+            return None
+        metrics.count("patch.rebuilt")
+        return content
+
+    def fetch(mode, file_path):
+        check_deadline(deadline, "fetch")
+        old_content = get_content(renamed_from.get(file_path, file_path), old_commit) if mode != "added" else None
+        new_content = None
+        if patches is not None and mode != "deleted":
+            new_content = rebuild_head(file_path, old_content if mode != "added" else b"")
+        if new_content is None and mode != "deleted":
+            new_content = get_content(file_path, latest_commit)
+        return old_content, new_content
+
+    # Incremental mode reparses each modified file from its old tree using the diff hunks;
+    # hunk-directed mode only compares declarations that a hunk touches
+    hunks = None
+    if (incremental or hunk_directed) and patches is not None:
+        # The patch already describes exactly how each old side turns into its new side
+        hunks = {
+            file_path: [hunk_from_unified(hunk.source_start, hunk.source_length, hunk.target_start, hunk.target_length) for hunk in patch]
+            for file_path, patch in patches.items()
+        }
+    elif incremental or hunk_directed:
+        with metrics.span("hunks"):
+            hunks = gitclient_object.get_file_hunks(latest_commit, compare_base) if local else bitbucket_object.get_file_hunks(latest_commit, old_commit)
+        check_deadline(deadline, "hunks")
+
+    pipeline = DiffPipeline(fetch, fetch_workers=fetch_workers, parse_workers=parse_workers, cache_dir=cache_dir, cache_max_bytes=cache_max_bytes, hunks=hunks, hunk_mode="incremental" if incremental else "directed", parse_pool=parse_pool, detect_renames=detect_renames, edit_scripts=edit_scripts, ignore_formatting=ignore_formatting)
+    for mode, changed_file, changes in pipeline.run(tasks):
+        if mode == "renamed":
+            changes["renamedFrom"] = renamed_from[changed_file]
+        yield mode, changed_file, changes
+
+def generate_pr_changes_bitbucket(bitbucket_object: BitBucket = None, gitclient_object: GitWrapper = None, pr_id: str = None, fromBranch: str = None, toBranch: str = None, output_dir="./", quiet=True, fetch_workers: int = 8, parse_workers: int = 1, cache_dir: str = None, cache_max_bytes: int = None, incremental: bool = False, hunk_directed: bool = False, output_format: str = "json", collect_metrics: bool = False, prometheus: str = None, detect_renames: bool = False, rename_threshold: float = 0.8, edit_scripts: bool = False, patch_heads: bool = False, ignore_formatting: bool = False, shard: Shard = None):
+
+    # Stage timings and counters go to metrics.json next to the changes, and to the `prometheus` path if given
+    collect_metrics = collect_metrics or bool(prometheus)
+    if collect_metrics:
+        metrics.enable()
+    try:
+        # if not isinstance(bitbucket_object, BitBucket):
+            # raise Exception("You should pass an valid bitbucket object")
         
-        print("Changes written to - ", final_output_path)
+
+        commits = {}
+        changes_iter = iter_pr_changes(bitbucket_object, gitclient_object, pr_id, fromBranch, toBranch, fetch_workers=fetch_workers, parse_workers=parse_workers, cache_dir=cache_dir, cache_max_bytes=cache_max_bytes, incremental=incremental, hunk_directed=hunk_directed, detect_renames=detect_renames, edit_scripts=edit_scripts, patch_heads=patch_heads, ignore_formatting=ignore_formatting, shard=shard, commits=commits)
+        # Added and deleted declarations are paired up across all modules once every file is done;
+        # a shard only sees some modules, so it keeps the sketches for merge_shards instead
+        matcher = DeclarationMatcher(threshold=rename_threshold) if detect_renames and shard is None else None
+        shard_sketches = []
+        # Each module's record goes to disk as soon as it is ready instead of accumulating in memory
+        with ChangesWriter(output_dir, output_format) as writer:
+            for mode, changed_file, changes in changes_iter:
+                if matcher is not None:
+                    matcher.add(changes.pop("sketches"))
+                elif detect_renames:
+                    shard_sketches.append(changes.pop("sketches"))
+                writer.write(changes)
+                if not quiet:
+                    print(f"PROCESSED {mode.upper()} FILE -", changed_file)
+
+        print("Changes written to - ", writer.output_path)
+        if shard is not None:
+            # Branch names alone would let shards computed after the PR or target branch moved merge together
+            run = {"pr_id": pr_id, "from_branch": fromBranch, "to_branch": toBranch, **commits, "format": output_format}
+            if detect_renames:
+                run.update(rename_threshold=rename_threshold, sketches=shard_sketches)
+            print("Shard manifest written to - ", write_manifest(output_dir, shard.manifest(**run)))
+        if matcher is not None:
+            with metrics.span("match_renames"), ChangesWriter(output_dir, "json", file_name="declaration_moves.json") as moves_writer:
+                for record in matcher.match():
+                    moves_writer.write(record)
+            print("Moves and renames written to - ", moves_writer.output_path)
+        if collect_metrics:
+            print("Metrics written to - ", metrics.write_report(output_dir, prometheus=prometheus))
 
     except Exception as e:
         print("ERROR - ", e)
         print(traceback.format_exc())
+    finally:
+        if collect_metrics:
+            metrics.disable()
 
 BASE_URL = "https://bitbucket.juspay.net/rest"
 PROJECT_KEY = "JBIZ"
@@ -2,13 +2,87 @@ import subprocess
 import json
 import re
 from collections import defaultdict
-from tree_sitter import Language, Parser, Node
-import tree_sitter_rescript
+from tree_sitter import Language, Parser, Node, Query
+try:
+    from tree_sitter import QueryCursor
+except ImportError:  # py-tree-sitter < 0.25 runs captures on the Query itself
+    QueryCursor = None
 import hashlib
 import os
+from bisect import bisect_right
+from typing import Iterable, Optional, Tuple
+
+from rescript_ast_diff import metrics
+from rescript_ast_diff.hunks import byte_edits
+
+
+class Declaration:
+    """
+    One extracted declaration. The body is kept as a byte range into the file's shared source
+    buffer and only decoded when a change is serialised, so unchanged declarations never allocate
+    a string. Records restored from the cache have no tree or buffer and carry their body instead.
+
+    The fingerprint is computed on first use by `hasher` unless one was given up front (by the
+    cache, or as a placeholder in hunk-directed mode), so a declaration whose bytes match its
+    counterpart's is never hashed at all.
+    """
+    __slots__ = ("name", "node", "source", "base", "start_byte", "end_byte", "start_point", "end_point", "_fingerprint", "_hasher", "_body")
+
+    def __init__(self, name, node, source, base, start_byte, end_byte, start_point, end_point, fingerprint, body=None, hasher=None):
+        self.name = name
+        self.node = node
+        self.source = source
+        self.base = base
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.start_point = start_point
+        self.end_point = end_point
+        self._fingerprint = fingerprint
+        self._hasher = hasher
+        self._body = body
+
+    @classmethod
+    def from_node(cls, name, node: Node, source: bytes, base: int, fingerprint, hasher=None):
+        return cls(name, node, source, base, node.start_byte, node.end_byte, node.start_point, node.end_point, fingerprint, hasher=hasher)
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = self._hasher()
+            self._hasher = None
+        return self._fingerprint
+
+    @property
+    def known_fingerprint(self):
+        """The fingerprint if it is already known, without computing it"""
+        return self._fingerprint
+
+    @property
+    def raw(self) -> bytes:
+        if self._body is not None:
+            return self._body.encode()
+        return self.source[self.start_byte - self.base:self.end_byte - self.base]
+
+    @property
+    def body(self) -> str:
+        if self._body is not None:
+            return self._body
+        return self.source[self.start_byte - self.base:self.end_byte - self.base].decode(errors="ignore")
+
+    def to_entry(self):
+        return (self.name, self.body, {"start": self.start_point, "end": self.end_point})
+
+
+def modified_entry(old: Declaration, new: Declaration):
+    return (old.name, old.body, new.body, {"old_start": old.start_point, "old_end": old.end_point, "new_start": new.start_point, "new_end": new.end_point})
 
 
 class DetailedChanges:
+    """
+    Per-module result. added*/deleted* hold Declarations and modified* hold (old, new) Declaration
+    pairs; bodies are only decoded by to_dict().
+    """
+
     def __init__(self, module_name):
         self.moduleName = module_name
         self.addedFunctions = []
@@ -27,45 +101,217 @@ class DetailedChanges:
         self.modifiedImports = []
         self.deletedImports = []
 
-    def to_dict(self):
+    def to_dict(self, modified=modified_entry):
+        """modified(old, new) builds each modified* entry; edits.edit_entry swaps the bodies for an edit script"""
         return {
             "moduleName": self.moduleName,
-            "addedFunctions": self.addedFunctions,
-            "modifiedFunctions": self.modifiedFunctions,
-            "deletedFunctions": self.deletedFunctions,
-            "addedTypes": self.addedTypes,
-            "modifiedTypes": self.modifiedTypes,
-            "deletedTypes": self.deletedTypes,
-            "addedExternals": self.addedExternals,
-            "modifiedExternals": self.modifiedExternals,
-            "deletedExternals": self.deletedExternals,
+            "addedFunctions": [d.to_entry() for d in self.addedFunctions],
+            "modifiedFunctions": [modified(old, new) for old, new in self.modifiedFunctions],
+            "deletedFunctions": [d.to_entry() for d in self.deletedFunctions],
+            "addedTypes": [d.to_entry() for d in self.addedTypes],
+            "modifiedTypes": [modified(old, new) for old, new in self.modifiedTypes],
+            "deletedTypes": [d.to_entry() for d in self.deletedTypes],
+            "addedExternals": [d.to_entry() for d in self.addedExternals],
+            "modifiedExternals": [modified(old, new) for old, new in self.modifiedExternals],
+            "deletedExternals": [d.to_entry() for d in self.deletedExternals],
         }
 
     def __str__(self):
+        changes = self.to_dict()
         return (
             f"Module: {self.moduleName}\n"
-            f"Added Functions: {self.addedFunctions}\n"
-            f"Modified Functions: {self.modifiedFunctions}\n"
-            f"Deleted Functions: {self.deletedFunctions}\n"
-            f"Added Types: {self.addedTypes}\n"
-            f"Modified Types: {self.modifiedTypes}\n"
-            f"Deleted Types: {self.deletedTypes}\n"
-            f"Added Externals: {self.addedExternals}\n"
-            f"Modified Externals: {self.modifiedExternals}\n"
-            f"Deleted Externals: {self.deletedExternals}"
+            f"Added Functions: {changes['addedFunctions']}\n"
+            f"Modified Functions: {changes['modifiedFunctions']}\n"
+            f"Deleted Functions: {changes['deletedFunctions']}\n"
+            f"Added Types: {changes['addedTypes']}\n"
+            f"Modified Types: {changes['modifiedTypes']}\n"
+            f"Deleted Types: {changes['deletedTypes']}\n"
+            f"Added Externals: {changes['addedExternals']}\n"
+            f"Modified Externals: {changes['modifiedExternals']}\n"
+            f"Deleted Externals: {changes['deletedExternals']}"
         )
 
 
 def format_rescript_file(file_pth):
+    # Spawns Node for every file; RescriptFileDiff(ignore_formatting=True) makes this unnecessary
     try:
         subprocess.run(["npx", "rescript", "format", file_pth], capture_output=True)
     except:
         pass
 
 
+def structural_hash(node: Node, source: bytes, base: int = 0, subtree_hashes: Optional[dict] = None) -> bytes:
+    """
+    Merkle hash of a subtree, computed bottom-up in a single pass without recursion.
+
+    Each node's digest covers its type, its children's digests and the source bytes between them
+    (leaves hash their own text), so two subtrees hash equal exactly when they have the same shape,
+    node types and text. `source` is the file content starting at byte offset `base`. If
+    `subtree_hashes` is given it is filled with node.id -> digest for every node in the subtree.
+    """
+    digests = []
+    stack = [(node, None)]
+    visited = 0
+    while stack:
+        current, children = stack.pop()
+        if children is None:
+            visited += 1
+            children = current.children
+            if children:
+                stack.append((current, children))
+                stack.extend((child, None) for child in reversed(children))
+                continue
+            digest = hashlib.blake2b(
+                current.type.encode() + b"\0" + source[current.start_byte - base:current.end_byte - base],
+                digest_size=16,
+            ).digest()
+        else:
+            hasher = hashlib.blake2b(current.type.encode() + b"\0", digest_size=16)
+            child_digests = digests[-len(children):]
+            del digests[-len(children):]
+            position = current.start_byte
+            for child, child_digest in zip(children, child_digests):
+                gap = source[position - base:child.start_byte - base]
+                hasher.update(b"%d:" % len(gap) + gap + child_digest)
+                position = child.end_byte
+            hasher.update(source[position - base:current.end_byte - base])
+            digest = hasher.digest()
+        if subtree_hashes is not None:
+            subtree_hashes[current.id] = digest
+        digests.append(digest)
+    metrics.count("nodes.hashed", visited)
+    return digests[0]
+
+
+# Nodes a formatter or a comment edit can add, drop or move without changing meaning
+TRIVIA_TYPES = frozenset({"comment"})
+OPTIONAL_TOKENS = frozenset({",", ";"})
+# Wrappers that may be added or removed around a single expression
+TRANSPARENT_TYPES = frozenset({"parenthesized_expression"})
+
+
+def significant_children(node: Node) -> list:
+    return [
+        child for child in node.children
+        if child.type not in TRIVIA_TYPES and (child.is_named or child.type not in OPTIONAL_TOKENS)
+    ]
+
+
+def unwrap(node: Node) -> Node:
+    """The expression inside any redundant parentheses around node"""
+    while node.type in TRANSPARENT_TYPES:
+        named = [child for child in significant_children(node) if child.is_named]
+        if len(named) != 1:
+            break
+        node = named[0]
+    return node
+
+
+def normalized_hash(node: Node, source: bytes, base: int = 0) -> bytes:
+    """
+    structural_hash that is blind to formatting: the bytes between tokens, comments, optional
+    separators and redundant parentheses do not contribute, so a declaration hashes the same
+    before and after `rescript format` or a comment edit. Token text still counts in full.
+    """
+    digests = []
+    stack = [(unwrap(node), None)]
+    visited = 0
+    while stack:
+        current, children = stack.pop()
+        if children is None:
+            visited += 1
+            children = significant_children(current)
+            if children:
+                children = [unwrap(child) for child in children]
+                stack.append((current, children))
+                stack.extend((child, None) for child in reversed(children))
+                continue
+            text = source[current.start_byte - base:current.end_byte - base] if not current.children else b""
+            digest = hashlib.blake2b(current.type.encode() + b"\0" + text, digest_size=16).digest()
+        else:
+            hasher = hashlib.blake2b(current.type.encode() + b"\0", digest_size=16)
+            for child_digest in digests[-len(children):]:
+                hasher.update(child_digest)
+            del digests[-len(children):]
+            digest = hasher.digest()
+        digests.append(digest)
+    metrics.count("nodes.hashed", visited)
+    return digests[0]
+
+
+DECLARATION_QUERY = """
+[(let_declaration) (type_declaration) (external_declaration)] @declaration
+(let_declaration (let_binding (value_identifier) @let.name))
+(type_declaration (type_binding (type_identifier) @type.name))
+(external_declaration (value_identifier) @external.name)
+"""
+
+_language = None
+_declaration_query = None
+
+
+def rescript_language() -> Language:
+    """
+    The ReScript grammar, loaded once per process. It is imported here rather than at module level
+    so that the parts of the package that never parse (merging shards, the Bitbucket client, hunk
+    arithmetic) work without it.
+    """
+    global _language
+    if _language is None:
+        import tree_sitter_rescript
+        _language = Language(tree_sitter_rescript.language())
+    return _language
+
+
+def declaration_query():
+    """The compiled DECLARATION_QUERY, built once per process"""
+    global _declaration_query
+    if _declaration_query is None:
+        _declaration_query = Query(rescript_language(), DECLARATION_QUERY)
+    return _declaration_query
+
+
+def run_query(query, node: Node) -> dict:
+    """Captures of a query as {capture name: [nodes]} across py-tree-sitter API versions"""
+    if QueryCursor is not None:
+        return QueryCursor(query).captures(node)
+    captures = query.captures(node)
+    if isinstance(captures, dict):
+        return captures
+    grouped = {}
+    for captured_node, capture_name in captures:
+        grouped.setdefault(capture_name, []).append(captured_node)
+    return grouped
+
+
+class LineRangeIndex:
+    """Inclusive line ranges, merged and sorted so overlap queries are a single bisection"""
+
+    def __init__(self, ranges: Iterable[Tuple[int, int]]):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(ranges):
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def overlaps(self, first_line: int, last_line: int) -> bool:
+        position = bisect_right(self.starts, last_line) - 1
+        return position >= 0 and self.ends[position] >= first_line
+
+
 class RescriptFileDiff:
-    def __init__(self, module_name=""):
+    def __init__(self, module_name="", verify=False, use_query=True, ignore_formatting=False):
         self.changes = DetailedChanges(module_name)
+        # Declarations are compared by structural hash; verify re-checks equal hashes with deep_equal
+        self.verify = verify
+        # Declarations are found with a tree-sitter query; use_query=False falls back to walk_declarations
+        self.use_query = use_query
+        # Compare by normalized_hash, so reformatting or editing comments is not a modification
+        self.ignore_formatting = ignore_formatting
+        self.hash_node = normalized_hash if ignore_formatting else structural_hash
 
     def get_decl_name(self, node: Node, node_type: str, name_type: str) -> str:
         for child in node.children:
@@ -78,59 +324,153 @@ class RescriptFileDiff:
         return None
 
     def deep_equal(self, nodeA: Node, nodeB: Node):
-        if (nodeA is None) != (nodeB is None):
-            return False
+        """
+        Exact structural comparison; only used to double-check equal structural hashes when verify
+        is set. With ignore_formatting it skips the same trivia normalized_hash does.
+        """
+        stack = [(nodeA, nodeB)]
+        visited = 0
+        while stack:
+            nodeA, nodeB = stack.pop()
+            visited += 1
+            if (nodeA is None) != (nodeB is None):
+                return False
 
-        if nodeA is None and nodeB is None:
-            return True
+            if nodeA is None and nodeB is None:
+                continue
 
-        if nodeA.type != nodeB.type:
-            return False
+            if self.ignore_formatting:
+                nodeA, nodeB = unwrap(nodeA), unwrap(nodeB)
 
-        childrenA = nodeA.children
-        childrenB = nodeB.children
+            if nodeA.type != nodeB.type:
+                return False
 
-        if len(childrenA) != len(childrenB):
-            return False
+            if self.ignore_formatting:
+                childrenA = [unwrap(child) for child in significant_children(nodeA)]
+                childrenB = [unwrap(child) for child in significant_children(nodeB)]
+            else:
+                childrenA = nodeA.children
+                childrenB = nodeB.children
+
+            if len(childrenA) != len(childrenB):
+                return False
 
-        if len(childrenA) == 0:
-            return nodeA.text == nodeB.text and nodeA.parent.text == nodeB.parent.text
+            if len(childrenA) == 0:
+                if nodeA.text != nodeB.text and not (self.ignore_formatting and nodeA.children and nodeB.children):
+                    return False
+                continue
 
-        for childA, childB in zip(childrenA, childrenB):
-            if not self.deep_equal(childA, childB):
+            # Leaves are compared along with their parent's text; check it once per parent, not once per leaf
+            if not self.ignore_formatting and any(child.child_count == 0 for child in childrenA) and nodeA.text != nodeB.text:
                 return False
 
+            stack.extend(zip(childrenA, childrenB))
+
+        metrics.count("nodes.compared", visited)
         return True
 
-    def extract_components(self, root: Node):
+    def walk_declarations(self, root: Node):
+        """
+        Reference extraction: a Python-level walk over named nodes that stops at declarations.
+        Yields (node, name) in document order; kept for use_query=False and for cross-checking.
+        """
+        name_getters = {
+            "let_declaration": lambda x: self.get_decl_name(x, "let_binding", "value_identifier"),
+            "type_declaration": lambda x: self.get_decl_name(x, "type_binding", "type_identifier"),
+            "external_declaration": lambda x: self.get_decl_name(x, None, "value_identifier"),
+        }
         queue = [root]
+        while queue:
+            current_node = queue.pop()
+            if current_node.type in name_getters:
+                name = name_getters[current_node.type](current_node)
+                if name:
+                    yield current_node, name
+            else:
+                for child in reversed(current_node.children):
+                    if child.is_named:
+                        queue.append(child)
+
+    def query_declarations(self, root: Node):
+        """
+        Same (node, name) pairs as walk_declarations, with the tree traversal done by one
+        precompiled tree-sitter query in C instead of visiting every named node from Python.
+        Only finding declarations and their names moves into C: qualified_name still runs in
+        Python afterwards, one parent hop per declaration rather than a walk over the tree.
+        """
+        source, base = root.text, root.start_byte
+        captures = run_query(declaration_query(), root)
+
+        # A declaration's name is its first matching identifier in document order
+        names = {}
+        for capture_name, decl_depth in (("let.name", 2), ("type.name", 2), ("external.name", 1)):
+            for name_node in captures.get(capture_name, ()):
+                decl = name_node.parent.parent if decl_depth == 2 else name_node.parent
+                if decl.id not in names or name_node.start_byte < names[decl.id].start_byte:
+                    names[decl.id] = name_node
+
+        # Declarations nested inside another declaration are not collected (the walk stops there)
+        outer_end = -1
+        for decl in sorted(captures.get("declaration", ()), key=lambda node: node.start_byte):
+            if decl.start_byte < outer_end:
+                continue
+            outer_end = decl.end_byte
+            name_node = names.get(decl.id)
+            if name_node is not None:
+                name = source[name_node.start_byte - base:name_node.end_byte - base].decode(errors="ignore")
+                if name:
+                    yield decl, name
+
+    def declarations(self, root: Node):
+        return self.query_declarations(root) if self.use_query else self.walk_declarations(root)
+
+    def qualified_name(self, node: Node, name: str) -> str:
+        """
+        Declarations inside a nested module are named Module::name, after the first child of the
+        binding around the module body. That is whatever the body hangs off (a functor's parameter
+        list as well as a module name), which a query capture would not reproduce exactly, so this
+        stays in Python for both walk_declarations and query_declarations.
+        """
+        if node.parent.type != "source_file":
+            try:
+                return f"{node.parent.parent.child(0).text.decode()}::{name}"
+            except:
+                pass
+        return name
+
+    def extract_components(self, root: Node, fingerprint_for=None):
+        """
+        Collect top-level and module-nested declarations. Fingerprints are computed lazily, see
+        Declaration. fingerprint_for(node), if given, may return an already known fingerprint for a
+        declaration, or a Declaration with the same bytes whose (lazy) fingerprint it then shares.
+        """
+        with metrics.span("extract"):
+            return self._extract_components(root, fingerprint_for)
+
+    def _extract_components(self, root: Node, fingerprint_for=None):
+        # The file's bytes are materialised once and sliced for every structural hash
+        source, base = root.text, root.start_byte
         
         functions = {}
         types = {}
         externals = {}
 
-        node_name_mapper = {
-            "let_declaration": (functions, lambda x: self.get_decl_name(x, "let_binding", "value_identifier")),
-            "type_declaration": (types, lambda x: self.get_decl_name(x, "type_binding", "type_identifier")),
-            "external_declaration": (externals, lambda x: self.get_decl_name(x, None, "value_identifier"))
+        kind_maps = {
+            "let_declaration": functions,
+            "type_declaration": types,
+            "external_declaration": externals,
         }
 
-        while queue:
-            current_node = queue.pop()
-            if current_node.type in node_name_mapper.keys():
-                dct, mapper_function = node_name_mapper[current_node.type]
-                name = mapper_function(current_node)
-                if name:
-                    if current_node.parent.type != "source_file":
-                        try:
-                            name = f"{current_node.parent.parent.child(0).text.decode()}::{name}"
-                        except:
-                            pass
-                    dct[name] = (current_node, current_node.text.decode(errors="ignore"), current_node.start_point, current_node.end_point)
+        for current_node, name in self.declarations(root):
+            name = self.qualified_name(current_node, name)
+            fingerprint = fingerprint_for(current_node) if fingerprint_for else None
+            if isinstance(fingerprint, Declaration):
+                hasher = lambda same=fingerprint: same.fingerprint
+                fingerprint = fingerprint.known_fingerprint
             else:
-                for child in reversed(current_node.children):
-                    if child.is_named:
-                        queue.append(child)
+                hasher = lambda node=current_node: self.hash_node(node, source, base).hex()
+            kind_maps[current_node.type][name] = Declaration.from_node(name, current_node, source, base, fingerprint, hasher)
+        metrics.count("declarations.extracted", len(functions) + len(types) + len(externals))
         return functions, types, externals
 
     def diff_components(self, before_map: dict, after_map: dict) -> dict:
@@ -141,21 +481,91 @@ class RescriptFileDiff:
         deleted_names = before_names - after_names
         common = before_names & after_names
 
-        added = [(n, after_map[n][1], {"start": after_map[n][2], "end": after_map[n][3]}) for n in sorted(added_names)]
-        deleted = [(n, before_map[n][1], {"start": before_map[n][2], "end": before_map[n][3]}) for n in sorted(deleted_names)]
+        added = [after_map[n] for n in sorted(added_names)]
+        deleted = [before_map[n] for n in sorted(deleted_names)]
 
+        metrics.count("declarations.compared", len(common))
         modified = []
         for name in sorted(common):
-            old_ast, old_body, old_start, old_end = before_map[name]
-            new_ast, new_body, new_start, new_end = after_map[name]
-            if not self.deep_equal(old_ast, new_ast):
-                modified.append((name, old_body, new_body, {"old_start": old_start, "old_end": old_end, "new_start": new_start, "new_end": new_end}))
+            old, new = before_map[name], after_map[name]
+            old_known, new_known = old.known_fingerprint, new.known_fingerprint
+            if old_known is not None and old_known == new_known:
+                is_equal = True
+            elif isinstance(old_known, str) and isinstance(new_known, str):
+                # Both already hashed (say, restored from the cache) and different
+                is_equal = False
+            else:
+                # Most common names are unchanged, and equal bytes settle that without hashing either
+                # tree; only declarations whose text differs are hashed
+                is_equal = old.raw == new.raw or self.real_fingerprint(old) == self.real_fingerprint(new)
+            # Components restored from the cache carry no tree, only their fingerprint
+            if is_equal and self.verify and old.node is not None and new.node is not None:
+                is_equal = old.raw == new.raw or self.deep_equal(old.node, new.node)
+            if not is_equal:
+                modified.append((old, new))
 
         return {"added": added, "deleted": deleted, "modified": modified}
 
-    def compare_two_files(self, old_file_ast, new_file_ast) -> DetailedChanges:
-        old_funcs, old_types, old_ext = self.extract_components(old_file_ast.root_node)
-        new_funcs, new_types, new_ext = self.extract_components(new_file_ast.root_node)
+    def real_fingerprint(self, decl: Declaration) -> str:
+        # Hunk-directed placeholders only compare equal to each other; anything else needs the hash
+        return self.node_fingerprint(decl.node) if isinstance(decl.known_fingerprint, tuple) else decl.fingerprint
+
+    def node_fingerprint(self, node: Node) -> str:
+        return self.hash_node(node, node.text, node.start_byte).hex()
+
+    def compare_two_files(self, old_file_ast, new_file_ast, hunks=None, old_content: Optional[bytes] = None, new_content: Optional[bytes] = None) -> DetailedChanges:
+        """
+        Diff two parsed revisions. With hunks (0-based (old_start, old_count, new_start, new_count)
+        line ranges from the textual diff) and the contents both trees were parsed from, only
+        declarations overlapping a hunk are hashed and compared structurally; the result is the
+        same as without them. Hunks that do not describe exactly these contents (say, computed
+        against a merge-base while the old side is the target branch tip) are ignored.
+        """
+        old_root, new_root = old_file_ast.root_node, new_file_ast.root_node
+        # Error recovery can reshape text outside the hunks, so only trust them on clean parses
+        if hunks is None or old_root.has_error or new_root.has_error:
+            return self.compare_components(self.extract_components(old_root), self.extract_components(new_root))
+
+        hunks = sorted(hunks)
+        # Everything outside the hunks is assumed identical on both sides, so check that it is
+        if old_content is None or new_content is None or byte_edits(old_content, new_content, hunks) is None:
+            metrics.count("hunks.mismatched")
+            return self.compare_components(self.extract_components(old_root), self.extract_components(new_root))
+
+        # Padded by a line either side so edits adjoining a declaration count as touching it
+        old_index = LineRangeIndex((start - 1, start + count) for start, count, _, _ in hunks)
+        new_index = LineRangeIndex((start - 1, start + count) for _, _, start, count in hunks)
+        new_hunk_ends = [new_start + new_count for _, _, new_start, new_count in hunks]
+        line_shifts = [0]
+        for _, old_count, _, new_count in hunks:
+            line_shifts.append(line_shifts[-1] + new_count - old_count)
+
+        def untouched_marker(index, to_old_line):
+            # Untouched declarations get their position in the old file as a placeholder fingerprint:
+            # equal placeholders mean the same unchanged text on both sides
+            def fingerprint_for(node):
+                first_line, column = node.start_point
+                if index.overlaps(first_line, node.end_point[0]):
+                    return None
+                return ("untouched", node.type, to_old_line(first_line), column)
+            return fingerprint_for
+
+        def new_to_old_line(line):
+            return line - line_shifts[bisect_right(new_hunk_ends, line)]
+
+        return self.compare_components(
+            self.extract_components(old_root, fingerprint_for=untouched_marker(old_index, lambda line: line)),
+            self.extract_components(new_root, fingerprint_for=untouched_marker(new_index, new_to_old_line)),
+        )
+
+    def compare_components(self, old_components, new_components) -> DetailedChanges:
+        """Same as compare_two_files, on (functions, types, externals) maps from extract_components or a cache"""
+        with metrics.span("compare"):
+            return self._compare_components(old_components, new_components)
+
+    def _compare_components(self, old_components, new_components) -> DetailedChanges:
+        old_funcs, old_types, old_ext = old_components
+        new_funcs, new_types, new_ext = new_components
 
         funcs_diff = self.diff_components(old_funcs, new_funcs)
         self.changes.addedFunctions = funcs_diff["added"]
@@ -175,19 +585,19 @@ class RescriptFileDiff:
         return self.changes
 
     def process_single_file(self, file_ast, mode="deleted"):
-        funcs, types, exts = self.extract_components(file_ast.root_node)
-        func_names = set(funcs.keys())
-        type_names = set(types.keys())
-        ext_names = set(exts.keys())
+        return self.process_single_components(self.extract_components(file_ast.root_node), mode)
+
+    def process_single_components(self, components, mode="deleted"):
+        funcs, types, exts = components
 
         if mode == "deleted":
-            self.changes.deletedFunctions = [(n, funcs[n][1], {"start": funcs[n][2], "end": funcs[n][3]}) for n in sorted(func_names)]
-            self.changes.deletedTypes = [(n, types[n][1], {"start": types[n][2], "end": types[n][3]}) for n in sorted(type_names)]
-            self.changes.deletedExternals = [(n, exts[n][1], {"start": exts[n][2], "end": exts[n][3]}) for n in sorted(ext_names)]
+            self.changes.deletedFunctions = [funcs[n] for n in sorted(funcs)]
+            self.changes.deletedTypes = [types[n] for n in sorted(types)]
+            self.changes.deletedExternals = [exts[n] for n in sorted(exts)]
         else:
-            self.changes.addedFunctions = [(n, funcs[n][1], {"start": funcs[n][2], "end": funcs[n][3]}) for n in sorted(func_names)]
-            self.changes.addedTypes = [(n, types[n][1], {"start": types[n][2], "end": types[n][3]}) for n in sorted(type_names)]
-            self.changes.addedExternals = [(n, exts[n][1], {"start": exts[n][2], "end": exts[n][3]}) for n in sorted(ext_names)]
+            self.changes.addedFunctions = [funcs[n] for n in sorted(funcs)]
+            self.changes.addedTypes = [types[n] for n in sorted(types)]
+            self.changes.addedExternals = [exts[n] for n in sorted(exts)]
         
         return self.changes
 
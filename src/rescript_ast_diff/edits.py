@@ -0,0 +1,274 @@
+import time
+from collections import defaultdict, deque
+from typing import Callable, List, Optional, Tuple
+
+from rescript_ast_diff import metrics
+from rescript_ast_diff.differ import Declaration, structural_hash
+
+# Phase 2 checks the clock this often (in steps) rather than on every node
+_CLOCK_INTERVAL = 256
+
+
+class _Tree:
+    """A declaration's tree flattened in preorder, with what matching needs per node"""
+
+    __slots__ = ("nodes", "parents", "sizes", "children", "hashes", "source", "base", "row_offset", "column_offset")
+
+    def __init__(self, decl: Declaration, parse: Optional[Callable[[bytes], object]]):
+        if decl.node is not None:
+            root, self.source, self.base = decl.node, decl.source, decl.base
+            self.row_offset = self.column_offset = 0
+        else:
+            # Restored from the cache: reparse the body and shift positions back into the file
+            self.source, self.base = decl.body.encode(), 0
+            root = parse(self.source).root_node
+            named = [child for child in root.children if child.is_named]
+            if len(named) == 1:
+                root = named[0]
+            self.row_offset, self.column_offset = decl.start_point
+
+        subtree_hashes = {}
+        structural_hash(root, self.source, self.base, subtree_hashes=subtree_hashes)
+        self.nodes, self.parents, self.children, self.hashes = [], [], [], []
+        stack = [(root, -1)]
+        while stack:
+            node, parent = stack.pop()
+            index = len(self.nodes)
+            self.nodes.append(node)
+            self.parents.append(parent)
+            self.children.append([])
+            self.hashes.append(subtree_hashes[node.id])
+            if parent >= 0:
+                self.children[parent].append(index)
+            stack.extend((child, index) for child in reversed(node.children))
+
+        self.sizes = [1] * len(self.nodes)
+        for index in range(len(self.nodes) - 1, 0, -1):
+            self.sizes[self.parents[index]] += self.sizes[index]
+
+    def _point(self, node_point) -> Tuple[int, int]:
+        row, column = node_point
+        return (row + self.row_offset, column + self.column_offset if row == 0 else column)
+
+    def span(self, index: int) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+        """(start, end) points in the file, only computed for nodes that end up in an action"""
+        node = self.nodes[index]
+        return self._point(node.start_point), self._point(node.end_point)
+
+    def text(self, index: int) -> str:
+        node = self.nodes[index]
+        return self.source[node.start_byte - self.base:node.end_byte - self.base].decode(errors="ignore")
+
+
+def _longest_increasing(values: List[int]) -> set:
+    """Positions of one longest strictly increasing subsequence of values"""
+    tails, tail_positions, previous = [], [], [-1] * len(values)
+    for position, value in enumerate(values):
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if tails[middle] < value:
+                low = middle + 1
+            else:
+                high = middle
+        if low:
+            previous[position] = tail_positions[low - 1]
+        if low == len(tails):
+            tails.append(value)
+            tail_positions.append(position)
+        else:
+            tails[low] = value
+            tail_positions[low] = position
+    kept = set()
+    position = tail_positions[-1] if tail_positions else -1
+    while position >= 0:
+        kept.add(position)
+        position = previous[position]
+    return kept
+
+
+class EditScript:
+    """
+    Tree edit script between two versions of one declaration, as insert/delete/update/move
+    actions over subtrees.
+
+    Matching runs in two phases. Identical subtrees are paired by structural hash, top-down, in
+    time linear in the tree size. What that leaves unmatched is then recovered bottom-up (a node
+    follows its matched children) and top-down (children of matched nodes pair by type, in
+    order). Both phases share a budget of `node_budget` steps and `timeout` seconds; once it is
+    spent matching stops and the script is flagged as truncated, leaving the rest as coarser
+    inserts and deletes.
+    """
+
+    def __init__(self, old: Declaration, new: Declaration, parse=None, node_budget: int = 20000, timeout: float = 0.1):
+        self.old = _Tree(old, parse)
+        self.new = _Tree(new, parse)
+        self.node_budget = node_budget
+        self.timeout = timeout
+        self.truncated = False
+        self.old_match = [-1] * len(self.old.nodes)
+        self.new_match = [-1] * len(self.new.nodes)
+        # Old nodes with a matched descendant; an identical-subtree match can no longer take them
+        self.old_blocked = [False] * len(self.old.nodes)
+        self._steps = 0
+        self._next_check = _CLOCK_INTERVAL
+        self._deadline = None
+
+    def _pair(self, old_index: int, new_index: int):
+        self.old_match[old_index] = new_index
+        self.new_match[new_index] = old_index
+
+    def _spend(self, amount: int = 1) -> bool:
+        """Charge steps against the budget; False once it (or the time) has run out"""
+        self._steps += amount
+        if self._steps > self.node_budget:
+            self.truncated = True
+        elif self._steps >= self._next_check:
+            self._next_check = self._steps + _CLOCK_INTERVAL
+            self.truncated = time.perf_counter() > self._deadline
+        return not self.truncated
+
+    def _match_identical(self):
+        old, new = self.old, self.new
+        # Candidates in preorder, per hash and per (hash, parent); used ones are dropped from the
+        # front as they are met, so every old node is looked at a bounded number of times
+        by_hash = defaultdict(deque)
+        by_parent = defaultdict(deque)
+        for index in range(len(old.nodes)):
+            # Leaves are too common (commas, keywords) to match on their own; phase 2 places them
+            if old.sizes[index] > 1:
+                by_hash[old.hashes[index]].append(index)
+                by_parent[(old.hashes[index], old.parents[index])].append(index)
+
+        def first_free(candidates):
+            while candidates and (self.old_match[candidates[0]] != -1 or self.old_blocked[candidates[0]]):
+                candidates.popleft()
+                if not self._spend():
+                    return -1
+            return candidates[0] if candidates else -1
+
+        index = 0
+        while index < len(new.nodes) and self._spend():
+            chosen = -1
+            if new.sizes[index] > 1 and new.hashes[index] in by_hash:
+                parent = new.parents[index]
+                parent_match = self.new_match[parent] if parent >= 0 else -1
+                # Prefer the copy that stayed under the same parent
+                same_parent = by_parent.get((new.hashes[index], parent_match))
+                chosen = first_free(same_parent) if same_parent else -1
+                if chosen == -1:
+                    chosen = first_free(by_hash[new.hashes[index]])
+            if chosen == -1:
+                index += 1
+                continue
+            # Equal hashes mean equal shapes, so both preorders line up node for node
+            for offset in range(new.sizes[index]):
+                self._pair(chosen + offset, index + offset)
+            ancestor = old.parents[chosen]
+            while ancestor >= 0 and not self.old_blocked[ancestor]:
+                self.old_blocked[ancestor] = True
+                ancestor = old.parents[ancestor]
+            index += new.sizes[index]
+
+    def _recover(self):
+        old, new = self.old, self.new
+        spend = self._spend
+
+        if self.new_match[0] == -1 and self.old_match[0] == -1:
+            self._pair(0, 0)
+
+        # Bottom-up: an unmatched node follows the old parent most of its matched children share
+        for index in range(len(new.nodes) - 1, -1, -1):
+            if self.new_match[index] != -1 or not new.children[index]:
+                continue
+            if not spend(len(new.children[index])):
+                return
+            votes = {}
+            for child in new.children[index]:
+                old_child = self.new_match[child]
+                if old_child != -1:
+                    old_parent = old.parents[old_child]
+                    if old_parent >= 0 and self.old_match[old_parent] == -1 and old.nodes[old_parent].type == new.nodes[index].type:
+                        votes[old_parent] = votes.get(old_parent, 0) + 1
+            if votes:
+                self._pair(max(votes, key=lambda candidate: (votes[candidate], -candidate)), index)
+
+        # Top-down: unmatched children of matched nodes pair up in order, equal text first, then equal type
+        for index in range(len(new.nodes)):
+            old_index = self.new_match[index]
+            if old_index == -1:
+                continue
+            new_children = [child for child in new.children[index] if self.new_match[child] == -1]
+            old_children = [child for child in old.children[old_index] if self.old_match[child] == -1]
+            if not new_children or not old_children:
+                continue
+            if not spend(len(new_children) * len(old_children)):
+                return
+            for same in (lambda a, b: old.hashes[a] == new.hashes[b], lambda a, b: old.nodes[a].type == new.nodes[b].type):
+                position = 0
+                for child in new_children:
+                    if self.new_match[child] != -1:
+                        continue
+                    for scan in range(position, len(old_children)):
+                        candidate = old_children[scan]
+                        if self.old_match[candidate] == -1 and same(candidate, child):
+                            self._pair(candidate, child)
+                            position = scan + 1
+                            break
+
+    def actions(self) -> List[dict]:
+        """The edit script, in new-tree order with deletions last"""
+        with metrics.span("edit_script"):
+            self._deadline = time.perf_counter() + self.timeout
+            self._match_identical()
+            if not self.truncated:
+                self._recover()
+        if self.truncated:
+            metrics.count("edit_scripts.truncated")
+        old, new = self.old, self.new
+
+        def ranges(side, tree, index):
+            start, end = tree.span(index)
+            return {f"{side}_start": start, f"{side}_end": end}
+
+        actions = []
+        for index in range(len(new.nodes)):
+            parent = new.parents[index]
+            old_index = self.new_match[index]
+            node_type = new.nodes[index].type
+            if old_index == -1:
+                if parent < 0 or self.new_match[parent] != -1:
+                    actions.append({"action": "insert", "type": node_type, **ranges("new", new, index), "text": new.text(index)})
+                continue
+            if parent >= 0 and self.new_match[parent] != old.parents[old_index]:
+                actions.append({"action": "move", "type": node_type, **ranges("old", old, old_index), **ranges("new", new, index)})
+            elif not new.children[index] and old.hashes[old_index] != new.hashes[index]:
+                actions.append({"action": "update", "type": node_type, **ranges("old", old, old_index), **ranges("new", new, index), "text": new.text(index)})
+
+            # Children that kept their parent but changed places relative to each other
+            kept = [child for child in new.children[index] if self.new_match[child] != -1 and old.parents[self.new_match[child]] == old_index]
+            in_order = _longest_increasing([self.new_match[child] for child in kept])
+            for position, child in enumerate(kept):
+                if position not in in_order:
+                    actions.append({"action": "move", "type": new.nodes[child].type, **ranges("old", old, self.new_match[child]), **ranges("new", new, child)})
+
+        for index in range(len(old.nodes)):
+            parent = old.parents[index]
+            if self.old_match[index] == -1 and (parent < 0 or self.old_match[parent] != -1):
+                actions.append({"action": "delete", "type": old.nodes[index].type, **ranges("old", old, index)})
+        return actions
+
+
+def edit_script(old: Declaration, new: Declaration, parse=None, node_budget: int = 20000, timeout: float = 0.1) -> dict:
+    """{"actions": [...], "truncated": bool} for one modified declaration; see EditScript"""
+    script = EditScript(old, new, parse, node_budget, timeout)
+    return {"actions": script.actions(), "truncated": script.truncated}
+
+
+def edit_entry(old: Declaration, new: Declaration, parse=None, node_budget: int = 20000, timeout: float = 0.1) -> Tuple[str, dict, dict]:
+    """A modified* entry carrying an edit script and the declaration spans instead of both bodies"""
+    return (
+        old.name,
+        edit_script(old, new, parse, node_budget, timeout),
+        {"old_start": old.start_point, "old_end": old.end_point, "new_start": new.start_point, "new_end": new.end_point},
+    )
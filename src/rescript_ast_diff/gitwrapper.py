@@ -1,10 +1,21 @@
 import os
 import subprocess
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
 from unidiff import PatchSet
 
+from rescript_ast_diff import metrics
+
 class GitWrapper:
-    def __init__(self, repo_path: str):
+    """
+    Read access to a local clone, which may be a blobless partial clone (see `clone`). Blobs a
+    partial clone is missing are fetched in one batch before they are read rather than lazily
+    one at a time. Branch fetches are batched into one `git fetch`, skipped when the branch was
+    fetched less than `fetch_ttl` seconds ago, and merge-bases are remembered per commit pair.
+    """
+
+    def __init__(self, repo_path: str, fetch_ttl: float = 0.0):
         if not os.path.exists(repo_path):
             raise ValueError(f"Repository path does not exist: {repo_path}")
         self.repo_path = repo_path
@@ -13,56 +24,339 @@ class GitWrapper:
             self._run_git_command(["rev-parse", "--is-inside-work-tree"], check=True)
         except subprocess.CalledProcessError:
             raise ValueError(f"Repository at {repo_path} is not a valid git repository.")
+        # Long-lived `git cat-file --batch` process shared by all blob reads
+        self._cat_file = None
+        self._cat_file_lock = threading.Lock()
+        self.fetch_ttl = fetch_ttl
+        self._fetch_lock = threading.Lock()
+        self._fetched_at: Dict[str, float] = {}
+        self._merge_bases: Dict[Tuple[str, str], str] = {}
+        self._partial_clone = None
+        # Blob id -> (commit, path) for blobs seen in list_tree, so get_blobs can prefetch them by path
+        self._blob_paths: Dict[str, Tuple[str, str]] = {}
+
+    @staticmethod
+    def clone(repo_url: str, local_path: str, blobless: bool = True):
+        """
+        Clone without a checkout. A blobless clone downloads commits and trees only; file
+        contents are fetched on demand, for the files a diff actually reads.
+        """
+        command = ["git", "clone", "--no-checkout"]
+        if blobless:
+            command.append("--filter=blob:none")
+        with metrics.span("git.clone"):
+            subprocess.run(command + [repo_url, local_path], check=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        """Shut down the persistent cat-file process, if one was started"""
+        with self._cat_file_lock:
+            process, self._cat_file = self._cat_file, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        process.stdout.close()
 
     def _run_git_command(self, command: List[str], check: bool = False) -> str:
         """Helper to run git commands"""
         git_command = ["git", "-C", self.repo_path] + command
-        result = subprocess.run(git_command, capture_output=True, text=True, check=check)
+        with metrics.span("git.command"):
+            result = subprocess.run(git_command, capture_output=True, text=True, check=check)
         return result.stdout.strip()
 
-    def get_latest_commit_from_branch(self, branch_name: str) -> str:
+    def _get_cat_file_process(self) -> subprocess.Popen:
+        """Start (or restart, if it died) the persistent cat-file process. Caller holds the lock."""
+        if self._cat_file is None or self._cat_file.poll() is not None:
+            self._cat_file = subprocess.Popen(
+                ["git", "-C", self.repo_path, "cat-file", "--batch"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        return self._cat_file
+
+    def _cat_file_batch(self, specs: List[str]) -> List[Tuple[Optional[str], Optional[str], Optional[bytes]]]:
+        """Read many objects through the cat-file pipe as (object id, type, raw bytes); (None, None, None) if missing"""
+        for spec in specs:
+            if "\n" in spec:
+                raise ValueError(f"Object name cannot contain a newline: {spec!r}")
+        if not specs:
+            return []
+
+        with self._cat_file_lock, metrics.span("git.cat_file"):
+            process = self._get_cat_file_process()
+            feed_error = []
+
+            # Requests are written from a separate thread so that git never blocks on a full
+            # stdout pipe while we are still blocked writing stdin.
+            def feed():
+                try:
+                    for spec in specs:
+                        process.stdin.write(spec.encode() + b"\n")
+                    process.stdin.flush()
+                except OSError as e:
+                    feed_error.append(e)
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            results = []
+            try:
+                for spec in specs:
+                    header = process.stdout.readline()
+                    if not header:
+                        raise RuntimeError(f"git cat-file exited while reading '{spec}': {feed_error}")
+                    fields = header.rstrip(b"\n").split(b" ")
+                    if fields[-1] in (b"missing", b"ambiguous"):
+                        results.append((None, None, None))
+                        continue
+                    object_id, object_type, size = fields
+                    data = process.stdout.read(int(size))
+                    process.stdout.read(1)  # trailing LF after every object
+                    results.append((object_id.decode(), object_type.decode(), data))
+            except Exception:
+                # The stream position is unknown now, so the process cannot be reused
+                process.kill()
+                self._cat_file = None
+                raise
+            finally:
+                feeder.join()
+            metrics.count("git.objects_read", len(results))
+            metrics.count("bytes_fetched", sum(len(data) for _, _, data in results if data))
+            return results
+
+    def is_partial_clone(self) -> bool:
+        if self._partial_clone is None:
+            self._partial_clone = self._run_git_command(["config", "--get", "remote.origin.promisor"]) == "true"
+        return self._partial_clone
+
+    def fetch(self, branches: Iterable[str]):
+        """
+        Update origin/<branch> for several branches with a single `git fetch`, skipping branches
+        fetched within the last fetch_ttl seconds. Callers that already know the commits they
+        need use ensure_commits instead, which does not fetch at all when they are present.
+        """
+        branches = list(dict.fromkeys(branches))
+        with self._fetch_lock:
+            now = time.monotonic()
+            stale = [branch for branch in branches if now - self._fetched_at.get(branch, float("-inf")) >= self.fetch_ttl]
+            if not stale:
+                metrics.count("git.fetches_skipped", len(branches))
+                return
+            with metrics.span("git.fetch"):
+                result = subprocess.run(["git", "-C", self.repo_path, "fetch", "--no-tags", "origin"] + stale, capture_output=True, text=True)
+            if result.returncode != 0:
+                print(f"Warning: fetch failed: {result.stderr}")
+                return
+            now = time.monotonic()
+            for branch in stale:
+                self._fetched_at[branch] = now
+
+    def get_latest_commit_from_branch(self, branch_name: str, fetch: bool = True) -> str:
         """Fetch remote branch and get latest commit hash"""
-        try:
-            self._run_git_command(["fetch", "origin", branch_name])
-        except subprocess.CalledProcessError as e:
-            print(f"Warning: Failed to fetch branch '{branch_name}': {e.stderr}")
+        if fetch:
+            self.fetch([branch_name])
 
         full_ref = f"origin/{branch_name}"
         try:
-            return self._run_git_command(["rev-parse", full_ref])
+            return self._run_git_command(["rev-parse", "--verify", "--quiet", full_ref], check=True)
         except subprocess.CalledProcessError:
             return self._run_git_command(["rev-parse", branch_name])
 
-    def get_common_ancestor(self, branch1: str, branch2: str) -> str:
+    def has_commit(self, commit: str) -> bool:
+        # A partial clone would otherwise fetch a missing commit on the spot, one object at a time
+        result = subprocess.run(
+            ["git", "-C", self.repo_path, "cat-file", "-e", f"{commit}^{{commit}}"],
+            capture_output=True,
+            env={**os.environ, "GIT_NO_LAZY_FETCH": "1"},
+        )
+        return result.returncode == 0
+
+    def ensure_commits(self, commits: Iterable[str], branches: Iterable[str] = ()) -> bool:
+        """
+        Make sure every commit is in the local object database. Nothing is fetched when they all
+        are; otherwise `branches` are fetched, then the commits themselves by hash as a last
+        resort. Returns whether every commit is now present.
+        """
+        missing = [commit for commit in dict.fromkeys(commits) if not self.has_commit(commit)]
+        if not missing:
+            metrics.count("git.fetches_skipped")
+            return True
+        branches = list(branches)
+        if branches:
+            self.fetch(branches)
+            missing = [commit for commit in missing if not self.has_commit(commit)]
+        if missing:
+            with metrics.span("git.fetch"):
+                subprocess.run(["git", "-C", self.repo_path, "fetch", "--no-tags", "origin"] + missing, capture_output=True)
+            missing = [commit for commit in missing if not self.has_commit(commit)]
+        return not missing
+
+    def merge_base(self, commit1: str, commit2: str) -> str:
+        """Merge-base of two commit hashes, remembered for the lifetime of this wrapper"""
+        key = (commit1, commit2) if commit1 <= commit2 else (commit2, commit1)
+        if key not in self._merge_bases:
+            self._merge_bases[key] = self._run_git_command(["merge-base", commit1, commit2])
+        return self._merge_bases[key]
+
+    def get_common_ancestor(self, branch1: str, branch2: str, fetch: bool = True) -> str:
         """Get the merge-base (common ancestor) of two branches"""
+        if fetch:
+            self.fetch([branch1, branch2])
+        return self.merge_base(
+            self.get_latest_commit_from_branch(branch1, fetch=False),
+            self.get_latest_commit_from_branch(branch2, fetch=False),
+        )
+
+    def _fetch_objects(self, object_ids: List[str]):
+        """Download specific objects from the promisor remote in one request"""
+        with metrics.span("git.prefetch"):
+            subprocess.run(
+                [
+                    "git", "-C", self.repo_path, "-c", "fetch.negotiationAlgorithm=noop", "fetch", "origin",
+                    "--no-tags", "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none", "--stdin",
+                ],
+                input="".join(object_id + "\n" for object_id in object_ids),
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+        metrics.count("git.blobs_prefetched", len(object_ids))
+
+    def prefetch_paths(self, pairs: Iterable[Tuple[str, str]]):
+        """In a partial clone, fetch every missing blob among (commit, file_path) pairs in one batch"""
+        if not self.is_partial_clone():
+            return
+        pairs = list(pairs)
+        commits = list(dict.fromkeys(commit for commit, _ in pairs))
+        paths = list(dict.fromkeys(file_path for _, file_path in pairs))
+        if not commits:
+            return
+        # Listing objects with --missing=print reports absent blobs as "?<id>" instead of fetching them
+        result = subprocess.run(
+            ["git", "--literal-pathspecs", "-C", self.repo_path, "rev-list", "--objects", "--missing=print", "--no-walk", "--stdin"],
+            input="".join(line + "\n" for line in commits + ["--"] + paths),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        missing = [line[1:].split(" ", 1)[0] for line in result.stdout.splitlines() if line.startswith("?")]
+        if missing:
+            self._fetch_objects(missing)
+
+    def prefetch_blobs(self, object_ids: Iterable[str]):
+        """prefetch_paths for blob ids this wrapper has seen in list_tree; others are left to lazy fetching"""
+        if self.is_partial_clone():
+            self.prefetch_paths(self._blob_paths[object_id] for object_id in object_ids if object_id in self._blob_paths)
+
+    def resolve_commit(self, ref: str) -> str:
+        """Resolve a branch, tag or abbreviated hash to a full commit hash"""
         try:
-            self._run_git_command(["fetch", "origin", branch1])
-            self._run_git_command(["fetch", "origin", branch2])
-        except subprocess.CalledProcessError as e:
-            print(f"Warning: fetch failed: {e.stderr}")
-
-        ref1 = f"origin/{branch1}"
-        ref2 = f"origin/{branch2}"
-        return self._run_git_command(["merge-base", ref1, ref2])
-
-    def get_changed_files_from_commits(self, to_commit: str, from_commit: str) -> Dict[str, List[str]]:
-        """Get categorized list of changed files between two commits"""
-        diff_output = self._run_git_command(["diff", "--name-status", from_commit, to_commit])
+            return self._run_git_command(["rev-parse", "--verify", f"{ref}^{{commit}}"], check=True)
+        except subprocess.CalledProcessError:
+            raise ValueError(f"Unknown revision '{ref}' in {self.repo_path}")
+
+    def list_tree(self, commit: str, paths: Optional[List[str]] = None) -> Dict[str, str]:
+        """Map file paths to blob ids at a commit, read from the object database without a checkout"""
+        command = ["ls-tree", "-r", "-z", "--full-tree", commit]
+        if paths is not None:
+            if not paths:
+                return {}
+            command += ["--"] + list(paths)
+        result = subprocess.run(["git", "-C", self.repo_path] + command, capture_output=True, check=True)
+        blobs = {}
+        for entry in result.stdout.decode(errors="surrogateescape").split("\0"):
+            if not entry:
+                continue
+            meta, file_path = entry.split("\t", 1)
+            _, object_type, object_id = meta.split(" ")
+            if object_type == "blob":
+                blobs[file_path] = object_id
+        if self.is_partial_clone():
+            self._blob_paths.update((object_id, (commit, file_path)) for file_path, object_id in blobs.items())
+        return blobs
+
+    def get_blobs(self, object_ids: Iterable[str]) -> List[Optional[bytes]]:
+        """Get raw contents of many blobs by object id; None where the object is missing"""
+        object_ids = list(object_ids)
+        self.prefetch_blobs(object_ids)
+        return [
+            data if object_type == "blob" else None
+            for _, object_type, data in self._cat_file_batch(object_ids)
+        ]
+
+    def get_changed_files_from_commits(self, to_commit: str, from_commit: str) -> Dict[str, list]:
+        """
+        Get categorized list of changed files between two commits. Renames are detected, and
+        "renamed" holds (old_path, new_path) pairs; copies are reported as added files.
+        """
+        diff_output = self._run_git_command(["-c", "core.quotePath=false", "diff", "--name-status", "--find-renames", from_commit, to_commit])
         changes = {
             "added": [],
             "deleted": [],
-            "modified": []
+            "modified": [],
+            "renamed": []
         }
         for line in diff_output.splitlines():
-            status, file_path = line.split('\t')
+            # Renames and copies carry a similarity score and two paths: R100<TAB>old<TAB>new
+            status, *paths = line.split('\t')
             if status == "A":
-                changes["added"].append(file_path)
+                changes["added"].append(paths[0])
             elif status == "D":
-                changes["deleted"].append(file_path)
-            elif status == "M":
-                changes["modified"].append(file_path)
+                changes["deleted"].append(paths[0])
+            elif status in ("M", "T"):
+                changes["modified"].append(paths[0])
+            elif status.startswith("R"):
+                changes["renamed"].append((paths[0], paths[1]))
+            elif status.startswith("C"):
+                changes["added"].append(paths[1])
         return changes
 
+    def get_commit_range_changes(self, from_commit: str, to_commit: str) -> List[Tuple[str, Optional[str], Dict[str, List[Tuple[str, Optional[str], Optional[str]]]]]]:
+        """
+        Every commit in from_commit..to_commit, oldest first, as (commit, first parent, changes) where
+        changes maps "added"/"deleted"/"modified" to (file_path, old_blob_id, new_blob_id). Merge
+        commits are diffed against their first parent. One `git log` call covers the whole range.
+        """
+        log_output = self._run_git_command([
+            "-c", "core.quotePath=false", "log", "--reverse", "--raw", "--no-renames", "--no-abbrev",
+            "--diff-merges=first-parent", "--format=%x01%H %P", f"{from_commit}..{to_commit}",
+        ])
+        null_id = "0" * 40
+        statuses = {"A": "added", "D": "deleted", "M": "modified"}
+        commits = []
+        for chunk in log_output.split("\x01"):
+            lines = chunk.strip().splitlines()
+            if not lines:
+                continue
+            hashes = lines[0].split()
+            changes = {"added": [], "deleted": [], "modified": []}
+            for line in lines[1:]:
+                if not line.startswith(":"):
+                    continue
+                meta, file_path = line.split("\t", 1)
+                _, _, old_blob, new_blob, status = meta.split(" ")
+                if status[0] in statuses:
+                    changes[statuses[status[0]]].append((
+                        file_path,
+                        old_blob if old_blob != null_id else None,
+                        new_blob if new_blob != null_id else None,
+                    ))
+            commits.append((hashes[0], hashes[1] if len(hashes) > 1 else None, changes))
+        return commits
+
     def get_changed_files_from_commits_raw(self, from_commit: str, to_commit: str) -> str:
         """Get raw git diff between two commits"""
         return self._run_git_command(["diff", from_commit, to_commit])
@@ -86,9 +380,62 @@ class GitWrapper:
 
         return added_changes, removed_changes
 
+    def get_file_contents(self, pairs: Iterable[Tuple[str, str]]) -> List[Optional[bytes]]:
+        """Get raw contents of many (commit, file_path) pairs in one pass; None where the file does not exist"""
+        pairs = list(pairs)
+        self.prefetch_paths(pairs)
+        specs = [f"{commit}:{file_path}" for commit, file_path in pairs]
+        return [
+            data if object_type == "blob" else None
+            for _, object_type, data in self._cat_file_batch(specs)
+        ]
+
+    def get_file_sizes(self, pairs: Iterable[Tuple[str, str]]) -> List[Optional[int]]:
+        """
+        Sizes in bytes of many (commit, file_path) pairs, without reading their contents; None where
+        the file does not exist. A partial clone has to download the blobs to know their sizes.
+        """
+        pairs = list(pairs)
+        specs = [f"{commit}:{file_path}" for commit, file_path in pairs]
+        for spec in specs:
+            if "\n" in spec:
+                raise ValueError(f"Object name cannot contain a newline: {spec!r}")
+        if not specs:
+            return []
+        self.prefetch_paths(pairs)
+        with metrics.span("git.cat_file"):
+            result = subprocess.run(
+                ["git", "-C", self.repo_path, "cat-file", "--batch-check"],
+                input="".join(spec + "\n" for spec in specs).encode(errors="surrogateescape"),
+                capture_output=True,
+                check=True,
+            )
+        sizes = []
+        for line in result.stdout.decode(errors="surrogateescape").splitlines():
+            fields = line.split(" ")
+            sizes.append(int(fields[2]) if len(fields) == 3 and fields[1] == "blob" else None)
+        return sizes
+
+    def get_file_hunks(self, to_commit: str, from_commit: str) -> Dict[str, List[Tuple[int, int, int, int]]]:
+        """Changed line ranges per file as 0-based (old_start, old_count, new_start, new_count)"""
+        raw_diff = self._run_git_command(["diff", "--unified=0", "--no-renames", from_commit, to_commit])
+        hunks = {}
+        for patched_file in PatchSet(raw_diff):
+            hunks[patched_file.path] = [
+                (
+                    hunk.source_start - 1 if hunk.source_length else hunk.source_start,
+                    hunk.source_length,
+                    hunk.target_start - 1 if hunk.target_length else hunk.target_start,
+                    hunk.target_length,
+                )
+                for hunk in patched_file
+            ]
+        return hunks
+
     def get_file_content(self, file_path: str, commit: Optional[str] = "HEAD") -> str:
         """Get the content of a file at a specific commit"""
-        try:
-            return self._run_git_command(["show", f"{commit}:{file_path}"], check=True)
-        except subprocess.CalledProcessError as e:
-            raise FileNotFoundError(f"File '{file_path}' not found at commit '{commit}'. Error: {e.stderr}")
+        content = self.get_file_contents([(commit, file_path)])[0]
+        if content is None:
+            raise FileNotFoundError(f"File '{file_path}' not found at commit '{commit}'.")
+        return content.decode(errors="ignore")
+
@@ -0,0 +1,165 @@
+import multiprocessing
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from rescript_ast_diff.cache import cache_key, components_to_record, open_cache, record_to_components
+from rescript_ast_diff.differ import RescriptFileDiff
+from rescript_ast_diff.gitwrapper import GitWrapper
+from rescript_ast_diff.output import ChangesWriter
+from rescript_ast_diff.pipeline import _to_builtin, get_parser
+
+BLOB_BATCH_SIZE = 16
+
+# Per-process repository handle (its own cat-file pipe) and cache, set up by init_history_worker
+_repo: Optional[GitWrapper] = None
+_owns_repo = False
+_cache = None
+_ignore_formatting = False
+
+
+def init_history_worker(repo_path: str, cache_dir: Optional[str] = None, cache_max_bytes: Optional[int] = None, ignore_formatting: bool = False, repo: Optional[GitWrapper] = None):
+    """
+    Set up this process for extract_blobs/read_blobs. Pool workers open their own repository
+    handle; a caller running in-process can lend its open `repo` instead of starting another
+    cat-file pipe. Any handle from an earlier call is released first.
+    """
+    global _repo, _owns_repo, _cache, _ignore_formatting
+    close_history_worker()
+    _repo, _owns_repo = (repo, False) if repo is not None else (GitWrapper(repo_path), True)
+    _cache = open_cache(cache_dir, cache_max_bytes)
+    _ignore_formatting = ignore_formatting
+
+
+def close_history_worker():
+    """Stop the cat-file pipe opened by init_history_worker; a lent repository is left open"""
+    global _repo
+    if _repo is not None and _owns_repo:
+        _repo.close()
+    _repo = None
+
+
+def extract_blobs(blob_ids: List[str]) -> list:
+    """Declarations of each blob, read through this process's cat-file pipe and the cache"""
+    keys = [cache_key(blob_id, _ignore_formatting) for blob_id in blob_ids]
+    components = [_cache.get(key) if _cache else None for key in keys]
+    missing = [index for index, found in enumerate(components) if found is None]
+    contents = _repo.get_blobs([blob_ids[index] for index in missing])
+    diff = RescriptFileDiff(ignore_formatting=_ignore_formatting)
+    for index, content in zip(missing, contents):
+        components[index] = diff.extract_components(get_parser().parse(content or b"").root_node)
+        if _cache is not None:
+            _cache.put(keys[index], components[index])
+    return components
+
+
+def read_blobs(blob_ids: List[str]) -> List[Optional[bytes]]:
+    """Raw blob contents through this process's cat-file pipe"""
+    return _repo.get_blobs(blob_ids)
+
+
+def extract_blob_records(blob_ids: List[str]) -> List[dict]:
+    # Trees cannot leave the worker; ship cache-style records back instead
+    return [components_to_record(components) for components in extract_blobs(blob_ids)]
+
+
+def generate_history(repo_path: str, from_commit: str, to_commit: str, output_dir="./", output_format="ndjson", workers: int = 1, cache_dir: str = None, cache_max_bytes: int = None, quiet=True, ignore_formatting: bool = False) -> str:
+    """
+    Per-commit declaration changes for every commit in from_commit..to_commit, oldest first.
+
+    Writes one record per commit, {"commit", "parent", "changes": [DetailedChanges.to_dict()...]},
+    to history.ndjson (or history.json). Every blob in the range is parsed at most once: blobs are
+    deduplicated across commits, extracted in order of first use (fanned out over a process pool
+    when workers > 1), and dropped once the last commit that needs them has been diffed. With
+    ignore_formatting, commits that only reformat or re-comment a declaration do not modify it.
+    """
+    with GitWrapper(repo_path) as gitclient:
+        commits = gitclient.get_commit_range_changes(from_commit, to_commit)
+        # A blobless clone downloads every blob the range needs in one go instead of one per read
+        gitclient.prefetch_paths(
+            (revision, file_path)
+            for commit, parent, changes in commits
+            for entries in changes.values()
+            for file_path, old_blob, new_blob in entries
+            if file_path.endswith(".res")
+            for revision, blob_id in ((parent, old_blob), (commit, new_blob))
+            if blob_id and revision
+        )
+
+    remaining_uses = Counter()
+    blob_order = []
+    for _, _, changes in commits:
+        for entries in changes.values():
+            for file_path, old_blob, new_blob in entries:
+                if not file_path.endswith(".res"):
+                    continue
+                for blob_id in (old_blob, new_blob):
+                    if blob_id:
+                        if blob_id not in remaining_uses:
+                            blob_order.append(blob_id)
+                        remaining_uses[blob_id] += 1
+    batches = deque(blob_order[index:index + BLOB_BATCH_SIZE] for index in range(0, len(blob_order), BLOB_BATCH_SIZE))
+    print(f"Found {len(commits)} commits touching {len(blob_order)} distinct ReScript blobs")
+
+    components: Dict[str, tuple] = {}
+    pool = None
+    in_flight = deque()
+    if workers > 1:
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_history_worker,
+            initargs=(repo_path, cache_dir, cache_max_bytes, ignore_formatting),
+        )
+    else:
+        init_history_worker(repo_path, cache_dir, cache_max_bytes, ignore_formatting)
+
+    def load(blob_id):
+        # Blobs arrive in first-use order, so everything a commit needs is at most a few batches away
+        while blob_id not in components:
+            if pool is None:
+                batch = batches.popleft()
+                components.update(zip(batch, extract_blobs(batch)))
+                continue
+            while batches and len(in_flight) < 4 * workers:
+                batch = batches.popleft()
+                in_flight.append((batch, pool.submit(extract_blob_records, batch)))
+            batch, future = in_flight.popleft()
+            components.update(zip(batch, map(record_to_components, future.result())))
+        return components[blob_id]
+
+    def release(blob_id):
+        remaining_uses[blob_id] -= 1
+        if remaining_uses[blob_id] == 0:
+            components.pop(blob_id, None)
+
+    try:
+        with ChangesWriter(output_dir, output_format, file_name=f"history.{output_format}") as writer:
+            for commit, parent, changes in commits:
+                modules = []
+                for mode in ("modified", "added", "deleted"):
+                    for file_path, old_blob, new_blob in changes[mode]:
+                        if not file_path.endswith(".res"):
+                            continue
+                        diff = RescriptFileDiff(file_path, ignore_formatting=ignore_formatting)
+                        if mode == "modified":
+                            file_changes = diff.compare_components(load(old_blob), load(new_blob))
+                        elif mode == "added":
+                            file_changes = diff.process_single_components(load(new_blob), mode="added")
+                        else:
+                            file_changes = diff.process_single_components(load(old_blob), mode="deleted")
+                        modules.append(_to_builtin(file_changes.to_dict()))
+                        for blob_id in (old_blob, new_blob):
+                            if blob_id:
+                                release(blob_id)
+                writer.write({"commit": commit, "parent": parent, "changes": modules})
+                if not quiet:
+                    print("PROCESSED COMMIT -", commit)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        else:
+            close_history_worker()
+
+    print("History written to - ", writer.output_path)
+    return writer.output_path
@@ -0,0 +1,59 @@
+from bisect import bisect_right
+from typing import List, Optional, Sequence, Tuple
+
+# A changed region as 0-based line ranges: (old_start, old_count, new_start, new_count)
+Hunk = Tuple[int, int, int, int]
+# The same region as byte ranges: (old_start, old_end, new_start, new_end)
+ByteEdit = Tuple[int, int, int, int]
+
+
+def hunk_from_unified(source_start: int, source_length: int, target_start: int, target_length: int) -> Hunk:
+    """Convert unified diff hunk header numbers (1-based; a zero-length side names the line before it) to a Hunk"""
+    old_start = source_start - 1 if source_length else source_start
+    new_start = target_start - 1 if target_length else target_start
+    return old_start, source_length, new_start, target_length
+
+
+class Lines:
+    def __init__(self, content: bytes):
+        self.content = content
+        self.starts = [0]
+        position = content.find(b"\n")
+        while position != -1:
+            self.starts.append(position + 1)
+            position = content.find(b"\n", position + 1)
+
+    def offset(self, line: int) -> int:
+        return self.starts[line] if line < len(self.starts) else len(self.content)
+
+    def point(self, offset: int) -> Tuple[int, int]:
+        row = bisect_right(self.starts, offset) - 1
+        return row, offset - self.starts[row]
+
+
+def byte_edits(old_content: bytes, new_content: bytes, hunks: Sequence[Hunk]) -> Optional[List[ByteEdit]]:
+    """
+    Sorted hunks as byte ranges, or None if they do not describe these contents: out of order, or
+    the text between and around them differs. Hunks computed against another base (a merge-base
+    rather than the old side actually read) fail this check.
+    """
+    old_lines = Lines(old_content)
+    new_lines = Lines(new_content)
+    edits = []
+    old_position = new_position = 0
+    for old_start, old_count, new_start, new_count in hunks:
+        edit = (
+            old_lines.offset(old_start),
+            old_lines.offset(old_start + old_count),
+            new_lines.offset(new_start),
+            new_lines.offset(new_start + new_count),
+        )
+        if edit[0] < old_position or edit[2] < new_position:
+            return None
+        if old_content[old_position:edit[0]] != new_content[new_position:edit[2]]:
+            return None
+        edits.append(edit)
+        old_position, new_position = edit[1], edit[3]
+    if old_content[old_position:] != new_content[new_position:]:
+        return None
+    return edits
@@ -0,0 +1,90 @@
+from typing import Optional, Sequence, Tuple
+
+from tree_sitter import Parser, Tree
+
+from rescript_ast_diff.differ import DetailedChanges, RescriptFileDiff
+from rescript_ast_diff.hunks import Hunk, Lines, byte_edits
+
+
+class IncrementalParse:
+    """
+    Parses the new revision of a file by editing the old revision's tree with the diff hunks and
+    reparsing with it as a base, so tree-sitter only re-lexes the edited regions.
+
+    Hunks are checked against both contents first; if the text outside them differs, the new
+    revision is parsed from scratch and `changed_ranges` covers the whole file.
+    """
+
+    def __init__(self, parser: Parser, old_content: bytes, new_content: bytes, hunks: Sequence[Hunk], old_tree: Optional[Tree] = None):
+        self.old_content = old_content
+        self.new_content = new_content
+        self.old_tree = old_tree or parser.parse(old_content)
+        self.edits = byte_edits(old_content, new_content, sorted(hunks))
+        if self.edits is None:
+            self.new_tree = parser.parse(new_content)
+            self.changed_ranges = [(0, len(new_content))]
+            return
+
+        # Tree.edit mutates in place and the old tree is still needed for the old side
+        base_tree = self.old_tree.copy()
+        old_lines = Lines(old_content)
+        new_lines = Lines(new_content)
+        # Applied bottom-up, so each edit's start is still in the unedited document's coordinates
+        for old_start, old_end, new_start, new_end in reversed(self.edits):
+            start_point = old_lines.point(old_start)
+            start_row, start_column = new_lines.point(new_start)
+            end_row, end_column = new_lines.point(new_end)
+            if end_row == start_row:
+                new_end_point = (start_point[0], start_point[1] + end_column - start_column)
+            else:
+                new_end_point = (start_point[0] + end_row - start_row, end_column)
+            base_tree.edit(
+                start_byte=old_start,
+                old_end_byte=old_end,
+                new_end_byte=old_start + new_end - new_start,
+                start_point=start_point,
+                old_end_point=old_lines.point(old_end),
+                new_end_point=new_end_point,
+            )
+        self.new_tree = parser.parse(new_content, base_tree)
+
+        ranges = [(new_start, new_end) for _, _, new_start, new_end in self.edits]
+        ranges += [(changed.start_byte, changed.end_byte) for changed in base_tree.changed_ranges(self.new_tree)]
+        self.changed_ranges = sorted(ranges)
+
+    def touches_changes(self, node) -> bool:
+        """Whether a node of the new tree overlaps (or borders) an edited or reparsed region"""
+        return any(node.start_byte <= end and node.end_byte >= start for start, end in self.changed_ranges)
+
+    def to_old_offset(self, new_offset: int) -> int:
+        """Map a new-revision byte offset outside every edit back to the old revision"""
+        shift = 0
+        for old_start, old_end, new_start, new_end in self.edits or ():
+            if new_start >= new_offset:
+                break
+            shift += (new_end - new_start) - (old_end - old_start)
+        return new_offset - shift
+
+
+def compare_incremental(diff: RescriptFileDiff, parser: Parser, old_content: bytes, new_content: bytes, hunks: Sequence[Hunk]) -> Tuple[DetailedChanges, tuple, tuple]:
+    """
+    compare_two_files for a modified file, reparsing the new side incrementally. Declarations that
+    sit entirely outside the changed ranges share their old declaration's fingerprint, which is only
+    computed if something (the cache, a differing counterpart) asks for it.
+    Returns the changes and both sides' components.
+    """
+    parse = IncrementalParse(parser, old_content, new_content, hunks)
+    old_components = diff.extract_components(parse.old_tree.root_node)
+    old_declarations = {
+        (decl.start_byte, decl.node.type): decl
+        for component_map in old_components
+        for decl in component_map.values()
+    }
+
+    def fingerprint_for(node):
+        if parse.edits is None or parse.touches_changes(node):
+            return None
+        return old_declarations.get((parse.to_old_offset(node.start_byte), node.type))
+
+    new_components = diff.extract_components(parse.new_tree.root_node, fingerprint_for=fingerprint_for)
+    return diff.compare_components(old_components, new_components), old_components, new_components
@@ -0,0 +1,376 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
+from rescript_ast_diff import history, metrics
+from rescript_ast_diff.cache import CACHE_FORMAT_VERSION, COMPONENT_KINDS, DeclarationCache, cache_key, components_to_record, grammar_version, open_cache
+from rescript_ast_diff.differ import RescriptFileDiff
+from rescript_ast_diff.gitwrapper import GitWrapper
+from rescript_ast_diff.history import BLOB_BATCH_SIZE, close_history_worker, init_history_worker, read_blobs
+from rescript_ast_diff.pipeline import get_parser
+from rescript_ast_diff.references import LOCAL_MODULE, extract_references, module_name
+
+# Bump whenever the tables or what is extracted into them change
+INDEX_FORMAT_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS commits (
+    commit_id TEXT PRIMARY KEY,
+    base_commit TEXT,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    commit_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    module TEXT NOT NULL,
+    blob_id TEXT NOT NULL,
+    PRIMARY KEY (commit_id, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_by_blob ON files (blob_id, commit_id);
+CREATE TABLE IF NOT EXISTS blobs (blob_id TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS declarations (
+    blob_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    short_name TEXT NOT NULL,
+    start_row INTEGER NOT NULL,
+    start_column INTEGER NOT NULL,
+    end_row INTEGER NOT NULL,
+    end_column INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS declarations_by_blob ON declarations (blob_id);
+CREATE INDEX IF NOT EXISTS declarations_by_name ON declarations (short_name, name);
+CREATE TABLE IF NOT EXISTS refs (
+    blob_id TEXT NOT NULL,
+    from_name TEXT NOT NULL,
+    target_module TEXT NOT NULL,
+    target_name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS refs_by_target ON refs (target_name, target_module);
+CREATE INDEX IF NOT EXISTS refs_by_blob ON refs (blob_id);
+"""
+
+# Singular kind names as stored, in COMPONENT_KINDS order
+KIND_NAMES = dict(zip(COMPONENT_KINDS, ("function", "type", "external")))
+
+
+class ReferencesCache(DeclarationCache):
+    """
+    References made by each declaration of a blob, keyed by blob id, in their own namespace of the
+    same cache directory as the declarations and with the same atomic writes and LRU eviction.
+    """
+
+    def namespace(self) -> str:
+        return "references-" + hashlib.sha1(f"{grammar_version()}:{INDEX_FORMAT_VERSION}".encode()).hexdigest()[:16]
+
+    def get(self, blob_id: str) -> Optional[dict]:
+        path = self._entry_path(blob_id)
+        try:
+            with open(path, "rb") as f:
+                references = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            metrics.count("references_cache.misses")
+            return None
+        self.hits += 1
+        metrics.count("references_cache.hits")
+        return references
+
+    def put(self, blob_id: str, references: dict):
+        self._write(self._entry_path(blob_id), json.dumps(references, separators=(",", ":")).encode())
+
+
+# Per-process references cache, set up by init_index_worker next to the history worker's declaration cache
+_references_cache: Optional[ReferencesCache] = None
+
+
+def init_index_worker(repo_path: str, cache_dir: Optional[str] = None, repo: Optional[GitWrapper] = None):
+    global _references_cache
+    init_history_worker(repo_path, cache_dir, repo=repo)
+    _references_cache = open_cache(cache_dir, cache_class=ReferencesCache)
+
+
+def extract_index_records(blob_ids: List[str]) -> List[Tuple[dict, dict]]:
+    """
+    (declaration record, references) for each blob. Blobs found in both caches are not read at
+    all; the rest are parsed once in this worker and their results cached.
+    """
+    declaration_cache = history._cache
+    keys = [cache_key(blob_id) for blob_id in blob_ids]
+    records = []
+    for blob_id, key in zip(blob_ids, keys):
+        components = declaration_cache.get(key) if declaration_cache else None
+        references = _references_cache.get(blob_id) if _references_cache and components is not None else None
+        records.append((components, references))
+
+    missing = [index for index, (components, references) in enumerate(records) if references is None]
+    for index, content in zip(missing, read_blobs([blob_ids[index] for index in missing])):
+        root = get_parser().parse(content or b"").root_node
+        diff = RescriptFileDiff()
+        components = diff.extract_components(root)
+        references = extract_references(diff, root)
+        if declaration_cache is not None:
+            declaration_cache.put(keys[index], components)
+        if _references_cache is not None:
+            _references_cache.put(blob_ids[index], references)
+        records[index] = (components, references)
+    return [(components_to_record(components), references) for components, references in records]
+
+
+class DeclarationIndex:
+    """
+    SQLite index of every declaration in the repository's .res files, per indexed commit, and of
+    the references each declaration makes to other declarations.
+
+    Declarations are stored once per blob and commits only map paths to blob ids, so indexing a
+    commit that shares most files with an indexed one costs a row copy per file plus extraction
+    of the blobs it has not seen before. The first commit is a full build; later ones are applied
+    as a diff against an already indexed commit (by default the most recently indexed).
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self._check_version()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _check_version(self):
+        # Fingerprints depend on the grammar, so an index built with another one is started over
+        version = f"{grammar_version()}-v{CACHE_FORMAT_VERSION}-i{INDEX_FORMAT_VERSION}"
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is not None and row[0] == version:
+            return
+        with self.connection:
+            for table in ("commits", "files", "blobs", "declarations", "refs"):
+                self.connection.execute(f"DELETE FROM {table}")
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (version,))
+
+    def indexed_commits(self) -> List[str]:
+        return [row[0] for row in self.connection.execute("SELECT commit_id FROM commits ORDER BY indexed_at")]
+
+    def is_indexed(self, commit: str) -> bool:
+        return self.connection.execute("SELECT 1 FROM commits WHERE commit_id = ?", (commit,)).fetchone() is not None
+
+    def _store_blobs(self, gitclient: GitWrapper, blob_ids: List[str], workers: int, cache_dir: Optional[str]):
+        known = set()
+        for start in range(0, len(blob_ids), 500):
+            chunk = blob_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            known.update(row[0] for row in self.connection.execute(f"SELECT blob_id FROM blobs WHERE blob_id IN ({placeholders})", chunk))
+        missing = list(dict.fromkeys(blob_id for blob_id in blob_ids if blob_id not in known))
+        if not missing:
+            return
+        print(f"Extracting declarations from {len(missing)} new blobs")
+        gitclient.prefetch_blobs(missing)
+
+        batches = [missing[start:start + BLOB_BATCH_SIZE] for start in range(0, len(missing), BLOB_BATCH_SIZE)]
+        if workers > 1:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_index_worker,
+                initargs=(gitclient.repo_path, cache_dir),
+            ) as pool:
+                for batch, records in zip(batches, pool.map(extract_index_records, batches)):
+                    self._insert_records(batch, records)
+        else:
+            # In-process extraction reads through the caller's own cat-file pipe
+            init_index_worker(gitclient.repo_path, cache_dir, repo=gitclient)
+            try:
+                for batch in batches:
+                    self._insert_records(batch, extract_index_records(batch))
+            finally:
+                close_history_worker()
+
+    def _insert_records(self, blob_ids: List[str], records: List[Tuple[dict, dict]]):
+        rows = []
+        reference_rows = []
+        for blob_id, (record, references) in zip(blob_ids, records):
+            for kind in COMPONENT_KINDS:
+                for name, (fingerprint, _, start, end, _, _) in record[kind].items():
+                    rows.append((blob_id, KIND_NAMES[kind], name, name.rsplit("::", 1)[-1], start[0], start[1], end[0], end[1], fingerprint))
+            for from_name, targets in references.items():
+                reference_rows += [(blob_id, from_name, target_module, target_name) for target_module, target_name in targets]
+        self.connection.executemany("INSERT INTO declarations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.connection.executemany("INSERT INTO refs VALUES (?, ?, ?, ?)", reference_rows)
+        self.connection.executemany("INSERT OR IGNORE INTO blobs VALUES (?)", [(blob_id,) for blob_id in blob_ids])
+
+    def update(self, gitclient: GitWrapper, ref: str, base: Optional[str] = None, workers: int = 1, cache_dir: Optional[str] = None) -> str:
+        """
+        Index the commit `ref` points at. With an indexed base commit (the most recent one unless
+        given) only the files changed between the two are re-read; otherwise the whole tree is.
+        """
+        commit = gitclient.resolve_commit(ref)
+        if self.is_indexed(commit):
+            return commit
+        if base is None:
+            indexed = self.indexed_commits()
+            base = indexed[-1] if indexed else None
+        else:
+            base = gitclient.resolve_commit(base)
+            if not self.is_indexed(base):
+                raise ValueError(f"Base commit {base} is not indexed")
+
+        with self.connection:
+            if base is None:
+                print(f"Building index for {commit}")
+                blobs = {path: blob_id for path, blob_id in gitclient.list_tree(commit).items() if path.endswith(".res")}
+                removed = []
+            else:
+                print(f"Updating index from {base} to {commit}")
+                changes = gitclient.get_changed_files_from_commits(commit, base)
+                changed = changes["modified"] + changes["added"] + [new_path for _, new_path in changes["renamed"]]
+                removed = changes["deleted"] + [old_path for old_path, _ in changes["renamed"]]
+                blobs = gitclient.list_tree(commit, [path for path in changed if path.endswith(".res")])
+                self.connection.execute(
+                    "INSERT INTO files SELECT ?, path, module, blob_id FROM files WHERE commit_id = ?", (commit, base)
+                )
+
+            self._store_blobs(gitclient, list(blobs.values()), workers, cache_dir)
+            self.connection.executemany("DELETE FROM files WHERE commit_id = ? AND path = ?", [(commit, path) for path in removed])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                [(commit, path, module_name(path), blob_id) for path, blob_id in blobs.items()],
+            )
+            self.connection.execute("INSERT INTO commits VALUES (?, ?, ?)", (commit, base, time.time()))
+        return commit
+
+    def definitions(self, commit: str, name: str, kind: Optional[str] = None) -> List[dict]:
+        """Where `name` (bare, or qualified as Module::name) is declared at an indexed commit"""
+        query = """
+            SELECT f.path, f.module, d.kind, d.name, d.start_row, d.start_column, d.end_row, d.end_column, d.fingerprint, f.blob_id
+            FROM declarations d JOIN files f ON f.blob_id = d.blob_id
+            WHERE d.short_name = ? AND f.commit_id = ?
+        """
+        params = [name.rsplit("::", 1)[-1], commit]
+        if "::" in name:
+            query += " AND d.name = ?"
+            params.append(name)
+        if kind:
+            query += " AND d.kind = ?"
+            params.append(kind)
+        return [
+            {
+                "path": path, "module": module, "kind": kind, "name": qualified,
+                "start": (start_row, start_column), "end": (end_row, end_column),
+                "fingerprint": fingerprint, "blob_id": blob_id,
+            }
+            for path, module, kind, qualified, start_row, start_column, end_row, end_column, fingerprint, blob_id
+            in self.connection.execute(query + " ORDER BY f.path, d.name", params)
+        ]
+
+    def changes(self, old_commit: str, new_commit: str, name: str, kind: Optional[str] = None) -> List[dict]:
+        """Modules where `name` was added, deleted or modified between two indexed commits"""
+        before = {(entry["path"], entry["kind"], entry["name"]): entry for entry in self.definitions(old_commit, name, kind)}
+        after = {(entry["path"], entry["kind"], entry["name"]): entry for entry in self.definitions(new_commit, name, kind)}
+        changed = []
+        for key in sorted(before.keys() | after.keys()):
+            old, new = before.get(key), after.get(key)
+            if old is None:
+                change = "added"
+            elif new is None:
+                change = "deleted"
+            elif old["fingerprint"] != new["fingerprint"]:
+                change = "modified"
+            else:
+                continue
+            path, kind_name, qualified = key
+            changed.append({"path": path, "module": (new or old)["module"], "kind": kind_name, "name": qualified, "change": change})
+        return changed
+
+    def changed_declarations(self, old_commit: str, new_commit: str) -> List[dict]:
+        """Every declaration added, deleted or modified between two indexed commits"""
+        query = "SELECT path, module, blob_id FROM files WHERE commit_id = ?"
+        before = {path: (module, blob_id) for path, module, blob_id in self.connection.execute(query, (old_commit,))}
+        after = {path: (module, blob_id) for path, module, blob_id in self.connection.execute(query, (new_commit,))}
+
+        def declarations(blob_id):
+            if blob_id is None:
+                return {}
+            return {
+                (kind, name): fingerprint
+                for kind, name, fingerprint in self.connection.execute(
+                    "SELECT kind, name, fingerprint FROM declarations WHERE blob_id = ?", (blob_id,)
+                )
+            }
+
+        changed = []
+        for path in sorted(before.keys() | after.keys()):
+            old_module, old_blob = before.get(path, (None, None))
+            new_module, new_blob = after.get(path, (None, None))
+            if old_blob == new_blob:
+                continue
+            old_declarations, new_declarations = declarations(old_blob), declarations(new_blob)
+            for key in sorted(old_declarations.keys() | new_declarations.keys()):
+                if key not in old_declarations:
+                    change = "added"
+                elif key not in new_declarations:
+                    change = "deleted"
+                elif old_declarations[key] != new_declarations[key]:
+                    change = "modified"
+                else:
+                    continue
+                kind, name = key
+                changed.append({"path": path, "module": new_module or old_module, "kind": kind, "name": name, "change": change})
+        return changed
+
+    def referrers(self, commit: str, module: str, name: str) -> List[Tuple[str, str, str]]:
+        """(path, module, declaration) of every declaration at an indexed commit that refers to Module::name"""
+        short_name = name.rsplit("::", 1)[-1]
+        return self.connection.execute(
+            """
+            SELECT DISTINCT f.path, f.module, r.from_name
+            FROM refs r JOIN files f ON f.blob_id = r.blob_id AND f.commit_id = ?
+            WHERE r.target_name IN (?, ?) AND (r.target_module = ? OR (r.target_module = ? AND f.module = ?))
+            ORDER BY f.path, r.from_name
+            """,
+            (commit, name, short_name, module, LOCAL_MODULE, module),
+        ).fetchall()
+
+    def impacted(self, commit: str, changed: Iterable[Tuple[str, str]], max_depth: int = 3) -> List[dict]:
+        """
+        Declarations that depend, directly or transitively up to `max_depth` references away, on
+        any of the `changed` (module, name) pairs, resolved against the reference graph of `commit`.
+        Each is reported once, at the shortest depth, with the declaration it was reached through.
+        """
+        seen = set(changed)
+        frontier = list(seen)
+        impacted = []
+        for depth in range(1, max_depth + 1):
+            next_frontier = []
+            for module, name in frontier:
+                for path, referrer_module, referrer in self.referrers(commit, module, name):
+                    key = (referrer_module, referrer)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    next_frontier.append(key)
+                    impacted.append({"path": path, "module": referrer_module, "name": referrer, "depth": depth, "via": f"{module}::{name}"})
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        return impacted
+
+
+def build_index(repo_path: str, db_path: str, refs: List[str], workers: int = 1, cache_dir: Optional[str] = None) -> List[str]:
+    """Index each ref in turn, every one incrementally from the one before"""
+    with GitWrapper(repo_path) as gitclient, DeclarationIndex(db_path) as index:
+        return [index.update(gitclient, ref, workers=workers, cache_dir=cache_dir) for ref in refs]
@@ -0,0 +1,186 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+
+class Metrics:
+    """
+    Stage timings, counters and per-file timings for one run.
+
+    Spans are keyed by stage name and accumulate a count, total and max duration. Stages running
+    on fetch threads or parse workers overlap, so span totals can add up to more than wall time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.counters = Counter()
+        self.files = []
+
+    def add_span(self, name: str, seconds: float):
+        with self._lock:
+            entry = self.spans.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def add(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def add_file(self, file_path: str, mode: str, seconds: float):
+        with self._lock:
+            self.files.append({"file": file_path, "mode": mode, "seconds": seconds})
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "wall_seconds": time.perf_counter() - self.started,
+                "spans": {
+                    name: {"count": count, "total_seconds": total, "max_seconds": longest}
+                    for name, (count, total, longest) in sorted(self.spans.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+                "files": sorted(self.files, key=lambda entry: entry["seconds"], reverse=True),
+            }
+
+    def merge(self, snapshot: dict):
+        """Fold in a snapshot taken in another process (wall time is not merged)"""
+        with self._lock:
+            for name, span in snapshot["spans"].items():
+                entry = self.spans.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += span["count"]
+                entry[1] += span["total_seconds"]
+                entry[2] = max(entry[2], span["max_seconds"])
+            self.counters.update(snapshot["counters"])
+            self.files.extend(snapshot["files"])
+
+
+class _Span:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics: Metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.metrics.add_span(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _FileSpan(_Span):
+    __slots__ = ("file_path", "mode")
+
+    def __init__(self, metrics: Metrics, file_path: str, mode: str):
+        super().__init__(metrics, "diff_file")
+        self.file_path = file_path
+        self.mode = mode
+
+    def __exit__(self, exc_type, exc_value, tb):
+        seconds = time.perf_counter() - self.start
+        self.metrics.add_span(self.name, seconds)
+        self.metrics.add_file(self.file_path, self.mode, seconds)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+# The active recorder for this process; None (the default) turns every call below into a no-op
+_metrics: Optional[Metrics] = None
+
+
+def enable() -> Metrics:
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+
+def disable():
+    global _metrics
+    _metrics = None
+
+
+def enabled() -> bool:
+    return _metrics is not None
+
+
+def current() -> Optional[Metrics]:
+    return _metrics
+
+
+def span(name: str):
+    """Time a stage: `with metrics.span("parse"): ...`"""
+    if _metrics is None:
+        return _NULL_SPAN
+    return _Span(_metrics, name)
+
+
+def file_span(file_path: str, mode: str):
+    """Time one file's parse/extract/compare, recorded both as the "diff_file" stage and per file"""
+    if _metrics is None:
+        return _NULL_SPAN
+    return _FileSpan(_metrics, file_path, mode)
+
+
+def count(name: str, value: int = 1):
+    if _metrics is not None:
+        _metrics.add(name, value)
+
+
+def to_prometheus(snapshot: dict, prefix: str = "rescript_ast_diff") -> str:
+    """Render a snapshot in the Prometheus text exposition format"""
+
+    def metric_name(name):
+        return prefix + "_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+    lines = [
+        f"# TYPE {prefix}_wall_seconds gauge",
+        f"{prefix}_wall_seconds {snapshot['wall_seconds']}",
+        f"# TYPE {prefix}_stage_seconds_total counter",
+    ]
+    lines += [f'{prefix}_stage_seconds_total{{stage="{name}"}} {span["total_seconds"]}' for name, span in snapshot["spans"].items()]
+    lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+    lines += [f'{prefix}_stage_calls_total{{stage="{name}"}} {span["count"]}' for name, span in snapshot["spans"].items()]
+    lines.append(f"# TYPE {prefix}_stage_max_seconds gauge")
+    lines += [f'{prefix}_stage_max_seconds{{stage="{name}"}} {span["max_seconds"]}' for name, span in snapshot["spans"].items()]
+    for name, value in snapshot["counters"].items():
+        lines.append(f"# TYPE {metric_name(name)}_total counter")
+        lines.append(f"{metric_name(name)}_total {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_report(output_dir: str, prometheus: Optional[str] = None) -> Optional[str]:
+    """
+    Write metrics.json for the active recorder into output_dir and, given a path, the Prometheus
+    text format there, replaced atomically so a textfile collector never reads half a file
+    """
+    if _metrics is None:
+        return None
+    snapshot = _metrics.snapshot()
+    report_path = os.path.join(output_dir, "metrics.json")
+    with open(report_path, "w") as f:
+        json.dump(snapshot, f, indent=3)
+    if prometheus:
+        with open(prometheus + ".partial", "w") as f:
+            f.write(to_prometheus(snapshot))
+        os.replace(prometheus + ".partial", prometheus)
+    return report_path
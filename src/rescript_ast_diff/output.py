@@ -0,0 +1,74 @@
+import json
+import os
+
+from rescript_ast_diff import metrics
+
+OUTPUT_FILE_NAMES = {
+    "json": "detailed_changes.json",
+    "ndjson": "detailed_changes.ndjson",
+}
+
+
+class ChangesWriter:
+    """
+    Writes per-module change records to disk as each file finishes, instead of collecting them all.
+
+    "ndjson" writes one compact record per line and flushes it immediately, so consumers can tail
+    `<name>.partial` while the run is still going. "json" produces exactly what
+    json.dump(all_changes, f, indent=3) would. Either way the file is written under a `.partial`
+    name and renamed into place by finalize(), so the final path only ever holds a complete run.
+    """
+
+    def __init__(self, output_dir: str, output_format: str = "json", file_name: str = None):
+        if output_format not in OUTPUT_FILE_NAMES:
+            raise ValueError(f"Unknown output format '{output_format}', expected one of {sorted(OUTPUT_FILE_NAMES)}")
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_format = output_format
+        self.output_path = os.path.join(output_dir, file_name or OUTPUT_FILE_NAMES[output_format])
+        self.partial_path = self.output_path + ".partial"
+        self.count = 0
+        self._file = open(self.partial_path, "w")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.finalize()
+        else:
+            self.discard()
+
+    def write(self, record: dict):
+        with metrics.span("write"):
+            self._write(record)
+
+    def _write(self, record: dict):
+        if self.output_format == "ndjson":
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+        else:
+            # Matches the layout json.dump uses for an element of a top-level indent=3 array
+            item = json.dumps(record, indent=3).replace("\n", "\n   ")
+            self._file.write(("[\n   " if self.count == 0 else ",\n   ") + item)
+        self.count += 1
+
+    def finalize(self) -> str:
+        """Close the stream and atomically move it to its final name"""
+        if self._file.closed:
+            return self.output_path
+        if self.output_format == "json":
+            self._file.write("\n]" if self.count else "[]")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.partial_path, self.output_path)
+        return self.output_path
+
+    def discard(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        try:
+            os.unlink(self.partial_path)
+        except OSError:
+            pass
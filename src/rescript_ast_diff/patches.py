@@ -0,0 +1,86 @@
+import re
+from typing import Dict, Optional
+
+from unidiff import PatchSet
+from unidiff.patch import LINE_TYPE_ADDED, LINE_TYPE_CONTEXT, LINE_TYPE_NO_NEWLINE, LINE_TYPE_REMOVED, PatchedFile
+
+from rescript_ast_diff.cache import git_blob_id
+
+# `index <old>..<new> [<mode>]`, with abbreviated blob ids
+INDEX_LINE = re.compile(r"^index ([0-9a-f]+)\.\.([0-9a-f]+)")
+# Patch text is decoded with this so that every byte survives the round trip back to bytes
+PATCH_ENCODING = ("utf-8", "surrogateescape")
+
+
+class PatchError(ValueError):
+    """A patch that does not apply to the given content, or whose result has the wrong blob id"""
+
+
+def parse_patch(raw_diff: str) -> Dict[str, PatchedFile]:
+    """Split a unified (git-style) diff into one PatchedFile per path; deleted files are keyed by their old path"""
+    return {patched_file.path: patched_file for patched_file in PatchSet(raw_diff)}
+
+
+def _blob_ids(patched_file: PatchedFile):
+    for line in patched_file.patch_info or ():
+        match = INDEX_LINE.match(line)
+        if match:
+            return match.group(1), match.group(2)
+    return None, None
+
+
+def _matches(content: bytes, abbreviated: Optional[str]) -> bool:
+    # An all-zero id stands for "no file", which only empty content can be
+    if not abbreviated:
+        return True
+    if not abbreviated.strip("0"):
+        return not content
+    return git_blob_id(content).startswith(abbreviated)
+
+
+def apply_patch(base: bytes, patched_file: PatchedFile) -> bytes:
+    """
+    The new side of a file, rebuilt from its old side and its hunks. Context and removed lines
+    must match the old side, and when the patch carries `index` blob ids, both sides must hash to
+    them; PatchError otherwise.
+    """
+    old_id, new_id = _blob_ids(patched_file)
+    if not _matches(base, old_id):
+        raise PatchError(f"{patched_file.path}: base content does not match blob {old_id}")
+
+    base_lines = base.splitlines(keepends=True)
+    result = []
+    position = 0
+    for hunk in patched_file:
+        # A zero-length old side names the line before the insertion
+        start = hunk.source_start - 1 if hunk.source_length else hunk.source_start
+        if start < position or start > len(base_lines):
+            raise PatchError(f"{patched_file.path}: hunk at line {hunk.source_start} is out of order or out of range")
+        result.extend(base_lines[position:start])
+        position = start
+        previous = None
+        for line in hunk:
+            if line.line_type == LINE_TYPE_NO_NEWLINE:
+                # The line before this marker has no trailing newline on its side of the diff
+                if previous is not None and previous[-1].endswith(b"\n"):
+                    previous[-1] = previous[-1][:-1]
+                continue
+            value = line.value.encode(*PATCH_ENCODING)
+            if line.line_type in (LINE_TYPE_CONTEXT, LINE_TYPE_REMOVED):
+                if position >= len(base_lines) or base_lines[position].rstrip(b"\r\n") != value.rstrip(b"\r\n"):
+                    raise PatchError(f"{patched_file.path}: line {position + 1} does not match the patch")
+                if line.line_type == LINE_TYPE_CONTEXT:
+                    result.append(base_lines[position])
+                    previous = result
+                else:
+                    previous = [value]
+                position += 1
+            elif line.line_type == LINE_TYPE_ADDED:
+                result.append(value)
+                previous = result
+    result.extend(base_lines[position:])
+    content = b"".join(result)
+
+    if not _matches(content, new_id):
+        raise PatchError(f"{patched_file.path}: rebuilt content does not match blob {new_id}")
+    return content
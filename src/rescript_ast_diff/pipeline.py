@@ -0,0 +1,199 @@
+import functools
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+from tree_sitter import Parser
+
+from rescript_ast_diff import metrics
+from rescript_ast_diff.cache import DeclarationCache, cache_key, git_blob_id, open_cache
+from rescript_ast_diff.differ import RescriptFileDiff, rescript_language
+from rescript_ast_diff.edits import edit_entry
+from rescript_ast_diff.incremental import compare_incremental
+from rescript_ast_diff.renames import sketch_changes
+
+# One warm parser (and cache handle) per process; set up by the pool initializer or lazily in-process
+_parser: Optional[Parser] = None
+_cache: Optional[DeclarationCache] = None
+_hunk_mode = "incremental"
+
+
+def init_worker(cache_dir: Optional[str] = None, cache_max_bytes: Optional[int] = None, hunk_mode: str = "incremental"):
+    global _parser, _cache, _hunk_mode
+    if _parser is None:
+        _parser = Parser(rescript_language())
+    _cache = open_cache(cache_dir, cache_max_bytes)
+    _hunk_mode = hunk_mode
+
+
+def get_parser() -> Parser:
+    if _parser is None:
+        init_worker()
+    return _parser
+
+
+def parse(content: bytes):
+    with metrics.span("parse"):
+        return get_parser().parse(content)
+
+
+def get_components(diff: RescriptFileDiff, content: bytes):
+    """Extract declarations from file content, through the declaration cache when one is configured"""
+    if _cache is None:
+        return diff.extract_components(parse(content).root_node)
+    blob_id = cache_key(git_blob_id(content), diff.ignore_formatting)
+    components = _cache.get(blob_id)
+    if components is None:
+        components = diff.extract_components(parse(content).root_node)
+        _cache.put(blob_id, components)
+    return components
+
+
+def _to_builtin(value):
+    # tree-sitter Points are not picklable, so results crossing process boundaries use plain tuples
+    if isinstance(value, dict):
+        return {key: _to_builtin(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_to_builtin(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_to_builtin(item) for item in value)
+    return value
+
+
+def get_incremental_changes(diff: RescriptFileDiff, old_content: bytes, new_content: bytes, hunks):
+    """Diff a modified file by reparsing the new side from the old tree, unless the cache already has it"""
+    if _cache is not None:
+        new_components = _cache.get(cache_key(git_blob_id(new_content), diff.ignore_formatting))
+        if new_components is not None:
+            return diff.compare_components(get_components(diff, old_content), new_components)
+    with metrics.span("incremental"):
+        changes, old_components, new_components = compare_incremental(diff, get_parser(), old_content, new_content, hunks)
+    if _cache is not None:
+        _cache.put(cache_key(git_blob_id(old_content), diff.ignore_formatting), old_components)
+        _cache.put(cache_key(git_blob_id(new_content), diff.ignore_formatting), new_components)
+    return changes
+
+
+def diff_file(job: Tuple[str, str, Optional[bytes], Optional[bytes], Optional[list]], hunk_mode: Optional[str] = None, detect_renames: bool = False, edit_scripts: bool = False, ignore_formatting: bool = False) -> dict:
+    """
+    Parse and diff one file. job is (mode, file_path, old_content, new_content, hunks); hunks may be None.
+    A "renamed" file is compared like a modified one. hunk_mode overrides the worker's default, so
+    one pool can serve runs in different modes. With detect_renames the result also carries
+    "sketches" of the added and deleted declarations for a DeclarationMatcher. With edit_scripts
+    modified* entries carry a tree edit script (see edits.EditScript) instead of both bodies. With
+    ignore_formatting, declarations that differ only in layout or comments are not modified.
+    """
+    mode, file_path, old_content, new_content, hunks = job
+    diff = RescriptFileDiff(file_path, ignore_formatting=ignore_formatting)
+    with metrics.file_span(file_path, mode):
+        if mode == "modified" and hunks is not None and (hunk_mode or _hunk_mode) == "directed":
+            changes = diff.compare_two_files(parse(old_content), parse(new_content), hunks=hunks, old_content=old_content, new_content=new_content)
+        elif mode == "modified" and hunks is not None:
+            changes = get_incremental_changes(diff, old_content, new_content, hunks)
+        elif mode in ("modified", "renamed"):
+            changes = diff.compare_components(get_components(diff, old_content), get_components(diff, new_content))
+        elif mode == "added":
+            changes = diff.process_single_components(get_components(diff, new_content), mode="added")
+        else:
+            changes = diff.process_single_components(get_components(diff, old_content), mode="deleted")
+        result = changes.to_dict(functools.partial(edit_entry, parse=parse)) if edit_scripts else changes.to_dict()
+        if detect_renames:
+            with metrics.span("sketch"):
+                result["sketches"] = sketch_changes(changes, parse)
+        return _to_builtin(result)
+
+
+def diff_file_measured(job, hunk_mode: Optional[str] = None, detect_renames: bool = False, edit_scripts: bool = False, ignore_formatting: bool = False) -> Tuple[dict, dict]:
+    """diff_file in a pool worker with metrics on; returns the changes and the worker's measurements"""
+    recorder = metrics.enable()
+    try:
+        return diff_file(job, hunk_mode, detect_renames, edit_scripts, ignore_formatting), recorder.snapshot()
+    finally:
+        metrics.disable()
+
+
+class DiffPipeline:
+    """
+    Overlaps I/O-bound fetches (thread pool) with CPU-bound parse/extract (process pool).
+
+    `fetch(mode, file_path)` returns the (old_content, new_content) bytes for a file, with None
+    for the side that does not exist. Results are yielded in task order regardless of which
+    worker finishes first. With parse_workers <= 1 parsing happens in the calling process.
+    With cache_dir set, every worker looks declarations up in a shared DeclarationCache first.
+    With hunks (file_path -> changed line ranges) set, modified files are either reparsed
+    incrementally (hunk_mode="incremental") or only have the declarations overlapping a hunk
+    compared (hunk_mode="directed"). A long-lived caller can pass its own warm parse_pool (whose
+    workers were set up with init_worker) instead of having each run spawn one. With
+    detect_renames every result carries the "sketches" that DeclarationMatcher pairs up, and with
+    edit_scripts modified declarations are reported as edit scripts. ignore_formatting compares
+    declarations by their normalized fingerprint, so no formatter needs to run beforehand.
+    """
+
+    def __init__(self, fetch: Callable[[str, str], Tuple[Optional[bytes], Optional[bytes]]], fetch_workers: int = 8, parse_workers: int = 1, cache_dir: Optional[str] = None, cache_max_bytes: Optional[int] = None, hunks: Optional[dict] = None, hunk_mode: str = "incremental", parse_pool: Optional[ProcessPoolExecutor] = None, detect_renames: bool = False, edit_scripts: bool = False, ignore_formatting: bool = False):
+        self.fetch = fetch
+        self.fetch_workers = max(fetch_workers, 1)
+        self.parse_workers = max(parse_workers, 1)
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.hunks = hunks
+        self.hunk_mode = hunk_mode
+        self.detect_renames = detect_renames
+        self.edit_scripts = edit_scripts
+        self.ignore_formatting = ignore_formatting
+        self.parse_pool = parse_pool
+
+    def run(self, tasks: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str, dict]]:
+        """Yield (mode, file_path, changes_dict) for every (mode, file_path) task, in order"""
+        tasks = iter(tasks)
+        # Bound the number of files held in memory at once
+        window = self.fetch_workers + 2 * self.parse_workers
+
+        with ExitStack() as stack:
+            fetch_pool = stack.enter_context(ThreadPoolExecutor(max_workers=self.fetch_workers))
+            parse_pool = self.parse_pool
+            if parse_pool is None and self.parse_workers <= 1:
+                init_worker(self.cache_dir, self.cache_max_bytes, self.hunk_mode)
+            elif parse_pool is None:
+                # Workers are spawned rather than forked: jobs are submitted from fetch threads
+                parse_pool = stack.enter_context(ProcessPoolExecutor(
+                    max_workers=self.parse_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_worker,
+                    initargs=(self.cache_dir, self.cache_max_bytes, self.hunk_mode),
+                ))
+
+            # Workers only measure (and ship their numbers back) when this process is recording
+            measured = metrics.enabled()
+
+            def fetch_and_submit(task):
+                mode, file_path = task
+                with metrics.span("fetch"):
+                    old_content, new_content = self.fetch(mode, file_path)
+                hunks = self.hunks.get(file_path) if self.hunks is not None and mode == "modified" else None
+                job = (mode, file_path, old_content, new_content, hunks)
+                # Hand the job to a parse worker straight from the fetch thread
+                if parse_pool is None:
+                    return job
+                if measured:
+                    return parse_pool.submit(diff_file_measured, job, self.hunk_mode, self.detect_renames, self.edit_scripts, self.ignore_formatting)
+                return parse_pool.submit(diff_file, job, self.hunk_mode, self.detect_renames, self.edit_scripts, self.ignore_formatting)
+
+            in_flight = deque(
+                (task, fetch_pool.submit(fetch_and_submit, task)) for task in itertools.islice(tasks, window)
+            )
+            while in_flight:
+                (mode, file_path), future = in_flight.popleft()
+                submitted = future.result()
+                for task in itertools.islice(tasks, 1):
+                    in_flight.append((task, fetch_pool.submit(fetch_and_submit, task)))
+                if parse_pool is None:
+                    changes = diff_file(submitted, self.hunk_mode, self.detect_renames, self.edit_scripts, self.ignore_formatting)
+                elif measured:
+                    changes, worker_metrics = submitted.result()
+                    metrics.current().merge(worker_metrics)
+                else:
+                    changes = submitted.result()
+                yield mode, file_path, changes
@@ -0,0 +1,93 @@
+import os
+from typing import Dict, List, Set, Tuple
+
+from tree_sitter import Node
+
+from rescript_ast_diff.differ import RescriptFileDiff
+
+# A reference as (target_module, target_name). LOCAL_MODULE stands for the declaring file's own
+# module, which is not known from the blob alone.
+Reference = Tuple[str, str]
+LOCAL_MODULE = ""
+
+PATH_TYPES = ("value_identifier_path", "type_identifier_path")
+JSX_TAG_PARENTS = ("jsx_opening_element", "jsx_self_closing_element")
+JSX_TAG_TYPES = ("module_identifier", "nested_jsx_identifier", "module_identifier_path")
+
+
+def module_name(file_path: str) -> str:
+    """The module a .res file defines, as code refers to it: `logicUtils.res` -> LogicUtils, `api_utils.res` -> Api_utils"""
+    base = os.path.basename(file_path)
+    if base.endswith(".res"):
+        base = base[:-len(".res")]
+    return base[:1].upper() + base[1:]
+
+
+def _path_reference(text: str) -> Reference:
+    """`Foo.bar` -> (Foo, bar); `Foo.Sub.bar` -> (Foo, Sub::bar), matching how nested declarations are named"""
+    segments = [segment.strip() for segment in text.split(".") if segment.strip()]
+    if len(segments) >= 3:
+        return segments[0], f"{segments[-2]}::{segments[-1]}"
+    return segments[0], segments[-1]
+
+
+def _opened_module(node: Node) -> str:
+    # `open Foo`, `open! Foo.Bar`, `include Foo` -> Foo
+    for child in node.children:
+        if child.is_named:
+            return child.text.decode(errors="ignore").split(".")[0].strip()
+    return ""
+
+
+def declaration_references(node: Node) -> Tuple[Set[Reference], Set[str]]:
+    """Qualified references (Module.name, and <Module /> as Module.make) and bare identifiers used in a subtree"""
+    qualified, bare = set(), set()
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        node_type = current.type
+        if node_type in PATH_TYPES:
+            text = current.text.decode(errors="ignore")
+            if "." in text:
+                qualified.add(_path_reference(text))
+            continue
+        if node_type in JSX_TAG_TYPES and current.parent is not None and current.parent.type in JSX_TAG_PARENTS:
+            qualified.add((current.text.decode(errors="ignore").split(".")[0], "make"))
+            continue
+        if node_type == "value_identifier":
+            bare.add(current.text.decode(errors="ignore"))
+            continue
+        stack.extend(current.children)
+    return qualified, bare
+
+
+def extract_references(diff: RescriptFileDiff, root: Node) -> Dict[str, List[Reference]]:
+    """
+    References made by each declaration of a file, keyed by its (qualified) name.
+
+    Bare identifiers can only be resolved by name, so each one is recorded both against the file's
+    own module and against every module the file opens or includes. That over-approximates, which
+    is the safe direction for impact analysis.
+    """
+    opened = []
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        if current.type in ("open_statement", "include_statement"):
+            module = _opened_module(current)
+            if module:
+                opened.append(module)
+            continue
+        stack.extend(child for child in current.children if child.is_named)
+
+    references = {}
+    for node, name in diff.declarations(root):
+        qualified, bare = declaration_references(node)
+        targets = set(qualified)
+        for identifier in bare:
+            if identifier == name:
+                continue
+            targets.add((LOCAL_MODULE, identifier))
+            targets.update((module, identifier) for module in opened)
+        references.setdefault(diff.qualified_name(node, name), []).extend(sorted(targets))
+    return references
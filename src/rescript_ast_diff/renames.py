@@ -0,0 +1,183 @@
+import hashlib
+import re
+import struct
+from collections import defaultdict
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from rescript_ast_diff.differ import Declaration, DetailedChanges, structural_hash
+
+# (kind, attribute on DetailedChanges holding the added and deleted declarations of that kind)
+DECLARATION_KINDS = (
+    ("function", "addedFunctions", "deletedFunctions"),
+    ("type", "addedTypes", "deletedTypes"),
+    ("external", "addedExternals", "deletedExternals"),
+)
+
+# Each salted blake2b digest supplies 16 independent 32-bit hash functions
+_HASHES_PER_DIGEST = 16
+_salted_hashers = [hashlib.blake2b(digest_size=64, salt=block.to_bytes(16, "little")) for block in range(16)]
+
+
+def minhash(tokens: Iterable[bytes], num_perm: int = 64) -> Tuple[int, ...]:
+    """MinHash signature of a token set; the fraction of equal positions estimates Jaccard similarity"""
+    tokens = set(tokens)
+    if not tokens:
+        return ()
+    blocks = -(-num_perm // _HASHES_PER_DIGEST)
+    if blocks > len(_salted_hashers):
+        raise ValueError(f"num_perm can be at most {len(_salted_hashers) * _HASHES_PER_DIGEST}")
+    layout = struct.Struct(f"<{blocks * _HASHES_PER_DIGEST}I")
+    rows = []
+    for token in tokens:
+        digests = []
+        for hasher in _salted_hashers[:blocks]:
+            hasher = hasher.copy()
+            hasher.update(token)
+            digests.append(hasher.digest())
+        rows.append(layout.unpack(b"".join(digests)))
+    return tuple(map(min, zip(*rows)))[:num_perm]
+
+
+def shape_hash(kind: str, name: str, body: str) -> str:
+    """Hash of a declaration's text with its own name blanked out, so pure renames collide"""
+    identifier = name.rsplit("::", 1)[-1]
+    masked = re.sub(rf"\b{re.escape(identifier)}\b", "", body, count=1)
+    return hashlib.blake2b(f"{kind}\0{masked}".encode(), digest_size=16).hexdigest()
+
+
+def subtree_tokens(decl: Declaration, parse: Optional[Callable[[bytes], object]] = None) -> List[bytes]:
+    """
+    Digests of every subtree of a declaration. A rename only changes the digests on the path from
+    the name to the root, so the sets of two versions of a declaration stay largely equal.
+    Declarations restored from the cache carry no tree; their body is reparsed with `parse`.
+    """
+    hashes = {}
+    if decl.node is not None:
+        structural_hash(decl.node, decl.source, decl.base, subtree_hashes=hashes)
+    elif parse is not None:
+        source = decl.body.encode()
+        root = parse(source).root_node
+        for child in root.children:
+            structural_hash(child, source, 0, subtree_hashes=hashes)
+    return list(hashes.values())
+
+
+def sketch(decl: Declaration, kind: str, module: str, parse=None, num_perm: int = 64) -> dict:
+    """Everything the matcher needs about one added or deleted declaration, small enough to ship between processes"""
+    name, body, span = decl.to_entry()
+    return {
+        "module": module,
+        "kind": kind,
+        "name": name,
+        "fingerprint": decl.fingerprint if isinstance(decl.fingerprint, str) else hashlib.blake2b(body.encode(), digest_size=16).hexdigest(),
+        "shape": shape_hash(kind, name, body),
+        "signature": list(minhash(subtree_tokens(decl, parse), num_perm)),
+        "body": body,
+        "start": span["start"],
+        "end": span["end"],
+    }
+
+
+def sketch_changes(changes: DetailedChanges, parse=None, num_perm: int = 64) -> dict:
+    """{"added": [...], "deleted": [...]} sketches for a module's added and deleted declarations"""
+    sketches = {"added": [], "deleted": []}
+    for kind, added_attribute, deleted_attribute in DECLARATION_KINDS:
+        sketches["added"] += [sketch(decl, kind, changes.moduleName, parse, num_perm) for decl in getattr(changes, added_attribute)]
+        sketches["deleted"] += [sketch(decl, kind, changes.moduleName, parse, num_perm) for decl in getattr(changes, deleted_attribute)]
+    return sketches
+
+
+class DeclarationMatcher:
+    """
+    Pairs deleted declarations with added ones, across every module of a run, as moves or renames.
+
+    Candidates are found in three passes, each only over what the previous ones left unpaired:
+    identical text (fingerprint), identical text apart from the name (shape hash), and finally
+    MinHash signatures bucketed with locality-sensitive hashing, so only declarations sharing a
+    band of their signature are ever compared. Near-matches need an estimated similarity of at
+    least `threshold`. A pair is "renamed" when the name changed and "moved" otherwise.
+    """
+
+    def __init__(self, threshold: float = 0.8, bands: int = 16):
+        self.threshold = threshold
+        self.bands = bands
+        self.added: List[dict] = []
+        self.deleted: List[dict] = []
+
+    def add(self, sketches: dict):
+        self.added.extend(sketches["added"])
+        self.deleted.extend(sketches["deleted"])
+
+    def _pair_exact(self, key: str, taken_old: set, taken_new: set, pairs: list):
+        buckets = defaultdict(list)
+        for index, added in enumerate(self.added):
+            if index not in taken_new:
+                buckets[(added["kind"], added[key])].append(index)
+        for old_index, deleted in enumerate(self.deleted):
+            if old_index in taken_old:
+                continue
+            candidates = buckets.get((deleted["kind"], deleted[key]))
+            if candidates:
+                new_index = candidates.pop(0)
+                taken_old.add(old_index)
+                taken_new.add(new_index)
+                pairs.append((old_index, new_index, 1.0))
+
+    def _pair_similar(self, taken_old: set, taken_new: set, pairs: list):
+        buckets = defaultdict(list)
+        for index, added in enumerate(self.added):
+            signature = added["signature"]
+            if index in taken_new or not signature:
+                continue
+            rows = max(len(signature) // self.bands, 1)
+            for band in range(0, len(signature), rows):
+                buckets[(added["kind"], band, tuple(signature[band:band + rows]))].append(index)
+
+        candidates = []
+        for old_index, deleted in enumerate(self.deleted):
+            signature = deleted["signature"]
+            if old_index in taken_old or not signature:
+                continue
+            rows = max(len(signature) // self.bands, 1)
+            seen = set()
+            for band in range(0, len(signature), rows):
+                for new_index in buckets.get((deleted["kind"], band, tuple(signature[band:band + rows])), ()):
+                    if new_index in seen:
+                        continue
+                    seen.add(new_index)
+                    other = self.added[new_index]["signature"]
+                    if len(other) != len(signature):
+                        continue
+                    similarity = sum(a == b for a, b in zip(signature, other)) / len(signature)
+                    if similarity >= self.threshold:
+                        candidates.append((similarity, old_index, new_index))
+
+        # Best matches first; each declaration takes part in at most one pair
+        for similarity, old_index, new_index in sorted(candidates, key=lambda candidate: (-candidate[0], candidate[1], candidate[2])):
+            if old_index in taken_old or new_index in taken_new:
+                continue
+            taken_old.add(old_index)
+            taken_new.add(new_index)
+            pairs.append((old_index, new_index, similarity))
+
+    def match(self) -> List[dict]:
+        """Move/rename records, ordered by the old module and name"""
+        taken_old, taken_new, pairs = set(), set(), []
+        self._pair_exact("fingerprint", taken_old, taken_new, pairs)
+        self._pair_exact("shape", taken_old, taken_new, pairs)
+        self._pair_similar(taken_old, taken_new, pairs)
+
+        def side(entry):
+            return {"module": entry["module"], "name": entry["name"], "body": entry["body"], "start": entry["start"], "end": entry["end"]}
+
+        records = []
+        for old_index, new_index, similarity in pairs:
+            old, new = self.deleted[old_index], self.added[new_index]
+            records.append({
+                "kind": old["kind"],
+                "change": "renamed" if old["name"].rsplit("::", 1)[-1] != new["name"].rsplit("::", 1)[-1] else "moved",
+                "similarity": round(similarity, 3),
+                "old": side(old),
+                "new": side(new),
+            })
+        return sorted(records, key=lambda record: (record["old"]["module"], record["old"]["name"], record["new"]["module"], record["new"]["name"]))
@@ -0,0 +1,226 @@
+import json
+import multiprocessing
+import os
+import signal
+import socketserver
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from rescript_ast_diff.bitbucket import BitBucket
+from rescript_ast_diff.compare_commits import check_deadline, iter_pr_changes
+from rescript_ast_diff.gitwrapper import GitWrapper
+from rescript_ast_diff.pipeline import get_parser, init_worker
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+def warm_worker() -> int:
+    # Forces the initializer and the grammar load to happen before the first real request
+    get_parser()
+    return os.getpid()
+
+
+class DiffService:
+    """
+    Resident state for serving diff requests: a pool of parser processes that stay warm between
+    requests, plus the long-lived git cat-file pipe or Bitbucket session and the declaration cache.
+
+    At most max_concurrent requests run at once and at most max_queue are accepted (running or
+    waiting); beyond that submit() raises ServiceBusy straight away. Each request has `timeout`
+    seconds from arrival, after which it raises TimeoutError; the work behind it notices the same
+    deadline at its next stage or file and stops. A request counts as pending until that work has
+    actually stopped, so abandoned requests still hold their place in the queue.
+    """
+
+    def __init__(self, bitbucket_object: BitBucket = None, gitclient_object: GitWrapper = None, parse_workers: int = 2, fetch_workers: int = 8, cache_dir: Optional[str] = None, cache_max_bytes: Optional[int] = None, max_concurrent: int = 4, max_queue: int = 32, timeout: float = 30.0):
+        if not bitbucket_object and not gitclient_object:
+            raise ValueError("DiffService needs a BitBucket or a GitWrapper")
+        self.bitbucket_object = bitbucket_object
+        self.gitclient_object = gitclient_object
+        self.fetch_workers = fetch_workers
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+        self._requests = ThreadPoolExecutor(max_workers=max_concurrent)
+        # Requests run on threads, and tree-sitter parsers must not be shared across threads, so
+        # parsing always happens in the pool even with a single worker
+        self.parse_workers = max(parse_workers, 1)
+        self._parse_pool = ProcessPoolExecutor(
+            max_workers=self.parse_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(cache_dir, cache_max_bytes),
+        )
+
+    def start(self):
+        """Spawn every parser worker and load the grammar before accepting requests"""
+        futures = [self._parse_pool.submit(warm_worker) for _ in range(self.parse_workers)]
+        for future in futures:
+            future.result()
+
+    def _diff(self, request: dict, deadline: float) -> list:
+        changes = []
+        for _, _, file_changes in iter_pr_changes(
+            self.bitbucket_object,
+            self.gitclient_object,
+            pr_id=request.get("pr_id"),
+            fromBranch=request.get("from_branch"),
+            toBranch=request.get("to_branch"),
+            fetch_workers=self.fetch_workers,
+            incremental=bool(request.get("incremental")),
+            hunk_directed=bool(request.get("hunk_directed")),
+            edit_scripts=bool(request.get("edit_scripts")),
+            patch_heads=bool(request.get("patch_heads")),
+            ignore_formatting=bool(request.get("ignore_formatting")),
+            cache_dir=self.cache_dir,
+            cache_max_bytes=self.cache_max_bytes,
+            parse_pool=self._parse_pool,
+            deadline=deadline,
+        ):
+            # A request that already timed out stops at the next file instead of running to the end
+            check_deadline(deadline, "diff")
+            changes.append(file_changes)
+        return changes
+
+    def submit(self, request: dict) -> list:
+        """Run one diff request; returns the list of per-module change records"""
+        if not request.get("pr_id") and not (request.get("from_branch") and request.get("to_branch")):
+            raise ValueError("Expected 'pr_id' or both 'from_branch' and 'to_branch'")
+        if request.get("pr_id") and not self.bitbucket_object:
+            raise ValueError("'pr_id' needs a Bitbucket-backed server")
+
+        with self._pending_lock:
+            if self.pending >= self.max_queue:
+                raise ServiceBusy(f"{self.pending} requests already queued")
+            self.pending += 1
+        try:
+            timeout = float(request.get("timeout") or self.timeout)
+            deadline = time.monotonic() + timeout
+            future = self._requests.submit(self._diff, request, deadline)
+        except BaseException:
+            self._release()
+            raise
+        # Released when _diff really finishes (or is cancelled before it starts), not when we stop waiting
+        future.add_done_callback(lambda _: self._release())
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError(f"request did not finish within {timeout}s")
+
+    def _release(self):
+        with self._pending_lock:
+            self.pending -= 1
+
+    def close(self):
+        """Let accepted requests finish, then stop the workers and release the repository handles"""
+        self._requests.shutdown(wait=True)
+        self._parse_pool.shutdown(wait=True)
+        if self.gitclient_object:
+            self.gitclient_object.close()
+        if self.bitbucket_object:
+            self.bitbucket_object.close()
+
+
+class DiffRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /health -> {"status": "ok", "pending": n}
+    POST /diff with {"pr_id": ...} or {"from_branch": ..., "to_branch": ...}, optionally
+    "incremental", "hunk_directed", "edit_scripts", "patch_heads", "ignore_formatting" and "timeout" -> {"changes": [DetailedChanges.to_dict()...]}
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Idle keep-alive connections are dropped after this many seconds, so they never hold up shutdown
+    timeout = 5
+
+    def address_string(self):
+        # Unix-socket peers have no (host, port) address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        self.send_json(200, {"status": "ok", "pending": self.server.service.pending})
+
+    def do_POST(self):
+        if self.path != "/diff":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("Expected a JSON object")
+            changes = self.server.service.submit(request)
+        except (ValueError, json.JSONDecodeError) as e:
+            self.send_json(400, {"error": str(e)})
+        except ServiceBusy as e:
+            self.send_json(503, {"error": str(e)})
+        except TimeoutError as e:
+            self.send_json(504, {"error": str(e)})
+        except Exception as e:
+            print("ERROR - ", e)
+            print(traceback.format_exc())
+            self.send_json(500, {"error": str(e)})
+        else:
+            self.send_json(200, {"changes": changes})
+
+
+class DiffHTTPServer(ThreadingHTTPServer):
+    # Handler threads are joined on close so in-flight responses are not cut off at shutdown
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, address, service: DiffService):
+        self.service = service
+        super().__init__(address, DiffRequestHandler)
+
+
+class DiffUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, socket_path: str, service: DiffService):
+        self.service = service
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, DiffRequestHandler)
+
+
+def serve(service: DiffService, host: str = "127.0.0.1", port: int = 8765, socket_path: Optional[str] = None):
+    """Serve until SIGINT/SIGTERM, then stop accepting, drain in-flight requests and shut down"""
+    service.start()
+    server = DiffUnixServer(socket_path, service) if socket_path else DiffHTTPServer((host, port), service)
+
+    def stop(signum, frame):
+        # shutdown() blocks until serve_forever returns, so it cannot run on the serving thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print("Serving on -", socket_path or f"http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+    print("Server stopped")
@@ -0,0 +1,144 @@
+import heapq
+import json
+import os
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from rescript_ast_diff.output import OUTPUT_FILE_NAMES, ChangesWriter
+from rescript_ast_diff.renames import DeclarationMatcher
+
+MANIFEST_FILE_NAME = "shard.json"
+
+Task = Tuple[str, str]
+
+
+class Shard:
+    """
+    One of `count` slices of a run's (mode, file_path) tasks, numbered from 1.
+
+    Every shard of a run sees the same task list and the same weights, so each can compute the
+    whole partition on its own: tasks are handed out heaviest first (ties broken by mode and
+    path) to whichever shard has the least weight so far. select() remembers the full task
+    order, which the shard's manifest carries so that merge_shards can restore it.
+    """
+
+    def __init__(self, index: int, count: int):
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError(f"Shard {index}/{count} out of range, expected 1 <= i <= N")
+        self.index = index
+        self.count = count
+        self.tasks: List[Task] = []
+        self.selected: List[Task] = []
+
+    @classmethod
+    def parse(cls, value: str) -> "Shard":
+        """Shard from "i/N", e.g. "2/8" """
+        index, separator, count = value.partition("/")
+        if not separator or not index.isdigit() or not count.isdigit():
+            raise ValueError(f"Expected a shard as i/N, got '{value}'")
+        return cls(int(index), int(count))
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+    def select(self, tasks: Sequence[Task], weight: Callable[[str, str], int]) -> List[Task]:
+        """This shard's tasks, in their original order; weight(mode, file_path) is typically a size in bytes"""
+        self.tasks = list(tasks)
+        # Empty files still cost a parse, so nothing weighs less than 1
+        weighted = sorted(((-max(weight(mode, file_path), 1), mode, file_path) for mode, file_path in self.tasks))
+        loads = [(0, shard) for shard in range(1, self.count + 1)]
+        mine = set()
+        for negative_weight, mode, file_path in weighted:
+            load, shard = heapq.heappop(loads)
+            if shard == self.index:
+                mine.add((mode, file_path))
+            heapq.heappush(loads, (load - negative_weight, shard))
+        self.selected = [task for task in self.tasks if task in mine]
+        return self.selected
+
+    def manifest(self, **extra) -> dict:
+        return {"shard": self.index, "shards": self.count, "tasks": self.tasks, "selected": self.selected, **extra}
+
+
+def write_manifest(output_dir: str, manifest: dict) -> str:
+    path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+    with open(path + ".partial", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".partial", path)
+    return path
+
+
+def _read_records(shard_dir: str, output_format: str) -> list:
+    with open(os.path.join(shard_dir, OUTPUT_FILE_NAMES[output_format])) as f:
+        if output_format == "ndjson":
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def merge_shards(shard_dirs: Sequence[str], output_dir: str = "./", output_format: Optional[str] = None) -> str:
+    """
+    Combine the outputs of every shard of a run into the detailed_changes file a single run
+    would have written, byte for byte, and the same declaration_moves.json when the shards were
+    run with rename detection. Raises ValueError unless the shards are exactly 1..N of one run,
+    all diffed at the same pair of commits.
+    """
+    manifests = []
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, MANIFEST_FILE_NAME)) as f:
+            manifests.append((json.load(f), shard_dir))
+    if not manifests:
+        raise ValueError("No shards to merge")
+    manifests.sort(key=lambda entry: entry[0]["shard"])
+
+    first = manifests[0][0]
+    for manifest, shard_dir in manifests:
+        if "from_commit" not in manifest or "to_commit" not in manifest:
+            raise ValueError(f"{shard_dir} does not record the commits it diffed")
+        if (manifest["from_commit"], manifest["to_commit"]) != (first["from_commit"], first["to_commit"]):
+            raise ValueError(
+                f"{shard_dir} diffed {manifest['from_commit']}..{manifest['to_commit']}, "
+                f"not {first['from_commit']}..{first['to_commit']} like shard {first['shard']}"
+            )
+    run_keys = [key for key in first if key not in ("shard", "selected", "format", "sketches")]
+    for manifest, shard_dir in manifests:
+        mismatched = [key for key in run_keys if manifest.get(key) != first[key]]
+        if mismatched:
+            raise ValueError(f"{shard_dir} is from a different run ({', '.join(mismatched)} differ)")
+    indexes = [manifest["shard"] for manifest, _ in manifests]
+    if indexes != list(range(1, first["shards"] + 1)):
+        raise ValueError(f"Expected shards 1..{first['shards']} exactly once, got {indexes}")
+
+    records: Dict[Tuple[str, str], dict] = {}
+    sketches: Dict[Tuple[str, str], dict] = {}
+    for manifest, shard_dir in manifests:
+        shard_records = _read_records(shard_dir, manifest["format"])
+        selected = [tuple(task) for task in manifest["selected"]]
+        if len(shard_records) != len(selected):
+            raise ValueError(f"{shard_dir} holds {len(shard_records)} records for {len(selected)} files; the shard did not finish")
+        # Shards that weighed files differently (say, against different revisions) overlap
+        overlapping = [file_path for mode, file_path in selected if (mode, file_path) in records]
+        if overlapping:
+            raise ValueError(f"{shard_dir} repeats {', '.join(overlapping)} from another shard")
+        records.update(zip(selected, shard_records))
+        if "sketches" in manifest:
+            sketches.update(zip(selected, manifest["sketches"]))
+
+    tasks = [tuple(task) for task in first["tasks"]]
+    missing = [file_path for mode, file_path in tasks if (mode, file_path) not in records]
+    if missing:
+        raise ValueError(f"No shard produced {', '.join(missing)}")
+
+    with ChangesWriter(output_dir, output_format or first["format"]) as writer:
+        for task in tasks:
+            writer.write(records[task])
+    print("Changes written to - ", writer.output_path)
+
+    if "rename_threshold" in first:
+        # Renames pair declarations across modules, so they can only be matched once every shard is in
+        matcher = DeclarationMatcher(threshold=first["rename_threshold"])
+        for task in tasks:
+            matcher.add(sketches[task])
+        with ChangesWriter(output_dir, "json", file_name="declaration_moves.json") as moves_writer:
+            for record in matcher.match():
+                moves_writer.write(record)
+        print("Moves and renames written to - ", moves_writer.output_path)
+    return writer.output_path
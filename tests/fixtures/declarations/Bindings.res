@@ -0,0 +1,17 @@
+@module("path") external join: (string, string) => string = "join"
+
+@val external setTimeout: (unit => unit, int) => float = "setTimeout"
+
+external log: 'a => unit = "console.log"
+
+@scope("JSON") @val
+external parse: string => Js.Json.t = "parse"
+
+type options = {
+  timeout: int,
+  retries: option<int>,
+}
+
+let defaultOptions = {timeout: 1000, retries: None}
+
+let withTimeout = (options, timeout) => {...options, timeout}
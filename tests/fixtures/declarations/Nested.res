@@ -0,0 +1,38 @@
+open Belt
+
+type id = string
+
+module Api = {
+  type response = {status: int, body: string}
+
+  external fetch: string => promise<response> = "fetch"
+
+  let get = async url => {
+    let response = await fetch(url)
+    response.body
+  }
+
+  module Retry = {
+    let attempts = 3
+
+    let rec run = (task, remaining) =>
+      remaining <= 0 ? task() : run(task, remaining - 1)
+  }
+}
+
+module Cache = {
+  let store: Js.Dict.t<string> = Js.Dict.empty()
+
+  let lookup = key => store->Js.Dict.get(key)
+}
+
+module type Store = {
+  let lookup: string => option<string>
+}
+
+let make = (~items: array<id>) => {
+  let count = items->Array.length
+  <div> {React.int(count)} </div>
+}
+
+let total = [1, 2, 3]->Array.reduce(0, (sum, item) => sum + item)
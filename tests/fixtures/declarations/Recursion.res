@@ -0,0 +1,35 @@
+let rec even = n =>
+  if n == 0 {
+    true
+  } else {
+    odd(n - 1)
+  }
+and odd = n =>
+  if n == 0 {
+    false
+  } else {
+    even(n - 1)
+  }
+
+let rec length = list =>
+  switch list {
+  | list{} => 0
+  | list{_, ...rest} => 1 + length(rest)
+  }
+
+type rec tree<'a> =
+  | Leaf
+  | Node(tree<'a>, 'a, tree<'a>)
+
+type rec expression =
+  | Literal(int)
+  | Block(statement)
+and statement =
+  | Return(expression)
+  | Sequence(array<statement>)
+
+let rec depth = tree =>
+  switch tree {
+  | Leaf => 0
+  | Node(left, _, right) => 1 + max(depth(left), depth(right))
+  }
@@ -0,0 +1,144 @@
+import json
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from rescript_ast_diff.cache import (
+    ContentCache,
+    DeclarationCache,
+    cache_key,
+    components_to_record,
+    fcntl,
+    git_blob_id,
+    record_to_components,
+)
+from rescript_ast_diff.differ import Declaration
+
+
+def components_for(key: str, size: int = 1):
+    """Deterministic components per key, so any reader can tell whether an entry is intact"""
+    body = f"let {key[:6]} = \"{'x' * size}\""
+    declaration = Declaration(f"f{key[:6]}", None, None, 0, 0, len(body), (0, 0), (0, len(body)), key, body=body)
+    return {declaration.name: declaration}, {}, {}
+
+
+def entry_paths(cache: DeclarationCache):
+    return sorted(path for _, _, path in cache._entries())
+
+
+def test_round_trip_and_counters(tmp_path):
+    cache = DeclarationCache(str(tmp_path))
+    key = git_blob_id(b"let a = 1\n")
+    assert cache.get(key) is None
+    cache.put(key, components_for(key))
+    restored = DeclarationCache(str(tmp_path)).get(key)
+    assert components_to_record(restored) == components_to_record(components_for(key))
+    assert components_to_record(record_to_components(components_to_record(restored))) == components_to_record(restored)
+    assert (cache.hits, cache.misses) == (0, 1)
+    # Exact and normalized fingerprints never share an entry
+    assert cache.get(cache_key(key, ignore_formatting=True)) is None
+
+
+def test_damaged_or_vanished_entries_are_misses(tmp_path):
+    cache = DeclarationCache(str(tmp_path))
+    cache.put("ab" * 20, components_for("ab" * 20))
+    path = entry_paths(cache)[0]
+    with open(path, "r+b") as f:
+        f.truncate(5)
+    assert cache.get("ab" * 20) is None
+    os.unlink(path)
+    assert cache.get("ab" * 20) is None
+    assert cache.misses == 2
+
+
+def test_writes_leave_no_temporary_files(tmp_path):
+    cache = DeclarationCache(str(tmp_path))
+    for index in range(20):
+        key = f"{index:040x}"
+        cache.put(key, components_for(key))
+        cache.put(key, components_for(key))
+    leftovers = [name for _, _, files in os.walk(tmp_path) for name in files if name.endswith(".tmp")]
+    assert leftovers == []
+    assert len(entry_paths(cache)) == 20
+
+
+def test_eviction_drops_least_recently_used_entries(tmp_path):
+    cache = DeclarationCache(str(tmp_path), max_bytes=10 ** 9)
+    keys = [f"{index:040x}" for index in range(10)]
+    now = time.time()
+    for age, key in enumerate(reversed(keys)):
+        cache.put(key, components_for(key, size=100))
+        os.utime(cache._entry_path(key), (now - 1000 - age * 10, now - 1000 - age * 10))
+    # keys[0] is the oldest write, but reading it makes it the most recently used
+    assert cache.get(keys[0]) is not None
+
+    entry_size = os.path.getsize(cache._entry_path(keys[0]))
+    cache.max_bytes = entry_size * 5
+    cache.evict(target_fraction=0.8)
+
+    survivors = {os.path.basename(os.path.dirname(path)) + os.path.basename(path)[:-len(cache.suffix)] for path in entry_paths(cache)}
+    assert survivors == {keys[0], keys[7], keys[8], keys[9]}
+    assert cache._scan_size() <= cache.max_bytes * 0.8
+
+
+def test_put_evicts_once_over_budget(tmp_path):
+    cache = DeclarationCache(str(tmp_path), max_bytes=4000)
+    for index in range(100):
+        key = f"{index:040x}"
+        cache.put(key, components_for(key, size=50))
+    assert cache._scan_size() <= 4000
+    assert cache.get(f"{99:040x}") is not None
+
+
+@pytest.mark.skipif(fcntl is None, reason="eviction only locks where fcntl is available")
+def test_eviction_backs_off_while_another_job_evicts(tmp_path):
+    cache = DeclarationCache(str(tmp_path), max_bytes=10 ** 9)
+    for index in range(5):
+        key = f"{index:040x}"
+        cache.put(key, components_for(key))
+    cache.max_bytes = 1
+    with open(tmp_path / ".evict.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        cache.evict()
+        assert len(entry_paths(cache)) == 5
+    cache.evict()
+    assert entry_paths(cache) == []
+
+
+def hammer(cache_dir: str, worker: int) -> int:
+    """Interleaved writes, reads and evictions; returns how many entries read back wrong"""
+    cache = DeclarationCache(cache_dir, max_bytes=3000)
+    wrong = 0
+    for step in range(150):
+        key = f"{(step * 7 + worker) % 60:040x}"
+        if step % 3:
+            components = cache.get(key)
+            if components is not None and components_to_record(components) != components_to_record(components_for(key, size=40)):
+                wrong += 1
+        else:
+            cache.put(key, components_for(key, size=40))
+    return wrong
+
+
+def test_concurrent_jobs_share_a_directory(tmp_path):
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(4) as pool:
+        assert pool.starmap(hammer, [(str(tmp_path), worker) for worker in range(4)]) == [0, 0, 0, 0]
+    cache = DeclarationCache(str(tmp_path), max_bytes=3000)
+    for path in entry_paths(cache):
+        with open(path) as f:
+            json.load(f)
+    leftovers = [name for _, _, files in os.walk(tmp_path) for name in files if name.endswith(".tmp")]
+    assert leftovers == []
+
+
+def test_content_cache_keys_by_commit_and_path(tmp_path):
+    cache = ContentCache(str(tmp_path))
+    cache.put("c1", "src/A.res", b"let a = 1\r\n\xff")
+    assert cache.get("c1", "src/A.res") == b"let a = 1\r\n\xff"
+    assert cache.get("c2", "src/A.res") is None
+    assert cache.get("c1", "src/B.res") is None
+    # Its own namespace: declaration entries never collide with contents
+    assert DeclarationCache(str(tmp_path)).entries_dir != cache.entries_dir
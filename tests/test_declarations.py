@@ -0,0 +1,46 @@
+from pathlib import Path
+
+import pytest
+
+from rescript_ast_diff.differ import RescriptFileDiff
+from rescript_ast_diff.pipeline import parse
+
+pytestmark = pytest.mark.grammar
+
+FIXTURES = sorted((Path(__file__).parent / "fixtures" / "declarations").glob("*.res"))
+
+
+def extracted(root, use_query: bool):
+    components = RescriptFileDiff("M", use_query=use_query).extract_components(root)
+    return sorted(
+        (kind, name, decl.start_byte, decl.end_byte, decl.fingerprint)
+        for kind, component_map in zip(("functions", "types", "externals"), components)
+        for name, decl in component_map.items()
+    )
+
+
+@pytest.mark.parametrize("fixture", FIXTURES, ids=[fixture.name for fixture in FIXTURES])
+def test_query_and_walk_extract_the_same_declarations(fixture):
+    root = parse(fixture.read_bytes()).root_node
+    assert not root.has_error
+    from_query = extracted(root, use_query=True)
+    assert from_query
+    assert from_query == extracted(root, use_query=False)
+
+
+def test_fixtures_cover_the_tricky_declarations():
+    names = {
+        (fixture.name, kind, name)
+        for fixture in FIXTURES
+        for kind, name, _, _, _ in extracted(parse(fixture.read_bytes()).root_node, use_query=True)
+    }
+    assert {
+        ("Recursion.res", "functions", "even"),
+        ("Recursion.res", "types", "tree"),
+        ("Recursion.res", "types", "expression"),
+        ("Bindings.res", "externals", "join"),
+        ("Bindings.res", "externals", "parse"),
+        ("Nested.res", "functions", "Api::get"),
+        ("Nested.res", "externals", "Api::fetch"),
+        ("Nested.res", "functions", "Cache::lookup"),
+    } <= names
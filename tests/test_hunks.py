@@ -0,0 +1,116 @@
+import difflib
+
+import pytest
+
+from rescript_ast_diff.differ import LineRangeIndex, RescriptFileDiff
+from rescript_ast_diff.hunks import byte_edits, hunk_from_unified
+from rescript_ast_diff.pipeline import parse
+
+OLD = """let add = (a, b) => {
+  let sum = a + b
+  sum
+}
+
+type point = {x: int, y: int}
+
+let scale = (p, k) => {
+  x: p.x * k,
+  y: p.y * k,
+}
+
+external log: string => unit = "console.log"
+
+let last = () => {
+  log("done")
+}
+"""
+
+
+def hunks_between(old: str, new: str):
+    """0-based (old_start, old_count, new_start, new_count) hunks, as `git diff -U0` would give them"""
+    matcher = difflib.SequenceMatcher(None, old.splitlines(keepends=True), new.splitlines(keepends=True), autojunk=False)
+    return [(i1, i2 - i1, j1, j2 - j1) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+
+def full(old: str, new: str) -> dict:
+    return RescriptFileDiff("M").compare_two_files(parse(old.encode()), parse(new.encode())).to_dict()
+
+
+def directed(old: str, new: str, hunks) -> dict:
+    old_content, new_content = old.encode(), new.encode()
+    return RescriptFileDiff("M").compare_two_files(parse(old_content), parse(new_content), hunks=hunks, old_content=old_content, new_content=new_content).to_dict()
+
+
+EDITS = pytest.mark.parametrize("new", [
+    # Hunk on the first line of a declaration
+    OLD.replace("let add = (a, b) => {", "let add = (a, b, c) => {"),
+    # Hunk on the last line of a declaration
+    OLD.replace('  log("done")\n}', '  log("finished")\n}'),
+    # Hunk between declarations only
+    OLD.replace("\n\ntype point", "\n\n\n// points\ntype point"),
+    # Insertion that shifts every later line
+    "let first = 1\n\n" + OLD.replace("y: p.y * k,", "y: p.y * k * 2,"),
+    # Deletion of a whole declaration
+    OLD.replace('external log: string => unit = "console.log"\n\n', ""),
+], ids=["declaration-start", "declaration-end", "between-declarations", "shifting-insertion", "deletion"])
+
+
+def test_hunk_from_unified_header():
+    # @@ -3,2 +3,4 @@ replaces lines 3-4 with lines 3-6
+    assert hunk_from_unified(3, 2, 3, 4) == (2, 2, 2, 4)
+    # A zero-length side names the line before the change: @@ -5,0 +6,2 @@ inserts after line 5
+    assert hunk_from_unified(5, 0, 6, 2) == (5, 0, 5, 2)
+    assert hunk_from_unified(0, 0, 1, 3) == (0, 0, 0, 3)
+    assert hunk_from_unified(7, 1, 6, 0) == (6, 1, 6, 0)
+
+
+@EDITS
+def test_byte_edits_rebuild_the_new_content(new):
+    old_content, new_content = OLD.encode(), new.encode()
+    edits = byte_edits(old_content, new_content, hunks_between(OLD, new))
+    assert edits is not None
+    rebuilt, position = b"", 0
+    for old_start, old_end, new_start, new_end in edits:
+        rebuilt += old_content[position:old_start] + new_content[new_start:new_end]
+        position = old_end
+    assert rebuilt + old_content[position:] == new_content
+
+
+def test_byte_edits_reject_hunks_that_do_not_describe_the_contents():
+    tip = OLD.replace("y: p.y * k,", "y: p.y * k + 1,")
+    new = OLD.replace("  sum\n}", "  sum * 2\n}")
+    assert byte_edits(tip.encode(), new.encode(), hunks_between(OLD, new)) is None
+    # The right hunks, out of order
+    two_edits = "let first = 1\n" + new
+    hunks = hunks_between(OLD, two_edits)
+    assert len(hunks) == 2 and byte_edits(OLD.encode(), two_edits.encode(), hunks) is not None
+    assert byte_edits(OLD.encode(), two_edits.encode(), hunks[::-1]) is None
+
+
+def test_line_range_index_merges_adjacent_ranges():
+    index = LineRangeIndex([(10, 12), (1, 2), (3, 5)])
+    assert (index.starts, index.ends) == ([1, 10], [5, 12])
+    assert index.overlaps(4, 4)
+    assert index.overlaps(8, 10)
+    assert index.overlaps(12, 20)
+    assert not index.overlaps(6, 9)
+    assert not index.overlaps(13, 20)
+    assert not index.overlaps(0, 0)
+
+
+@pytest.mark.grammar
+@EDITS
+def test_hunk_directed_matches_full_comparison(new):
+    hunks = hunks_between(OLD, new)
+    assert hunks
+    assert directed(OLD, new, hunks) == full(OLD, new)
+
+
+@pytest.mark.grammar
+def test_hunks_from_another_base_fall_back_to_full_comparison():
+    # Hunks computed against the merge-base, while the old side read is the target branch tip
+    tip = OLD.replace("y: p.y * k,", "y: p.y * k + 1,")
+    new = OLD.replace("  sum\n}", "  sum * 2\n}")
+    result = directed(tip, new, hunks_between(OLD, new))
+    assert result == full(tip, new)
+    assert sorted(entry[0] for entry in result["modifiedFunctions"]) == ["add", "scale"]
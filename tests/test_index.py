@@ -0,0 +1,74 @@
+import pytest
+
+from rescript_ast_diff.gitwrapper import GitWrapper
+from rescript_ast_diff.index import DeclarationIndex, ReferencesCache
+
+
+@pytest.mark.grammar
+def test_impact_through_camel_case_modules(repo, tmp_path):
+    old = repo.commit({
+        "LogicUtils.res": "let getValue = x => x + 1\n",
+        "apiUtils.res": "let fetch = x => LogicUtils.getValue(x)\n",
+        "Screen.res": "open ApiUtils\nlet render = () => fetch(1)\n",
+    })
+    new = repo.commit({"LogicUtils.res": "let getValue = x => x + 2\n"})
+
+    with GitWrapper(str(repo.path)) as gitclient, DeclarationIndex(str(tmp_path / "index.sqlite")) as index:
+        index.update(gitclient, old)
+        index.update(gitclient, new)
+        changed = index.changed_declarations(old, new)
+        assert [(entry["module"], entry["name"]) for entry in changed] == [("LogicUtils", "getValue")]
+
+        impacted = index.impacted(new, [("LogicUtils", "getValue")])
+        assert [(entry["module"], entry["name"], entry["depth"]) for entry in impacted] == [
+            ("ApiUtils", "fetch", 1),
+            ("Screen", "render", 2),
+        ]
+
+
+@pytest.mark.grammar
+def test_update_resolves_base_and_reuses_the_cache(repo, tmp_path):
+    old = repo.commit({"A.res": "let f = x => x + 1\n", "B.res": "let g = y => A.f(y)\n"})
+    repo.git("tag", "v1")
+    new = repo.commit({"A.res": "let f = x => x + 2\n"})
+    cache_dir = str(tmp_path / "cache")
+
+    def rows(db_path):
+        with DeclarationIndex(db_path) as index:
+            return (
+                sorted(index.connection.execute("SELECT * FROM declarations")),
+                sorted(index.connection.execute("SELECT * FROM refs")),
+            )
+
+    with GitWrapper(str(repo.path)) as gitclient:
+        with DeclarationIndex(str(tmp_path / "cold.sqlite")) as index:
+            index.update(gitclient, old, cache_dir=cache_dir)
+            assert index.update(gitclient, new, base="v1", cache_dir=cache_dir) == new
+        with DeclarationIndex(str(tmp_path / "warm.sqlite")) as index:
+            index.update(gitclient, "v1", cache_dir=cache_dir)
+            index.update(gitclient, new, base=old[:8], cache_dir=cache_dir)
+
+    assert rows(str(tmp_path / "warm.sqlite")) == rows(str(tmp_path / "cold.sqlite"))
+
+
+def test_update_accepts_any_revision_as_base(repo, tmp_path):
+    # No .res files, so nothing is parsed
+    old = repo.commit({"README.md": "one\n"})
+    repo.git("tag", "v1")
+    new = repo.commit({"README.md": "two\n"})
+    with GitWrapper(str(repo.path)) as gitclient, DeclarationIndex(str(tmp_path / "index.sqlite")) as index:
+        index.update(gitclient, old)
+        assert index.update(gitclient, new, base="v1") == new
+        assert index.update(gitclient, "main~1", base=old[:10]) == old
+        newest = repo.commit({"README.md": "three\n"})
+        with pytest.raises(ValueError):
+            index.update(gitclient, newest, base="no-such-branch")
+
+
+def test_references_cache_round_trip(tmp_path):
+    cache = ReferencesCache(str(tmp_path))
+    references = {"render": [["ApiUtils", "fetch"], ["Screen", "render"]], "Inner::value": []}
+    assert cache.get("ab" * 20) is None
+    cache.put("ab" * 20, references)
+    assert ReferencesCache(str(tmp_path)).get("ab" * 20) == references
+    assert (cache.hits, cache.misses) == (0, 1)
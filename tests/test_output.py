@@ -0,0 +1,69 @@
+import json
+import os
+
+import pytest
+
+from rescript_ast_diff.output import OUTPUT_FILE_NAMES, ChangesWriter
+
+RECORDS = [
+    {"moduleName": "A", "addedFunctions": [], "modifiedFunctions": [], "nested": {}},
+    {
+        "moduleName": "Ünïcode",
+        "addedFunctions": [["make", "let make = () => {\n  \"multi\\nline\"\n}", {"start": [0, 0], "end": [2, 1]}]],
+        "modifiedFunctions": [["f", "let f = 1", "let f = 2", {"old_start": [3, 0], "old_end": [3, 9], "new_start": [3, 0], "new_end": [3, 9]}]],
+        "nested": {"deep": [[], [{}], [1, 2.5, None, True]]},
+    },
+    {"moduleName": "C", "empty": "", "renamedFrom": "src/B.res"},
+]
+
+
+@pytest.mark.parametrize("count", [0, 1, len(RECORDS)])
+def test_json_output_matches_json_dump(tmp_path, count):
+    with ChangesWriter(str(tmp_path), "json") as writer:
+        for record in RECORDS[:count]:
+            writer.write(record)
+    expected = tmp_path / "expected.json"
+    with open(expected, "w") as f:
+        json.dump(RECORDS[:count], f, indent=3)
+    assert (tmp_path / OUTPUT_FILE_NAMES["json"]).read_bytes() == expected.read_bytes()
+
+
+def test_ndjson_output_is_one_record_per_line(tmp_path):
+    with ChangesWriter(str(tmp_path), "ndjson") as writer:
+        for record in RECORDS:
+            writer.write(record)
+    lines = (tmp_path / OUTPUT_FILE_NAMES["ndjson"]).read_text().splitlines()
+    assert [json.loads(line) for line in lines] == RECORDS
+
+
+def test_records_stream_to_the_partial_file_until_finalized(tmp_path):
+    final_path = tmp_path / OUTPUT_FILE_NAMES["ndjson"]
+    writer = ChangesWriter(str(tmp_path), "ndjson")
+    writer.write(RECORDS[0])
+    # Readable while the run is going, but never under the final name
+    assert json.loads((tmp_path / (OUTPUT_FILE_NAMES["ndjson"] + ".partial")).read_text()) == RECORDS[0]
+    assert not final_path.exists()
+    assert writer.finalize() == str(final_path)
+    assert writer.finalize() == str(final_path)
+    assert os.listdir(tmp_path) == [OUTPUT_FILE_NAMES["ndjson"]]
+
+
+def test_a_failed_run_keeps_the_previous_output(tmp_path):
+    with ChangesWriter(str(tmp_path), "json") as writer:
+        writer.write(RECORDS[0])
+    previous = (tmp_path / OUTPUT_FILE_NAMES["json"]).read_bytes()
+
+    with pytest.raises(RuntimeError):
+        with ChangesWriter(str(tmp_path), "json") as writer:
+            writer.write(RECORDS[1])
+            raise RuntimeError("parse failed")
+    assert (tmp_path / OUTPUT_FILE_NAMES["json"]).read_bytes() == previous
+    assert os.listdir(tmp_path) == [OUTPUT_FILE_NAMES["json"]]
+
+
+def test_custom_file_name_and_unknown_format(tmp_path):
+    with ChangesWriter(str(tmp_path / "new" / "dir"), "json", file_name="declaration_moves.json") as writer:
+        writer.write(RECORDS[2])
+    assert json.loads((tmp_path / "new" / "dir" / "declaration_moves.json").read_text()) == [RECORDS[2]]
+    with pytest.raises(ValueError, match="Unknown output format"):
+        ChangesWriter(str(tmp_path), "yaml")
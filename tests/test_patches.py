@@ -0,0 +1,77 @@
+import random
+import subprocess
+
+import pytest
+
+from rescript_ast_diff.patches import PATCH_ENCODING, PatchError, apply_patch, parse_patch
+
+OLD = {
+    "Edited.res": "let a = 1\nlet b = 2\nlet c = 3\nlet d = 4\nlet e = 5\nlet f = 6\nlet g = 7\n",
+    "NoNewline.res": "let a = 1\nlet b = 2",
+    "Crlf.res": "let a = 1\r\nlet b = 2\r\nlet c = 3\r\n",
+    "Deleted.res": "let gone = 1\n",
+}
+NEW = {
+    "Edited.res": "let first = 0\nlet a = 1\nlet b = 20\nlet c = 3\nlet d = 4\nlet f = 6\nlet g = 7\nlet h = 8\n",
+    "NoNewline.res": "let a = 1\nlet b = 3\nlet c = 4",
+    "Crlf.res": "let a = 1\r\nlet b = 22\r\nlet c = 3\r\n",
+    "Deleted.res": None,
+    "Added.res": "let new = 1\n",
+}
+
+
+def diff(repo, old: dict, new: dict):
+    old_commit = repo.commit(old)
+    new_commit = repo.commit(new)
+    # Read as bytes: text mode would turn the CRLF lines of the diff into LF
+    raw_diff = subprocess.run(["git", "-C", str(repo.path), "diff", "-U1", old_commit, new_commit], check=True, capture_output=True).stdout
+    return parse_patch(raw_diff.decode(*PATCH_ENCODING))
+
+
+def test_apply_patch_rebuilds_every_file(repo):
+    patches = diff(repo, OLD, NEW)
+    assert sorted(patches) == sorted(NEW)
+    for path, patched_file in patches.items():
+        base = OLD.get(path, "").encode()
+        expected = (NEW[path] or "").encode()
+        assert apply_patch(base, patched_file) == expected, path
+
+
+def test_apply_patch_matches_git_on_random_edits(repo):
+    rng = random.Random(0)
+    lines = [f"let v{index} = {index}\n" for index in range(40)]
+    old, new = {}, {}
+    for file_index in range(20):
+        before = rng.sample(lines, rng.randint(1, 30))
+        after = list(before)
+        for _ in range(rng.randint(1, 6)):
+            position = rng.randrange(len(after) + 1)
+            operation = rng.choice("ide")
+            if operation == "i":
+                after.insert(position, f"let inserted{rng.randint(0, 99)} = 1\n")
+            elif operation == "d" and position < len(after):
+                del after[position]
+            elif position < len(after):
+                after[position] = after[position].replace("=", "= -")
+        if after and rng.random() < 0.3:
+            after[-1] = after[-1].rstrip("\n")
+        old[f"M{file_index}.res"], new[f"M{file_index}.res"] = "".join(before), "".join(after)
+
+    patches = diff(repo, old, new)
+    for path, patched_file in patches.items():
+        assert apply_patch(old[path].encode(), patched_file) == new[path].encode(), path
+
+
+def test_apply_patch_rejects_a_different_base(repo):
+    patched_file = diff(repo, OLD, NEW)["Edited.res"]
+    # Same lines where the hunks look, but not the blob the patch was made against
+    base = OLD["Edited.res"].replace("let e = 5", "let e = 55").encode()
+    with pytest.raises(PatchError, match="base content"):
+        apply_patch(base, patched_file)
+
+
+def test_apply_patch_checks_the_context_without_blob_ids(repo):
+    patched_file = diff(repo, OLD, NEW)["Edited.res"]
+    patched_file.patch_info = None
+    with pytest.raises(PatchError, match="does not match the patch"):
+        apply_patch(OLD["Edited.res"].replace("let b = 2", "let b = 9").encode(), patched_file)
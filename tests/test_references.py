@@ -0,0 +1,7 @@
+from rescript_ast_diff.references import module_name
+
+
+def test_module_name_keeps_inner_capitals():
+    assert module_name("src/utils/LogicUtils.res") == "LogicUtils"
+    assert module_name("apiUtils.res") == "ApiUtils"
+    assert module_name("api_utils.res") == "Api_utils"
@@ -0,0 +1,129 @@
+import json
+import random
+
+import pytest
+
+from rescript_ast_diff.output import OUTPUT_FILE_NAMES, ChangesWriter
+from rescript_ast_diff.shards import Shard, merge_shards, write_manifest
+
+MODES = ("modified", "renamed", "added", "deleted")
+
+
+def make_tasks(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    tasks = [(rng.choice(MODES), f"src/Module{index}.res") for index in range(count)]
+    weights = {task: rng.choice((0, 10, 10, 250, 4000, 90000)) for task in tasks}
+    return tasks, weights
+
+
+def record(task) -> dict:
+    mode, file_path = task
+    return {
+        "moduleName": file_path,
+        "addedFunctions": [["make", "let make = () => \"é\\n\"", {"start": [1, 0], "end": [1, 24]}]] if mode != "deleted" else [],
+        "modifiedFunctions": [],
+        "deletedFunctions": [["old", "let old = 1", {"start": [0, 0], "end": [0, 11]}]] if mode != "added" else [],
+    }
+
+
+def run_single(directory, tasks, output_format: str) -> str:
+    with ChangesWriter(str(directory), output_format) as writer:
+        for task in tasks:
+            writer.write(record(task))
+    return writer.output_path
+
+
+def run_shard(directory, shard: Shard, tasks, weights, output_format: str = "json", commits=("a" * 40, "b" * 40)) -> str:
+    """What `compare --shard` leaves behind: the shard's records and its manifest"""
+    selected = shard.select(tasks, lambda mode, file_path: weights[(mode, file_path)])
+    with ChangesWriter(str(directory), output_format) as writer:
+        for task in selected:
+            writer.write(record(task))
+    run = {"pr_id": None, "from_branch": "feature", "to_branch": "main", "from_commit": commits[0], "to_commit": commits[1], "format": output_format}
+    write_manifest(str(directory), shard.manifest(**run))
+    return str(directory)
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 7])
+def test_shards_partition_the_tasks(count):
+    tasks, weights = make_tasks(50)
+    weight = lambda mode, file_path: weights[(mode, file_path)]
+    selections = [Shard(index, count).select(tasks, weight) for index in range(1, count + 1)]
+
+    assert sorted(task for selected in selections for task in selected) == sorted(tasks)
+    for selected in selections:
+        # Original order, and the same answer for the same input
+        assert selected == [task for task in tasks if task in selected]
+    assert selections == [Shard(index, count).select(list(tasks), weight) for index in range(1, count + 1)]
+
+    # Greedy heaviest-first keeps every shard within one file of the lightest (empty files weigh 1)
+    loads = [sum(max(weights[task], 1) for task in selected) for selected in selections]
+    assert max(loads) - min(loads) <= max(weights.values())
+
+
+def test_shard_selection_does_not_depend_on_task_order():
+    # Equal weights everywhere, so only the mode/path tie-break decides
+    tasks = [("modified", f"M{index}.res") for index in range(12)]
+    shuffled = random.Random(1).sample(tasks, len(tasks))
+    for index in (1, 2, 3):
+        assert set(Shard(index, 3).select(tasks, lambda *_: 5)) == set(Shard(index, 3).select(shuffled, lambda *_: 5))
+
+
+def test_shard_parse():
+    shard = Shard.parse("2/8")
+    assert (shard.index, shard.count, str(shard)) == (2, 8, "2/8")
+    for value in ("0/3", "4/3", "3", "a/b", "1/0", "-1/2"):
+        with pytest.raises(ValueError):
+            Shard.parse(value)
+
+
+@pytest.mark.parametrize("output_format", ["json", "ndjson"])
+def test_merge_is_byte_identical_to_a_single_run(tmp_path, output_format):
+    tasks, weights = make_tasks(30)
+    single = run_single(tmp_path / "single", tasks, output_format)
+    shard_dirs = [run_shard(tmp_path / f"shard{index}", Shard(index, 4), tasks, weights, output_format) for index in range(1, 5)]
+
+    merged = merge_shards(shard_dirs[::-1], str(tmp_path / "merged"))
+    with open(single, "rb") as expected, open(merged, "rb") as actual:
+        assert actual.read() == expected.read()
+
+
+def test_merge_can_change_the_format(tmp_path):
+    tasks, weights = make_tasks(10)
+    single = run_single(tmp_path / "single", tasks, "ndjson")
+    shard_dirs = [run_shard(tmp_path / f"shard{index}", Shard(index, 2), tasks, weights, "json") for index in (1, 2)]
+    merged = merge_shards(shard_dirs, str(tmp_path / "merged"), output_format="ndjson")
+    assert merged.endswith(OUTPUT_FILE_NAMES["ndjson"])
+    with open(single, "rb") as expected, open(merged, "rb") as actual:
+        assert actual.read() == expected.read()
+
+
+def test_merge_rejects_incomplete_or_mismatched_shards(tmp_path):
+    tasks, weights = make_tasks(12)
+    first = run_shard(tmp_path / "first", Shard(1, 2), tasks, weights)
+    second = run_shard(tmp_path / "second", Shard(2, 2), tasks, weights)
+
+    with pytest.raises(ValueError, match="exactly once"):
+        merge_shards([first], str(tmp_path / "out"))
+    with pytest.raises(ValueError, match="exactly once"):
+        merge_shards([first, first], str(tmp_path / "out"))
+
+    # The head moved between the two shard jobs
+    moved = run_shard(tmp_path / "moved", Shard(2, 2), tasks, weights, commits=("a" * 40, "c" * 40))
+    with pytest.raises(ValueError, match="diffed"):
+        merge_shards([first, moved], str(tmp_path / "out"))
+
+    # Weighed differently, so the selections overlap
+    reweighed = run_shard(tmp_path / "reweighed", Shard(2, 2), tasks, {task: 1 for task in tasks})
+    with open(tmp_path / "first" / "shard.json") as f, open(tmp_path / "reweighed" / "shard.json") as g:
+        overlapping = {tuple(task) for task in json.load(f)["selected"]} & {tuple(task) for task in json.load(g)["selected"]}
+    assert overlapping
+    with pytest.raises(ValueError, match="repeats"):
+        merge_shards([first, reweighed], str(tmp_path / "out"))
+
+    # A shard that stopped part way
+    with open(tmp_path / "second" / OUTPUT_FILE_NAMES["json"], "w") as f:
+        f.write("[]")
+    with pytest.raises(ValueError, match="did not finish"):
+        merge_shards([first, second], str(tmp_path / "out"))
+    assert not (tmp_path / "out" / OUTPUT_FILE_NAMES["json"]).exists()